@@ -99,6 +99,37 @@ class FortuneCalculator:
         '水': {'lucky_color': '黑色、蓝色', 'lucky_direction': '北方', 'lucky_element': '水'}
     }
     
+    # 天干五合（合化五行）
+    TIAN_GAN_HE = {
+        frozenset('甲己'): '土', frozenset('乙庚'): '金', frozenset('丙辛'): '水',
+        frozenset('丁壬'): '木', frozenset('戊癸'): '火'
+    }
+    # 天干相冲
+    TIAN_GAN_CHONG = {frozenset('甲庚'), frozenset('乙辛'), frozenset('丙壬'), frozenset('丁癸')}
+    # 地支六合（合化五行）
+    DI_ZHI_LIU_HE = {
+        frozenset('子丑'): '土', frozenset('寅亥'): '木', frozenset('卯戌'): '火',
+        frozenset('辰酉'): '金', frozenset('巳申'): '水', frozenset('午未'): '土'
+    }
+    # 地支六冲
+    DI_ZHI_CHONG = {
+        frozenset('子午'), frozenset('丑未'), frozenset('寅申'),
+        frozenset('卯酉'), frozenset('辰戌'), frozenset('巳亥')
+    }
+    # 地支相刑（寅巳申无恩之刑、丑戌未恃势之刑、子卯无礼之刑）
+    DI_ZHI_XING = {
+        frozenset('寅巳'), frozenset('巳申'), frozenset('寅申'),
+        frozenset('丑戌'), frozenset('戌未'), frozenset('丑未'),
+        frozenset('子卯')
+    }
+    # 地支自刑
+    DI_ZHI_ZI_XING = {'辰', '午', '酉', '亥'}
+    # 地支六害
+    DI_ZHI_HAI = {
+        frozenset('子未'), frozenset('丑午'), frozenset('寅巳'),
+        frozenset('卯辰'), frozenset('申亥'), frozenset('酉戌')
+    }
+    
     # 纳音五行（简化版，仅五行）
     NA_YIN = {
         '甲子': '金', '乙丑': '金', '丙寅': '火', '丁卯': '火',
@@ -257,7 +288,39 @@ class FortuneCalculator:
         if hour == 23 or hour == 0:
             return 0  # 子
         return (hour + 1) // 2
-    
+
+    def get_lunar_date(self, moment: datetime) -> Dict[str, Any]:
+        """
+        公历时刻 → 农历月、日与时辰
+
+        Args:
+            moment: 公历时间（不做真太阳时修正）
+
+        Returns:
+            year_gan_zhi, month（1-12）, is_leap_month, month_name（如：闰六月）,
+            day（1-30）, day_name（如：初十）, hour_zhi, hour_index（子=0 ... 亥=11）,
+            day_gan_zhi, hour_gan_zhi, jie_qi（当前所处节气）
+        """
+        lunar = Solar.fromYmdHms(
+            moment.year, moment.month, moment.day,
+            moment.hour, moment.minute, moment.second
+        ).getLunar()
+        month = lunar.getMonth()
+        hour_index = self._get_time_zhi_index(moment.hour)
+        return {
+            'year_gan_zhi': lunar.getYearInGanZhi(),
+            'month': abs(month),
+            'is_leap_month': month < 0,
+            'month_name': f"{lunar.getMonthInChinese()}月",
+            'day': lunar.getDay(),
+            'day_name': lunar.getDayInChinese(),
+            'hour_zhi': self.DI_ZHI[hour_index],
+            'hour_index': hour_index,
+            'day_gan_zhi': lunar.getDayInGanZhi(),
+            'hour_gan_zhi': lunar.getTimeInGanZhi(),
+            'jie_qi': lunar.getPrevJieQi(False).getName()
+        }
+
     def calculate_shi_shen(self, day_gan: str, other_gan: str) -> str:
         """
         计算十神
@@ -606,6 +669,96 @@ class FortuneCalculator:
         """
         return self.CHANG_SHENG_TABLE.get(day_gan, {}).get(zhi, '')
     
+    def analyze_liu_nian(
+        self,
+        pillars: Dict[str, str],
+        liu_nian: str,
+        da_yun: str = '',
+        useful_gods: Optional[List[str]] = None,
+        taboo_gods: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
+        """
+        分析流年与原局四柱、所在大运的作用关系（纯规则计算，不依赖 LLM）
+        
+        Args:
+            pillars: 四柱干支，如 {'year': '己巳', 'month': '丙子', 'day': '丙寅', 'hour': '壬辰'}
+            liu_nian: 流年干支
+            da_yun: 所在大运干支（可为空）
+            useful_gods: 喜用神五行
+            taboo_gods: 忌神五行
+        
+        Returns:
+            流年十神、星运、纳音、喜忌，以及与各柱 / 大运的合、冲、刑、害
+        """
+        useful_gods = useful_gods or []
+        taboo_gods = taboo_gods or []
+        day_gan = pillars['day'][0]
+        gan, zhi = liu_nian[0], liu_nian[1]
+        
+        def effect(wuxing: str) -> str:
+            if wuxing in useful_gods:
+                return '喜'
+            if wuxing in taboo_gods:
+                return '忌'
+            return '平'
+        
+        targets = [
+            (name, pillars.get(key, ''))
+            for key, name in (('year', '年柱'), ('month', '月柱'), ('day', '日柱'), ('hour', '时柱'))
+        ]
+        if da_yun:
+            targets.append(('大运', da_yun))
+        
+        interactions = []
+        for target, gan_zhi in targets:
+            if len(gan_zhi) < 2:
+                continue
+            other_gan, other_zhi = gan_zhi[0], gan_zhi[1]
+            gan_pair = frozenset((gan, other_gan))
+            zhi_pair = frozenset((zhi, other_zhi))
+            
+            if gan_pair in self.TIAN_GAN_HE:
+                interactions.append({'type': '天干五合', 'target': target,
+                                     'detail': f"{gan}{other_gan}合化{self.TIAN_GAN_HE[gan_pair]}"})
+            if gan_pair in self.TIAN_GAN_CHONG:
+                interactions.append({'type': '天干相冲', 'target': target, 'detail': f"{gan}{other_gan}相冲"})
+            if zhi_pair in self.DI_ZHI_LIU_HE:
+                interactions.append({'type': '地支六合', 'target': target,
+                                     'detail': f"{zhi}{other_zhi}合化{self.DI_ZHI_LIU_HE[zhi_pair]}"})
+            if zhi_pair in self.DI_ZHI_CHONG:
+                interactions.append({'type': '地支六冲', 'target': target, 'detail': f"{zhi}{other_zhi}相冲"})
+            if zhi_pair in self.DI_ZHI_XING:
+                interactions.append({'type': '地支相刑', 'target': target, 'detail': f"{zhi}{other_zhi}相刑"})
+            elif zhi == other_zhi and zhi in self.DI_ZHI_ZI_XING:
+                interactions.append({'type': '地支自刑', 'target': target, 'detail': f"{zhi}{other_zhi}自刑"})
+            if zhi_pair in self.DI_ZHI_HAI:
+                interactions.append({'type': '地支六害', 'target': target, 'detail': f"{zhi}{other_zhi}相害"})
+        
+        # 太岁：流年地支与出生年支相同为本命年，相冲为冲太岁
+        year_zhi = pillars.get('year', '  ')[1]
+        if zhi == year_zhi:
+            tai_sui = '本命年'
+        elif frozenset((zhi, year_zhi)) in self.DI_ZHI_CHONG:
+            tai_sui = '冲太岁'
+        else:
+            tai_sui = ''
+        
+        gan_wuxing = self.TIAN_GAN_WUXING[gan]
+        zhi_wuxing = self.DI_ZHI_WUXING[zhi]
+        return {
+            'gan_zhi': liu_nian,
+            'gan_shi_shen': self.calculate_shi_shen(day_gan, gan),
+            'zhi_shi_shen': self.calculate_shi_shen(day_gan, self.DI_ZHI_CANG_GAN[zhi][0][0]),
+            'xing_yun': self.get_xing_yun(day_gan, zhi),
+            'na_yin': self.get_na_yin_full(liu_nian),
+            'gan_wuxing': gan_wuxing,
+            'zhi_wuxing': zhi_wuxing,
+            'gan_effect': effect(gan_wuxing),
+            'zhi_effect': effect(zhi_wuxing),
+            'tai_sui': tai_sui,
+            'interactions': interactions
+        }
+    
     def determine_pattern(self, si_zhu: Dict[str, str], shi_shen: Dict[str, str]) -> str:
         """
         判定格局
@@ -6,21 +6,43 @@ import os
 import json
 import re
 import base64
-from typing import Optional, List, Dict
+import hashlib
+import uuid
+import asyncio
+import threading
+from typing import Optional, List, Dict, Tuple
 from datetime import datetime, timedelta
-from fastapi import FastAPI, HTTPException, Header, Depends
-from fastapi.responses import StreamingResponse
+from zoneinfo import ZoneInfo
+from fastapi import FastAPI, HTTPException, Header, Depends, Query
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, field_validator, Field
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from calculator import FortuneCalculator
 from services.lifeline import lifeline_service
 from services.lifeline import lifeline_service
+from services.stream_hub import stream_hub, StreamSession, parse_last_event_id
+from services.llm_scheduler import llm_scheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from services.deadline import Deadline
+from services.job_queue import kline_job_queue
+from services.precompute import kline_precompute, kline_year_prefetch, chat_tab_prefetch
+from services.timeline import resolve_window, summarize_window
+from services.columnar import to_columnar, validate_payload_format
+from services.chat_sessions import chat_session_store
+from services.chat_context import chat_context
+from services.prompt_cache import prompt_cache
+from services.knowledge import faq_index
+from services.chart_codec import chart_codec, CHART_SECTIONS
+from services.intent_router import intent_router
+from services.meihua import cast_by_numbers, extract_numbers, format_cast
+from services.xiaoliuren import liuren_by_time, format_liuren
+from services.qimen import qimen_plate, format_qimen
+from services.ziwei import ziwei_chart, format_ziwei, ziwei_cache_stats
 
 # 加载环境变量
 load_dotenv()
@@ -76,6 +98,84 @@ class FortuneBook(Base):
             "created_at": self.created_at.isoformat() if self.created_at else None
         }
 
+class KLineJob(Base):
+    """K 线后台生成任务表"""
+    __tablename__ = "kline_jobs"
+    
+    id = Column(String, primary_key=True, index=True)  # 任务ID（uuid hex，不可枚举）
+    user_id = Column(String, index=True, nullable=True)  # 基于命书创建时为命书所有者
+    book_id = Column(Integer, index=True, nullable=True)  # 关联的命书ID（传 birth_data 时为空）
+    status = Column(String, nullable=False, default="queued")  # queued / running / completed / failed
+    progress = Column(Integer, nullable=False, default=0)  # 0-100
+    birth_info = Column(Text, nullable=False)  # 出生信息JSON
+    result = Column(Text, nullable=True)  # 生成结果JSON（chart_data, analysis_text, bazi_report）
+    error = Column(Text, nullable=True)  # 失败原因
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    
+    def to_dict(self):
+        """转换为字典"""
+        return {
+            "job_id": self.id,
+            "user_id": self.user_id,
+            "book_id": self.book_id,
+            "status": self.status,
+            "progress": self.progress,
+            "result": json.loads(self.result) if self.result else None,
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+class KLineCurve(Base):
+    """命书 K 线曲线表（与读取时间无关的部分，随时间变化的字段在读取时计算）"""
+    __tablename__ = "kline_curves"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    book_id = Column(Integer, ForeignKey("fortune_books.id"), unique=True, index=True, nullable=False)  # 关联的命书ID
+    chart_key = Column(String, index=True, nullable=True)  # 出生信息指纹（相同命盘的命书可直接复用曲线）
+    birth_year = Column(Integer, nullable=False)  # 出生年份（用于计算当前年龄）
+    points = Column(Text, nullable=False)  # 101个数据点JSON（age, year, gan_zhi, da_yun, score, is_peak, is_valley）
+    peaks = Column(Text, nullable=False)  # 高峰列表JSON
+    valleys = Column(Text, nullable=False)  # 低谷列表JSON
+    analysis_text = Column(Text, nullable=True)  # LLM 总结
+    bazi_report = Column(Text, nullable=True)  # 生成时的排盘数据JSON
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class KLineYearDetail(Base):
+    """K 线流年详情解读缓存表（按命盘 + 年龄缓存，用户查看时才生成）"""
+    __tablename__ = "kline_year_details"
+    
+    id = Column(String, primary_key=True, index=True)  # {chart_key}:{age}
+    chart_key = Column(String, index=True, nullable=False)  # 出生信息指纹（同 KLineCurve.chart_key）
+    age = Column(Integer, nullable=False)  # 年龄（0-100）
+    narrative = Column(Text, nullable=False)  # 解读JSON（summary, wealth, interpersonal, relationship, health, suitable, avoid）
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ChatSession(Base):
+    """起卦对话会话表（服务端保存对话历史，客户端每轮只发送新消息）"""
+    __tablename__ = "chat_sessions"
+    
+    id = Column(String, primary_key=True, index=True)  # 会话ID（uuid hex，不可枚举）
+    user_id = Column(String, index=True, nullable=False)  # 会话所有者
+    messages = Column(Text, nullable=False)  # 对话历史JSON（role, content）
+    bazi_data = Column(Text, nullable=True)  # 首轮传入的八字排盘数据JSON
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        """转换为字典"""
+        return {
+            "session_id": self.id,
+            "user_id": self.user_id,
+            "messages": json.loads(self.messages),
+            "bazi_data": json.loads(self.bazi_data) if self.bazi_data else None,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None
+        }
+
 # 创建数据库表
 Base.metadata.create_all(bind=engine)
 
@@ -225,6 +325,16 @@ if COMPASS_API_KEY:
         print(f"⚠️  Compass API 客户端初始化失败: {e}", flush=True)
         compass_client = None
 
+
+# 静态系统提示词的上游缓存（与生成共用 Compass 客户端）
+def cached_prompt_handle(key: str, system_instruction: str, model: str = "gemini-2.5-flash") -> Optional[str]:
+    """
+    静态提示词的上游缓存名（未就绪、未启用或不支持时返回 None，照常发送完整提示词）
+    
+    缓存必须建在发起生成的同一个 Compass 客户端上，缓存名只在创建它的服务端有效。
+    """
+    return prompt_cache.handle(compass_client, key, model, system_instruction)
+
 # 初始化 DeepSeek API 配置（作为备用）
 deepseek_api_key = os.getenv("DEEPSEEK_API_KEY", "")
 deepseek_base_url = os.getenv("DEEPSEEK_API_BASE_URL", "https://api.deepseek.com/v1")
@@ -233,19 +343,6 @@ if deepseek_api_key:
 else:
     print("⚠️  DeepSeek API 未配置", flush=True)
 
-# 加载知识库
-FAQ_CONTENT = ""
-FAQ_PATH = "faq.txt"
-try:
-    if os.path.exists(FAQ_PATH):
-        with open(FAQ_PATH, "r", encoding="utf-8") as f:
-            FAQ_CONTENT = f.read()
-    else:
-        print(f"⚠️  知识库文件 {FAQ_PATH} 不存在，将使用空知识库")
-except Exception as e:
-    print(f"⚠️  读取知识库文件 {FAQ_PATH} 失败: {e}，将使用空知识库")
-    FAQ_CONTENT = ""
-
 # 起卦对话 System Prompt（单轮深度交付版）
 DIVINATION_SYSTEM_PROMPT = """你是一位实战派命理顾问，擅长将复杂的八字、紫微斗数转化为现代人的"人生避坑指南"。
 
@@ -258,6 +355,7 @@ DIVINATION_SYSTEM_PROMPT = """你是一位实战派命理顾问，擅长将复
 2. **单轮完整输出**：一旦用户提供生辰信息，立即按完整结构输出，**严禁分段，严禁引导追问**。
 3. **去玄学化**：不说"食神、伤官"，说"才华、反叛精神"；不说"寅申冲"，说"环境变动、车马之劳"。
 4. **拒绝宽泛**：禁止使用"性格开朗"、"事业有成"等废话。必须结合八字（如：火旺则急、土重则厚）给出具体的描述。
+5. **紫微以排盘为准**：若提供了【紫微斗数命盘】，十二宫、主星、四化与大限均已由后端排出，直接引用，严禁自行重新安星。
 
 【阶段1：初始接待 (Greeting)】
 
@@ -389,13 +487,16 @@ SINGLE_EVENT_DIVINATION_PROMPT = """### Role Definition
 #### 2. 【卦象解码：透视现象】 (专业+通俗)
 在此板块，你需要列出专业术语，但必须紧跟**"人话翻译"**。
 - **小六壬（看时机）**：
+  - 若消息中已附【小六壬排盘】，课位以其为准，不要重新掐算。
   - 输出格式：`课位名称` —— `通俗解释`。
   - *示例：* "留连 —— 意思是'拖延、缓慢'。说明这件事不会像你预期的那样快，需要多一点耐心。"
 - **梅花易数（看过程）**：
+  - 若消息中已附【梅花易数排盘】，主卦、互卦、变卦、动爻和体用关系以其为准，不要重新起卦。
   - 展示主卦、变卦名称。
   - **重点解释体用关系**：不要只说"用克体"，要解释为"外部环境对你构成了压力/这件事的主导权暂时不在你手里"。
   - **卦意映射**：将"无妄"、"讼"等卦名翻译成具体场景。如"讼"代表"观点不合、需要大量沟通"，而不是"打官司"。
 - **奇门/神煞（看细节）**：
+  - 若消息中已附【奇门遁甲盘】，局数、值符值使和各宫星门神以其为准，不要重新排盘。
   - 选取 1-2 个最关键的符号进行解读。
   - *转化技巧*：遇到"死门/惊门"，解释为"对方态度不够积极"或"容易产生误会"；遇到"玄武"，解释为"局势不明朗，信息不对称"。
 
@@ -472,6 +573,10 @@ class KLineGenerateRequest(BaseModel):
     lat: Optional[float] = None
     lng: Optional[float] = None
     city: Optional[str] = None
+    mode: Optional[str] = None  # job：后台任务模式，立即返回 job_id
+    refresh: Optional[bool] = False  # 传 book_id 时忽略已保存的曲线，重新生成
+    from_age: Optional[int] = Field(None, ge=0, le=100)  # 只返回该年龄区间的数据点（默认 0-100）
+    to_age: Optional[int] = Field(None, ge=0, le=100)
     
     @field_validator('birth_date')
     @classmethod
@@ -483,6 +588,14 @@ class KLineGenerateRequest(BaseModel):
             except ValueError:
                 raise ValueError('出生日期格式错误，应为 YYYY-MM-DD（如：2000-10-10）')
         return v
+    
+    @field_validator('mode')
+    @classmethod
+    def validate_mode(cls, v):
+        """验证生成模式"""
+        if v is not None and v != 'job':
+            raise ValueError('mode 只支持 job')
+        return v
 
 
 class SaveFortuneBookRequest(BaseModel):
@@ -572,47 +685,13 @@ class SaveFortuneBookRequest(BaseModel):
         return v
 
 
-def build_system_prompt(bazi_report: dict, name: str, gender: str, city: str) -> str:
+def build_fortune_static_prompt() -> str:
     """
-    构建系统提示词（升级版：包含硬核判定和核心性格语料库）
-    
-    Args:
-        bazi_report: BaziReport 数据结构
-        name: 姓名
-        gender: 性别
-        city: 城市
+    命理分析系统提示词中与用户无关的部分（角色定义、性格语料库）
     
-    Returns:
-        系统提示词字符串
+    内容只随代码变化，可作为上游缓存的前缀（见 services/prompt_cache.py）。
+    知识库按命盘检索后放在 build_fortune_facts_prompt 中。
     """
-    chart = bazi_report['chart']
-    five_elements = bazi_report.get('five_elements_legacy', bazi_report.get('five_elements', {}))
-    gods = bazi_report['gods']
-    da_yun = bazi_report['da_yun']
-    
-    # 提取关键数据
-    day_master = bazi_report.get('day_master', chart.get('day_gan', ''))
-    day_wuxing = gods.get('day_wuxing', '')
-    strength_status = gods.get('strength_status', '中和')
-    pattern_name = gods.get('pattern_name', '正格')
-    yong_shen = gods.get('useful_gods', [])
-    xi_shen = gods.get('favorable_god', '')
-    personality_tags = gods.get('personality_tags', [])
-    
-    # 五行百分比（兼容新旧格式）
-    if isinstance(five_elements, list):
-        # 新格式：数组
-        wuxing_percentages = {elem['name']: elem['percent'] for elem in five_elements}
-    else:
-        # 旧格式：字典
-        wuxing_percentages = five_elements.get('percentages', {})
-    
-    mu = wuxing_percentages.get('木', 0)
-    huo = wuxing_percentages.get('火', 0)
-    tu = wuxing_percentages.get('土', 0)
-    jin = wuxing_percentages.get('金', 0)
-    shui = wuxing_percentages.get('水', 0)
-    
     # 1. 系统角色定义
     role_prompt = """你是一位精通子平八字与现代心理学的命理专家。你的任务是基于后端提供的"精密排盘数据"，为用户提供温暖、治愈且富有深度的命理分析。
 
@@ -621,18 +700,7 @@ def build_system_prompt(bazi_report: dict, name: str, gender: str, city: str) ->
 - 逻辑：严格遵守后端给出的日主强弱、喜用神和五行得分，不得随意更改基本事实
 - 风格：将生涩的术语（如"伤官见官"）转化为易懂的生活建议和性格解析"""
     
-    # 2. 后端注入的"事实语料库"
-    facts = f"""
-[核心数据]
-- 日主：{day_master}（{day_wuxing}）
-- 状态：{strength_status}（如：日主中和/强/弱）
-- 格局：{pattern_name}
-- 喜用神：{', '.join(yong_shen) if yong_shen else '无'}、{xi_shen if xi_shen else ''}
-- 五行能量：木({mu}%), 火({huo}%), 土({tu}%), 金({jin}%), 水({shui}%)
-- 性格标签：{', '.join(personality_tags) if personality_tags else '无'}
-"""
-    
-    # 3. 核心性格语料库
+    # 2. 核心性格语料库
     personality_knowledge = """
 [核心性格语料库]
 根据日主天干和五行，参考以下性格特征进行准确分析：
@@ -649,60 +717,49 @@ def build_system_prompt(bazi_report: dict, name: str, gender: str, city: str) ->
 - 癸水：像清澈的溪流，温柔智慧，适应力强。思维敏捷，善于学习，但有时过于随波逐流。
 """
     
-    # 八字排盘数据（详细版）
-    bazi_data = f"""
-【八字排盘数据（BaziReport）】
-姓名: {name}
-性别: {gender}
-出生地: {city}
-真太阳时: {bazi_report['true_solar_time']}
+    return f"{role_prompt}\n\n{personality_knowledge}"
 
-四柱八字详情:
-"""
-    for pillar in chart['pillars']:
-        bazi_data += f"  {pillar['name']}: {pillar['gan_zhi']} "
-        bazi_data += f"(天干:{pillar['gan']}{pillar['gan_wuxing']}, 地支:{pillar['zhi']}{pillar['zhi_wuxing']})"
-        if pillar['cang_gan']:
-            cang_str = ', '.join([f"{c['gan']}({c['score']}分)" for c in pillar['cang_gan']])
-            bazi_data += f" 藏干:[{cang_str}]"
-        if pillar['na_yin']:
-            bazi_data += f" 纳音:{pillar['na_yin']}"
-        bazi_data += "\n"
-    
-    bazi_data += f"\n十神配置:\n"
-    for key, value in chart['shi_shen'].items():
-        pillar_name = key.replace('_shi_shen', '').replace('year', '年柱').replace('month', '月柱').replace('day', '日柱').replace('hour', '时柱')
-        bazi_data += f"  {pillar_name}: {value}\n"
-    
-    bazi_data += f"\n日主: {chart['day_gan']}{chart['day_zhi']} ({gods['day_wuxing']})\n"
-    
-    # 五行能量分析
-    bazi_data += f"""
-【五行能量分析】
-五行得分: 木={five_elements['scores']['木']}, 火={five_elements['scores']['火']}, 土={five_elements['scores']['土']}, 金={five_elements['scores']['金']}, 水={five_elements['scores']['水']}
-五行占比: 木={five_elements['percentages']['木']}%, 火={five_elements['percentages']['火']}%, 土={five_elements['percentages']['土']}%, 金={five_elements['percentages']['金']}%, 水={five_elements['percentages']['水']}%
-最旺五行: {five_elements['strongest']}
-最弱五行: {five_elements['weakest']}
-五行状态: {five_elements['missing']}
-
-【用神分析】
-日主强弱: {'偏强' if gods['is_strong'] else '偏弱'}
-同党得分: {gods['tong_dang_score']} (印、比劫)
-异党得分: {gods['yi_dang_score']} (食伤、财、官杀)
-喜用神: {', '.join(gods['useful_gods']) if gods['useful_gods'] else '无'}
-忌神: {', '.join(gods['taboo_gods']) if gods['taboo_gods'] else '无'}
-
-大运:
-"""
-    for dy in da_yun:
-        bazi_data += f"  {dy['age_start']}-{dy['age_end']}岁: {dy['gan_zhi']}\n"
+
+def build_fortune_facts_prompt(bazi_report: dict, name: str, gender: str, city: str) -> str:
+    """
+    命理分析系统提示词中与用户相关的部分（核心数据、排盘详情）及输出要求
+    
+    Args:
+        bazi_report: BaziReport 数据结构
+        name: 姓名
+        gender: 性别
+        city: 城市
+    """
+    chart = bazi_report['chart']
+    gods = bazi_report['gods']
+    
+    # 提取关键数据（用于知识库检索）
+    day_master = bazi_report.get('day_master', chart.get('day_gan', ''))
+    day_wuxing = gods.get('day_wuxing', '')
+    strength_status = gods.get('strength_status', '中和')
+    pattern_name = gods.get('pattern_name', '正格')
+    yong_shen = gods.get('useful_gods', [])
+    xi_shen = gods.get('favorable_god', '')
+    personality_tags = gods.get('personality_tags', [])
     
-    # 知识库内容
-    knowledge_base = f"""
-【知识库参考】
-{FAQ_CONTENT}
+    # 1. 后端注入的"事实语料库"：命盘紧凑编码（见 services/chart_codec.py）
+    facts = f"""
+[核心数据]
+姓名：{name} 性别：{gender} 出生地：{city} 真太阳时：{bazi_report['true_solar_time']}
+{chart_codec.encode(bazi_report, CHART_SECTIONS)}
 """
     
+    # 知识库：只注入与命盘相关的段落（见 services/knowledge.py）
+    knowledge_query = " ".join([
+        day_master, day_wuxing, strength_status, pattern_name,
+        *yong_shen, xi_shen, *personality_tags, *chart['shi_shen'].values(),
+        "性格 天赋 十神 大运 事业 感情 财运 健康"
+    ])
+    knowledge_chunks = faq_index.search(knowledge_query)
+    knowledge_base = ""
+    if knowledge_chunks:
+        knowledge_base = "\n【知识库参考】\n" + "\n\n".join(knowledge_chunks) + "\n"
+    
     # 输出要求
     output_requirements = f"""
 【重要提示】
@@ -750,7 +807,7 @@ def build_system_prompt(bazi_report: dict, name: str, gender: str, city: str) ->
 3. 分析时请充分利用 BaziReport 中的硬数据（五行得分、用神、十神等），确保分析有数据支撑，而不是泛泛而谈。
 """
     
-    return f"{role_prompt}\n\n{facts}\n\n{personality_knowledge}\n\n{bazi_data}\n\n{knowledge_base}\n\n{output_requirements}"
+    return f"{facts}\n\n{knowledge_base}\n\n{output_requirements}"
 
 
 def parse_llm_json_response(text: str) -> Optional[dict]:
@@ -823,12 +880,103 @@ def parse_chart_data(text: str) -> Optional[dict]:
     return None
 
 
-async def stream_fortune_analysis(request: FortuneRequest):
+def _pull_sync_chunk(iterator, lock: threading.Lock, sentinel):
+    with lock:
+        return next(iterator, sentinel)
+
+
+def _close_sync_stream(iterator, lock: threading.Lock):
+    """等正在进行的 next() 返回后关闭同步流（GenAI SDK 的流在 close() 时断开 HTTP 连接）"""
+    with lock:
+        close = getattr(iterator, 'close', None)
+        if close:
+            try:
+                close()
+            except Exception as e:
+                print(f"⚠️  关闭上游流失败: {e}", flush=True)
+
+
+async def iter_sync_stream(sync_iterable, priority: int = PRIORITY_INTERACTIVE,
+                           deadline: Optional[Deadline] = None, reserve: float = 0.0,
+                           slot_tag: Optional[str] = None):
+    """
+    在线程池中逐块拉取同步流（GenAI SDK 的 generate_content_stream 等）
+    
+    直接在 async 生成器里 for 循环同步流会阻塞事件循环，导致其他请求和 SSE 推送一起卡住。
+    迭代期间占用一个 LLM 并发槽位；消费方中途取消（客户端断开）时关闭上游流并归还槽位。
+    传入 deadline 时，每块的等待时间不超过剩余预算（扣除 reserve），超时抛出 asyncio.TimeoutError。
+    slot_tag 用于后台任务排队时按 tag 提升优先级（见 llm_scheduler.promote）。
+    """
+    iterator = iter(sync_iterable)
+    sentinel = object()
+    lock = threading.Lock()
+    exhausted = False
+    async with llm_scheduler.slot(priority, slot_tag):
+        try:
+            while True:
+                pull = asyncio.to_thread(_pull_sync_chunk, iterator, lock, sentinel)
+                chunk = await (deadline.run(pull, reserve=reserve) if deadline else pull)
+                if chunk is sentinel:
+                    exhausted = True
+                    break
+                yield chunk
+        finally:
+            if not exhausted:
+                asyncio.get_running_loop().run_in_executor(None, _close_sync_stream, iterator, lock)
+
+
+async def call_sync_llm(func, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+    """
+    在线程池中执行一次同步 LLM 调用（GenAI SDK 的 generate_content 等），期间占用一个 LLM 并发槽位
+    
+    线程开始后无法中止：调用方被取消（客户端断开、超出耗时预算）时立即返回，上游调用仍会跑完，
+    槽位保留到线程结束再归还，保证同时进行的上游调用数不超过 LLM_MAX_CONCURRENCY。
+    """
+    await llm_scheduler.acquire(priority)
+    try:
+        future = asyncio.get_running_loop().run_in_executor(None, lambda: func(*args, **kwargs))
+    except BaseException:
+        llm_scheduler.release()
+        raise
+    
+    def finished(done: asyncio.Future):
+        llm_scheduler.release()
+        if not done.cancelled():
+            done.exception()  # 调用方已取消时避免“异常未读取”的告警
+    
+    future.add_done_callback(finished)
+    return await asyncio.shield(future)
+
+
+# 各接口端到端耗时预算（秒），可通过 <NAME>_DEADLINE_SECONDS 环境变量覆盖
+REQUEST_DEADLINE_DEFAULTS = {
+    "fortune": 120,
+    "calculate": 20,
+    "kline": 45,
+    "kline_job": 180,
+    "kline_year": 20,
+    "lifeline": 30,
+    "chat": 90,
+    "chat_summary": 60,
+    "divination": 60
+}
+
+# 为兜底输出（默认数据、排盘文本、序列化）预留的秒数
+DEADLINE_FALLBACK_RESERVE = 2.0
+
+
+def request_deadline(name: str) -> Deadline:
+    """在接口入口创建请求截止时间"""
+    return Deadline.from_env(f"{name.upper()}_DEADLINE_SECONDS", REQUEST_DEADLINE_DEFAULTS[name])
+
+
+async def stream_fortune_analysis(request: FortuneRequest, deadline: Optional[Deadline] = None):
     """
     流式返回命理分析结果
     
     Args:
         request: 命理分析请求
+        deadline: 请求截止时间；预算耗尽时停止生成，仍返回已生成的正文和排盘数据
     
     Yields:
         流式文本数据
@@ -849,48 +997,68 @@ async def stream_fortune_analysis(request: FortuneRequest):
             gender=request.gender
         )
         
-        # 2. 构建系统提示词（传入 BaziReport）
-        system_prompt = build_system_prompt(
+        # 2. 构建系统提示词（传入 BaziReport）：静态部分可引用上游缓存，只发送用户相关部分
+        static_prompt = build_fortune_static_prompt()
+        facts_prompt = build_fortune_facts_prompt(
             bazi_report,
             request.name,
             request.gender,
             request.city
         )
+        question = f"请为 {request.name} 进行详细的命理分析。"
         
-        # 3. 构建完整提示词
-        full_prompt = f"{system_prompt}\n\n请为 {request.name} 进行详细的命理分析。"
-        
-        # 4. 调用 Compass API（流式）
-        stream = compass_client.models.generate_content_stream(
-            model="gemini-2.5-flash",  # 使用 Gemini 2.5 Flash 模型
-            contents=full_prompt
-        )
+        # 3. 调用 Compass API（流式）
+        stream = None
+        cache_name = cached_prompt_handle("fortune", static_prompt)
+        if cache_name:
+            try:
+                stream = compass_client.models.generate_content_stream(
+                    model="gemini-2.5-flash",
+                    contents=f"{facts_prompt}\n\n{question}",
+                    config={"cached_content": cache_name}
+                )
+            except Exception as e:
+                print(f"⚠️  使用提示词缓存失败，改为发送完整提示词: {e}", flush=True)
+                prompt_cache.invalidate("fortune")
+        if stream is None:
+            full_prompt = f"{static_prompt}\n\n{facts_prompt}\n\n{question}"
+            stream = compass_client.models.generate_content_stream(
+                model="gemini-2.5-flash",  # 使用 Gemini 2.5 Flash 模型
+                contents=full_prompt
+            )
         
         full_text = ""
         chart_data_found = False
         
-        # 5. 流式返回结果
-        for chunk in stream:
-            if hasattr(chunk, 'text') and chunk.text:
-                content = chunk.text
-                full_text += content
+        # 5. 流式返回结果（在线程中拉取，避免阻塞事件循环上的其他订阅者）
+        try:
+            async for chunk in iter_sync_stream(stream, deadline=deadline, reserve=DEADLINE_FALLBACK_RESERVE):
+                if hasattr(chunk, 'text') and chunk.text:
+                    content = chunk.text
+                    full_text += content
                 
-                # 检查是否包含图表数据
-                if not chart_data_found and "<<<CHART_DATA>>>" in full_text:
-                    chart_data = parse_chart_data(full_text)
-                    if chart_data:
-                        chart_data_found = True
-                        # 单独发送图表数据
-                        yield "data: " + json.dumps({
-                            "type": "chart_data",
-                            "data": chart_data
-                        }, ensure_ascii=False) + "\n\n"
+                    # 检查是否包含图表数据
+                    if not chart_data_found and "<<<CHART_DATA>>>" in full_text:
+                        chart_data = parse_chart_data(full_text)
+                        if chart_data:
+                            chart_data_found = True
+                            # 单独发送图表数据
+                            yield "data: " + json.dumps({
+                                "type": "chart_data",
+                                "data": chart_data
+                            }, ensure_ascii=False) + "\n\n"
                 
-                # 发送文本内容
-                yield "data: " + json.dumps({
-                    "type": "text",
-                    "content": content
-                }, ensure_ascii=False) + "\n\n"
+                    # 发送文本内容
+                    yield "data: " + json.dumps({
+                        "type": "text",
+                        "content": content
+                    }, ensure_ascii=False) + "\n\n"
+        except asyncio.TimeoutError:
+            print(f"⏰ 命理分析超出耗时预算，已生成 {len(full_text)} 字符，停止生成", flush=True)
+            yield "data: " + json.dumps({
+                "type": "text",
+                "content": "\n\n（分析生成超时，已停止，以下为排盘结果）"
+            }, ensure_ascii=False) + "\n\n"
         
         # 如果流式输出结束时仍未找到图表数据，尝试从完整文本中提取
         if not chart_data_found:
@@ -1016,10 +1184,7 @@ async def call_llm_for_structured_data(bazi_report: dict, name: str, gender: str
 出生地：{city}
 
 【排盘数据】
-日主：{day_master}（{day_wuxing}）
-四柱：{chart.get('si_zhu', {}).get('year', '')} {chart.get('si_zhu', {}).get('month', '')} {chart.get('si_zhu', {}).get('day', '')} {chart.get('si_zhu', {}).get('hour', '')}
-五行能量：木({wuxing_percentages.get('木', 0)}%), 火({wuxing_percentages.get('火', 0)}%), 土({wuxing_percentages.get('土', 0)}%), 金({wuxing_percentages.get('金', 0)}%), 水({wuxing_percentages.get('水', 0)}%)
-十神配置：{', '.join(ten_gods_list) if ten_gods_list else '无'}
+{chart_codec.encode(bazi_report)}
 
 【重要要求】
 1. **命理精华（summary）要求**：
@@ -1060,7 +1225,8 @@ async def call_llm_for_structured_data(bazi_report: dict, name: str, gender: str
             # Gemini API 支持 response_mime_type 参数来强制 JSON 格式
             try:
                 # 方法1：使用 config 参数（某些 SDK 版本）
-                response = compass_client.models.generate_content(
+                response = await asyncio.to_thread(
+                    compass_client.models.generate_content,
                     model="gemini-2.5-flash",  # 使用 Gemini 2.5 Flash 模型
                     contents=system_prompt,
                     config={
@@ -1071,7 +1237,8 @@ async def call_llm_for_structured_data(bazi_report: dict, name: str, gender: str
             except (TypeError, AttributeError) as e1:
                 # 方法2：直接使用 response_mime_type 参数（某些 SDK 版本）
                 try:
-                    response = compass_client.models.generate_content(
+                    response = await asyncio.to_thread(
+                        compass_client.models.generate_content,
                         model="gemini-2.5-flash",  # 使用 Gemini 2.5 Flash 模型
                         contents=system_prompt,
                         response_mime_type="application/json"
@@ -1080,7 +1247,8 @@ async def call_llm_for_structured_data(bazi_report: dict, name: str, gender: str
                 except (TypeError, AttributeError) as e2:
                     # 方法3：如果都不支持，使用默认方式，但会在 prompt 中强调 JSON 格式
                     print(f"⚠️  JSON 格式参数不支持，使用默认方式（已在 prompt 中强调 JSON，Gemini 2.5）", flush=True)
-                    response = compass_client.models.generate_content(
+                    response = await asyncio.to_thread(
+                        compass_client.models.generate_content,
                         model="gemini-2.5-flash",  # 使用 Gemini 2.5 Flash 模型
                         contents=system_prompt
                     )
@@ -1139,6 +1307,174 @@ async def call_llm_for_structured_data(bazi_report: dict, name: str, gender: str
         return {}
 
 
+def merge_llm_data_into_report(bazi_report: dict, llm_data: dict) -> dict:
+    """
+    将 LLM 结构化数据合并进 BaziReport
+    
+    优先使用 LLM 返回的数据，如果没有则使用后端计算的数据。
+    llm_data 为空字典时，即为纯后端兜底结果（流式接口首帧使用）。
+    
+    Args:
+        bazi_report: 后端计算的排盘数据（原地修改）
+        llm_data: call_llm_for_structured_data 的返回值
+    
+    Returns:
+        本次写入的字段（day_master_info, ten_gods, personality_tags, essence_text），用于流式 patch
+    """
+    # day_master 数据
+    if llm_data.get('day_master'):
+        bazi_report['day_master_info'] = llm_data['day_master']
+    else:
+        gods = bazi_report.get('gods', {})
+        day_master = bazi_report.get('day_master', gods.get('day_gan', ''))
+        day_wuxing = gods.get('day_wuxing', '')
+        if day_master and day_wuxing:
+            bazi_report['day_master_info'] = {
+                "name": day_master,
+                "element": day_wuxing
+            }
+    
+    # ten_gods 数据
+    if llm_data.get('ten_gods') and len(llm_data.get('ten_gods', [])) > 0:
+        bazi_report['ten_gods'] = llm_data['ten_gods']
+        print(f"✅ 使用 LLM 的 ten_gods: {llm_data['ten_gods']}", flush=True)
+    else:
+        # 从后端数据中提取十神
+        chart = bazi_report.get('chart', {})
+        ten_gods_list = []
+        if chart.get('shi_shen'):
+            shi_shen_dict = chart['shi_shen']
+            for key in ['year_shi_shen', 'month_shi_shen', 'hour_shi_shen']:
+                shi_shen = shi_shen_dict.get(key, '')
+                if shi_shen and shi_shen != '日主' and shi_shen not in ten_gods_list:
+                    ten_gods_list.append(shi_shen)
+        bazi_report['ten_gods'] = ten_gods_list
+        print(f"⚠️  使用后端计算的 ten_gods: {ten_gods_list}", flush=True)
+    
+    # personality_tags 数据
+    if llm_data.get('personality_tags') and len(llm_data.get('personality_tags', [])) > 0:
+        bazi_report['personality_tags'] = llm_data['personality_tags']
+        # 同时更新 gods 中的 personality_tags（向后兼容）
+        if 'gods' in bazi_report:
+            bazi_report['gods']['personality_tags'] = llm_data['personality_tags']
+        print(f"✅ 使用 LLM 的 personality_tags: {llm_data['personality_tags']}", flush=True)
+    else:
+        # 使用后端计算的 personality_tags
+        gods = bazi_report.get('gods', {})
+        personality_tags = gods.get('personality_tags', [])
+        bazi_report['personality_tags'] = personality_tags
+        print(f"⚠️  使用后端计算的 personality_tags: {personality_tags}", flush=True)
+    
+    # summary 数据（命理精华）
+    if llm_data.get('summary') and len(llm_data.get('summary', '')) > 10:
+        bazi_report['essence_text'] = llm_data['summary']
+        print(f"✅ 使用 LLM 的 summary: {llm_data['summary'][:50]}...", flush=True)
+    else:
+        # 使用后端生成的 essence_text
+        gods = bazi_report.get('gods', {})
+        day_master = bazi_report.get('day_master', gods.get('day_gan', ''))
+        day_wuxing = gods.get('day_wuxing', '')
+        strength_status = gods.get('strength_status', '')
+        pattern_name = gods.get('pattern_name', '')
+        personality_tags = gods.get('personality_tags', [])
+        
+        essence_parts = []
+        if day_master and day_wuxing:
+            essence_parts.append(f"日主{day_master}，五行属{day_wuxing}")
+        if strength_status:
+            essence_parts.append(f"日主{strength_status}")
+        if pattern_name:
+            essence_parts.append(f"格局为{pattern_name}")
+        if personality_tags:
+            tags_desc = '、'.join(personality_tags[:3])
+            essence_parts.append(f"性格{tags_desc}")
+        
+        essence_text = '，'.join(essence_parts) + '。' if essence_parts else ''
+        bazi_report['essence_text'] = essence_text
+    
+    # five_elements 数据（如果 LLM 返回了，可以用于验证，但优先使用后端计算的）
+    # 后端计算的 five_elements 已经包含在 bazi_report 中，不需要覆盖
+    
+    return {
+        "day_master_info": bazi_report.get('day_master_info'),
+        "ten_gods": bazi_report['ten_gods'],
+        "personality_tags": bazi_report['personality_tags'],
+        "essence_text": bazi_report['essence_text']
+    }
+
+
+def auto_save_fortune_book(request: FortuneRequest, bazi_report: dict, llm_data: dict) -> Optional[int]:
+    """
+    /api/calculate 的自动保存逻辑
+    
+    保存失败不影响返回结果，只记录日志。
+    
+    Returns:
+        保存成功返回 book_id，否则返回 None
+    """
+    saved_book_id = None
+    try:
+        # 使用依赖注入获取数据库会话
+        db_gen = get_db()
+        db = next(db_gen)
+        try:
+            # 从 JWT token 或环境变量获取用户ID
+            # 注意：这里需要传入 authorization header，但 calculate_bazi 接口没有接收
+            # 为了保持向后兼容，暂时使用环境变量或默认值
+            current_user_id = get_current_user_id(user_id=None)
+            
+            # 构建完整的summary（包含bazi_report和llm_data）
+            summary_data = {
+                "bazi_report": bazi_report,
+                "llm_data": llm_data,
+                "generated_at": datetime.utcnow().isoformat()
+            }
+            
+            # 创建命书记录
+            fortune_book = FortuneBook(
+                user_id=current_user_id,
+                name=request.book_name,
+                person_name=request.name,
+                birth_date=request.birth_date,
+                birth_time=request.birth_time,
+                gender=request.gender,
+                lat=request.lat,
+                lng=request.lng,
+                city=request.city,
+                summary=json.dumps(summary_data, ensure_ascii=False)  # 存储大模型生成的JSON内容全文
+            )
+            
+            # 持久化到数据库
+            db.add(fortune_book)
+            db.commit()
+            db.refresh(fortune_book)
+            saved_book_id = fortune_book.id
+            print(f"✅ 自动保存命书成功，ID: {saved_book_id}", flush=True)
+        except Exception as save_error:
+            db.rollback()
+            print(f"⚠️  自动保存命书失败: {save_error}", flush=True)
+            # 保存失败不影响返回结果，只记录日志
+        finally:
+            # 关闭数据库会话
+            try:
+                next(db_gen, None)
+            except StopIteration:
+                pass
+    except Exception as db_error:
+        print(f"⚠️  获取数据库会话失败: {db_error}", flush=True)
+        # 数据库连接失败不影响返回结果
+    return saved_book_id
+
+
+def validate_auto_save(request: FortuneRequest):
+    """auto_save=True 时必须提供 book_name"""
+    if request.auto_save and not request.book_name:
+        raise HTTPException(
+            status_code=400,
+            detail="当 auto_save=True 时，必须提供 book_name（命书名）"
+        )
+
+
 @app.post("/api/calculate")
 async def calculate_bazi(request: FortuneRequest):
     """
@@ -1148,8 +1484,13 @@ async def calculate_bazi(request: FortuneRequest):
     1. 后端计算排盘数据（硬核判定）
     2. 调用 LLM 获取结构化的命理分析数据
     3. 合并数据返回给前端
+    
+    需要首屏更快时请使用 POST /api/calculate/stream（先推送排盘，再推送 LLM 补丁）
     """
+    deadline = request_deadline("calculate")
     try:
+        validate_auto_save(request)
+        
         # 1. 生成完整的 BaziReport（后端硬核判定）
         bazi_report = calculator.generate_bazi_report(
             birth_date=request.birth_date,
@@ -1159,152 +1500,28 @@ async def calculate_bazi(request: FortuneRequest):
             gender=request.gender
         )
         
-        # 2. 调用 LLM 获取结构化的命理分析数据
-        llm_data = await call_llm_for_structured_data(
-            bazi_report,
-            request.name,
-            request.gender,
-            request.city,
-            request.birth_date,
-            request.birth_time
-        )
+        # 2. 调用 LLM 获取结构化的命理分析数据（超出预算时使用后端兜底数据）
+        try:
+            llm_data = await deadline.run(call_llm_for_structured_data(
+                bazi_report,
+                request.name,
+                request.gender,
+                request.city,
+                request.birth_date,
+                request.birth_time
+            ), reserve=DEADLINE_FALLBACK_RESERVE)
+        except asyncio.TimeoutError:
+            print("⏰ LLM 结构化数据超出耗时预算，使用后端兜底数据", flush=True)
+            llm_data = {}
         
         # 3. 合并 LLM 数据和后端数据
-        # 优先使用 LLM 返回的数据，如果没有则使用后端计算的数据
-        
-        # day_master 数据
-        if llm_data.get('day_master'):
-            bazi_report['day_master_info'] = llm_data['day_master']
-        else:
-            gods = bazi_report.get('gods', {})
-            day_master = bazi_report.get('day_master', gods.get('day_gan', ''))
-            day_wuxing = gods.get('day_wuxing', '')
-            if day_master and day_wuxing:
-                bazi_report['day_master_info'] = {
-                    "name": day_master,
-                    "element": day_wuxing
-                }
-        
-        # ten_gods 数据
-        if llm_data.get('ten_gods') and len(llm_data.get('ten_gods', [])) > 0:
-            bazi_report['ten_gods'] = llm_data['ten_gods']
-            print(f"✅ 使用 LLM 的 ten_gods: {llm_data['ten_gods']}", flush=True)
-        else:
-            # 从后端数据中提取十神
-            chart = bazi_report.get('chart', {})
-            ten_gods_list = []
-            if chart.get('shi_shen'):
-                shi_shen_dict = chart['shi_shen']
-                for key in ['year_shi_shen', 'month_shi_shen', 'hour_shi_shen']:
-                    shi_shen = shi_shen_dict.get(key, '')
-                    if shi_shen and shi_shen != '日主' and shi_shen not in ten_gods_list:
-                        ten_gods_list.append(shi_shen)
-            bazi_report['ten_gods'] = ten_gods_list
-            print(f"⚠️  使用后端计算的 ten_gods: {ten_gods_list}", flush=True)
-        
-        # personality_tags 数据
-        if llm_data.get('personality_tags') and len(llm_data.get('personality_tags', [])) > 0:
-            bazi_report['personality_tags'] = llm_data['personality_tags']
-            # 同时更新 gods 中的 personality_tags（向后兼容）
-            if 'gods' in bazi_report:
-                bazi_report['gods']['personality_tags'] = llm_data['personality_tags']
-            print(f"✅ 使用 LLM 的 personality_tags: {llm_data['personality_tags']}", flush=True)
-        else:
-            # 使用后端计算的 personality_tags
-            gods = bazi_report.get('gods', {})
-            personality_tags = gods.get('personality_tags', [])
-            bazi_report['personality_tags'] = personality_tags
-            print(f"⚠️  使用后端计算的 personality_tags: {personality_tags}", flush=True)
-        
-        # summary 数据（命理精华）
-        if llm_data.get('summary') and len(llm_data.get('summary', '')) > 10:
-            bazi_report['essence_text'] = llm_data['summary']
-            print(f"✅ 使用 LLM 的 summary: {llm_data['summary'][:50]}...", flush=True)
-        else:
-            # 使用后端生成的 essence_text
-            gods = bazi_report.get('gods', {})
-            day_master = bazi_report.get('day_master', gods.get('day_gan', ''))
-            day_wuxing = gods.get('day_wuxing', '')
-            strength_status = gods.get('strength_status', '')
-            pattern_name = gods.get('pattern_name', '')
-            personality_tags = gods.get('personality_tags', [])
-            
-            essence_parts = []
-            if day_master and day_wuxing:
-                essence_parts.append(f"日主{day_master}，五行属{day_wuxing}")
-            if strength_status:
-                essence_parts.append(f"日主{strength_status}")
-            if pattern_name:
-                essence_parts.append(f"格局为{pattern_name}")
-            if personality_tags:
-                tags_desc = '、'.join(personality_tags[:3])
-                essence_parts.append(f"性格{tags_desc}")
-            
-            essence_text = '，'.join(essence_parts) + '。' if essence_parts else ''
-            bazi_report['essence_text'] = essence_text
-        
-        # five_elements 数据（如果 LLM 返回了，可以用于验证，但优先使用后端计算的）
-        # 后端计算的 five_elements 已经包含在 bazi_report 中，不需要覆盖
+        merge_llm_data_into_report(bazi_report, llm_data)
         
         # 4. 如果启用了自动保存，将结果保存到数据库
         saved_book_id = None
         if request.auto_save:
-            if not request.book_name:
-                raise HTTPException(
-                    status_code=400,
-                    detail="当 auto_save=True 时，必须提供 book_name（命书名）"
-                )
-            
-            try:
-                # 使用依赖注入获取数据库会话
-                db_gen = get_db()
-                db = next(db_gen)
-                try:
-                    # 从 JWT token 或环境变量获取用户ID
-                    # 注意：这里需要传入 authorization header，但 calculate_bazi 接口没有接收
-                    # 为了保持向后兼容，暂时使用环境变量或默认值
-                    current_user_id = get_current_user_id(user_id=None)
-                    
-                    # 构建完整的summary（包含bazi_report和llm_data）
-                    summary_data = {
-                        "bazi_report": bazi_report,
-                        "llm_data": llm_data,
-                        "generated_at": datetime.utcnow().isoformat()
-                    }
-                    
-                    # 创建命书记录
-                    fortune_book = FortuneBook(
-                        user_id=current_user_id,
-                        name=request.book_name,
-                        person_name=request.name,
-                        birth_date=request.birth_date,
-                        birth_time=request.birth_time,
-                        gender=request.gender,
-                        lat=request.lat,
-                        lng=request.lng,
-                        city=request.city,
-                        summary=json.dumps(summary_data, ensure_ascii=False)  # 存储大模型生成的JSON内容全文
-                    )
-                    
-                    # 持久化到数据库
-                    db.add(fortune_book)
-                    db.commit()
-                    db.refresh(fortune_book)
-                    saved_book_id = fortune_book.id
-                    print(f"✅ 自动保存命书成功，ID: {saved_book_id}", flush=True)
-                except Exception as save_error:
-                    db.rollback()
-                    print(f"⚠️  自动保存命书失败: {save_error}", flush=True)
-                    # 保存失败不影响返回结果，只记录日志
-                finally:
-                    # 关闭数据库会话
-                    try:
-                        next(db_gen, None)
-                    except StopIteration:
-                        pass
-            except Exception as db_error:
-                print(f"⚠️  获取数据库会话失败: {db_error}", flush=True)
-                # 数据库连接失败不影响返回结果
+            saved_book_id = auto_save_fortune_book(request, bazi_report, llm_data)
+            schedule_kline_precompute(saved_book_id)
         
         return {
             "success": True,
@@ -1317,15 +1534,95 @@ async def calculate_bazi(request: FortuneRequest):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.post("/api/fortune")
-async def fortune_analysis(request: FortuneRequest):
+async def stream_calculate(request: FortuneRequest, bazi_report: dict, deadline: Optional[Deadline] = None):
     """
-    命理分析接口
+    渐进式排盘结果（SSE）
+    
+    事件顺序：
+    1. bazi_report：完整的后端排盘（已用后端数据填充 ten_gods / personality_tags / essence_text 兜底值）
+    2. patch：LLM 返回后覆盖的字段（day_master_info, ten_gods, personality_tags, essence_text）
+    3. saved：自动保存结果（saved_book_id，未开启 auto_save 时为 null）
+    4. [DONE]
+    
+    Args:
+        request: 排盘请求
+        bazi_report: 已计算好的 BaziReport
+        deadline: 请求截止时间；预算耗尽时不再等待 LLM，保留首帧的兜底数据
+    
+    Yields:
+        SSE 数据帧
+    """
+    # 1. 首帧：确定性排盘（毫秒级），前端可立即渲染命盘
+    merge_llm_data_into_report(bazi_report, {})
+    yield "data: " + json.dumps({
+        "type": "bazi_report",
+        "data": bazi_report
+    }, ensure_ascii=False) + "\n\n"
+    
+    # 2. LLM 动态推理，返回后以补丁形式推送
+    llm_data = {}
+    deadline = deadline or request_deadline("calculate")
+    try:
+        llm_data = await deadline.run(call_llm_for_structured_data(
+            bazi_report,
+            request.name,
+            request.gender,
+            request.city,
+            request.birth_date,
+            request.birth_time
+        ), reserve=DEADLINE_FALLBACK_RESERVE)
+    except asyncio.TimeoutError:
+        print("⏰ LLM 结构化数据超出耗时预算，保留后端兜底数据", flush=True)
+    except Exception as e:
+        print(f"⚠️  LLM 结构化数据获取失败，保留后端兜底数据: {e}", flush=True)
+    
+    if llm_data:
+        patch = merge_llm_data_into_report(bazi_report, llm_data)
+        yield "data: " + json.dumps({
+            "type": "patch",
+            "data": patch
+        }, ensure_ascii=False) + "\n\n"
+    
+    # 3. 自动保存（保存的是合并后的完整数据）
+    saved_book_id = None
+    if request.auto_save:
+        saved_book_id = await asyncio.to_thread(auto_save_fortune_book, request, bazi_report, llm_data)
+        schedule_kline_precompute(saved_book_id)
+    yield "data: " + json.dumps({
+        "type": "saved",
+        "saved_book_id": saved_book_id
+    }, ensure_ascii=False) + "\n\n"
+    
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/api/calculate/stream")
+async def calculate_bazi_stream(request: FortuneRequest):
+    """
+    八字排盘计算接口（渐进式 SSE 版本）
     
-    接收用户信息，返回流式命理分析结果
+    与 /api/calculate 返回相同的数据，但先推送确定性排盘，再推送 LLM 补丁和保存结果，
+    Result 页面无需等待 LLM 即可渲染命盘。
     """
+    deadline = request_deadline("calculate")
+    try:
+        validate_auto_save(request)
+        
+        # 排盘参数错误在建立流之前返回 400
+        bazi_report = calculator.generate_bazi_report(
+            birth_date=request.birth_date,
+            birth_time=request.birth_time,
+            lng=request.lng,
+            lat=request.lat,
+            gender=request.gender
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
     return StreamingResponse(
-        stream_fortune_analysis(request),
+        stream_calculate(request, bazi_report, deadline),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -1335,17 +1632,114 @@ async def fortune_analysis(request: FortuneRequest):
     )
 
 
-@app.get("/")
-async def root():
-    """根路径"""
-    return {
-        "message": "命理分析 API",
-        "version": "1.0.0",
-        "endpoints": {
-            "POST /api/calculate": "八字排盘计算接口",
+STREAM_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+# 各类流式生成的预计输出 token 数（客户端断开中止生成时，用于估算节省量）
+STREAM_EXPECTED_TOKENS = {
+    "fortune": 4000,
+    "kline": 2000,
+    "chat": 1500
+}
+
+
+def validate_stream_id(stream_id: Optional[str]):
+    """校验客户端指定的流 ID"""
+    if stream_id and not STREAM_ID_PATTERN.match(stream_id):
+        raise HTTPException(status_code=400, detail="stream_id 只能包含字母、数字、- 和 _，长度 8-64")
+
+
+def resumable_stream_response(session: StreamSession, last_event_id: Optional[str] = None) -> StreamingResponse:
+    """
+    订阅一次流式生成
+
+    Args:
+        session: stream_hub 中的流
+        last_event_id: 客户端已收到的最后一个事件编号（断线重连时由浏览器自动携带）
+    """
+    return StreamingResponse(
+        session.subscribe(parse_last_event_id(last_event_id)),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+            "X-Stream-Id": session.stream_id
+        }
+    )
+
+
+def resume_owned_stream(session: StreamSession, authorization: Optional[str] = None, user_id: Optional[str] = None,
+                        last_event_id: Optional[str] = None) -> StreamingResponse:
+    """续传已有的流（流记录了所属用户时才鉴权，只允许该用户续传；匿名流任何人可凭 stream_id 续传）"""
+    if not session.owner:
+        return resumable_stream_response(session, last_event_id)
+    owner = get_current_user_id(authorization=authorization, user_id=user_id)
+    if session.owner != owner:
+        print(f"❌ 权限拒绝：用户 {owner} 尝试续传用户 {session.owner} 的流 {session.stream_id}", flush=True)
+        raise HTTPException(status_code=403, detail="无权访问：该流不属于当前用户")
+    return resumable_stream_response(session, last_event_id)
+
+
+@app.post("/api/fortune")
+async def fortune_analysis(
+    request: FortuneRequest,
+    stream_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None)
+):
+    """
+    命理分析接口
+    
+    接收用户信息，返回流式命理分析结果。
+    携带已有的 stream_id 时不再重新生成，直接从 Last-Event-ID 之后续传。
+    """
+    validate_stream_id(stream_id)
+    session = stream_hub.get(stream_id)
+    if session:
+        return resumable_stream_response(session, last_event_id)
+    
+    deadline = request_deadline("fortune")
+    return resumable_stream_response(stream_hub.start(
+        stream_fortune_analysis(request, deadline), stream_id, STREAM_EXPECTED_TOKENS["fortune"]
+    ))
+
+
+@app.get("/api/streams/{stream_id}")
+async def resume_stream(
+    stream_id: str,
+    last_event_id: Optional[str] = Header(None),
+    authorization: Optional[str] = Header(None),
+    user_id: Optional[str] = None
+):
+    """
+    断线重连接口
+
+    补发 Last-Event-ID 之后的事件，然后继续接收实时事件；
+    流结束后在 SSE_REPLAY_TTL_SECONDS 内仍可回放。
+    K 线、起卦对话等与用户绑定的流只允许发起者续传。
+    """
+    session = stream_hub.get(stream_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="流不存在或已过期")
+    return resume_owned_stream(session, authorization, user_id, last_event_id)
+
+
+@app.get("/")
+async def root():
+    """根路径"""
+    return {
+        "message": "命理分析 API",
+        "version": "1.0.0",
+        "endpoints": {
+            "POST /api/calculate": "八字排盘计算接口",
+            "POST /api/calculate/stream": "八字排盘计算接口（渐进式 SSE）",
             "POST /api/fortune": "命理分析接口",
+            "GET /api/streams/{stream_id}": "流式接口断线重连（Last-Event-ID 续传）",
             "GET /api/user/fortune-books": "获取用户命书列表",
-            "POST /api/generate-kline": "生成人生K线数据"
+            "POST /api/generate-kline": "生成人生K线数据（mode=job 为后台任务模式）",
+            "GET /api/kline/{book_id}": "读取命书已保存的K线",
+            "GET /api/kline/{book_id}/years/{age}": "K线单年详情（流年作用关系 + 按需生成的解读）",
+            "GET /api/kline-jobs/{job_id}": "查询K线后台任务",
+            "GET /api/kline-jobs/{job_id}/events": "订阅K线后台任务（SSE）"
         }
     }
 
@@ -1520,7 +1914,8 @@ async def delete_fortune_book(
         
         print(f"✅ 权限验证通过：用户 {current_user_id} 删除自己的命书", flush=True)
         
-        # 删除命书
+        # 删除命书（连同保存的 K 线曲线，避免 ID 复用后串数据）
+        db.query(KLineCurve).filter(KLineCurve.book_id == book_id).delete()
         db.delete(fortune_book)
         db.commit()
         
@@ -1592,6 +1987,9 @@ async def save_fortune_book(
         print(f"✅ 命书保存成功，ID: {saved_id}", flush=True)
         print(f"📋 保存的 new_id (用于前端跳转): {saved_id}", flush=True)  # 打印 new_id 用于调试
         
+        # 保存后大多数用户会打开 K 线页：后台预生成
+        schedule_kline_precompute(saved_id)
+        
         # 返回保存的记录ID（字段名必须与前端 CreateForm.jsx 接收的字段名一致）
         # 前端期望: { "id": "生成的ID", "status": "success" }
         return {
@@ -1614,146 +2012,450 @@ async def save_fortune_book(
         raise HTTPException(status_code=500, detail=f"保存命书失败: {str(e)}")
 
 
-@app.post("/api/generate-kline")
-async def generate_kline(
+def calculate_liu_nian_gan_zhi(birth_year: int, years: int = 101) -> List[str]:
+    """
+    计算从出生年起每年的流年干支（默认 0-100 岁，共 101 年）
+    
+    流年干支取该年 1 月 1 日对应的农历年干支，与 LifeLineService 的时间轴保持一致。
+    该计算只依赖出生年份，可与 BaziReport 并行执行。
+    
+    Args:
+        birth_year: 出生年份
+        years: 年数
+    
+    Returns:
+        流年干支列表，下标即年龄
+    """
+    from lunar_python import Solar
+    liu_nian_list = []
+    for age in range(years):
+        lunar = Solar.fromYmd(birth_year + age, 1, 1).getLunar()
+        liu_nian_list.append(lunar.getYearGan() + lunar.getYearZhi())
+    return liu_nian_list
+
+
+def build_kline_timeline(birth_year: int, liu_nian_list: List[str], da_yun: List[Dict]) -> List[Dict]:
+    """
+    将流年干支与大运合并为 K 线时间轴
+    
+    Args:
+        birth_year: 出生年份
+        liu_nian_list: calculate_liu_nian_gan_zhi 的结果
+        da_yun: BaziReport 中的大运列表
+    
+    Returns:
+        时间轴列表，每个元素包含 age, year, gan_zhi, da_yun
+    """
+    timeline_data = []
+    for age, liu_nian_gan_zhi in enumerate(liu_nian_list):
+        # 找到对应的大运
+        current_dayun = ''
+        for dy in da_yun:
+            age_start = dy.get('age_start', 0)
+            age_end = dy.get('age_end', 100)
+            if age_start <= age < age_end:
+                current_dayun = dy.get('gan_zhi', '')
+                break
+        
+        timeline_data.append({
+            'age': age,
+            'year': birth_year + age,
+            'gan_zhi': liu_nian_gan_zhi,
+            'da_yun': current_dayun
+        })
+    return timeline_data
+
+
+def build_kline_points(timeline_data: List[Dict], scores: List[int], peaks: List[Dict], valleys: List[Dict]) -> List[Dict]:
+    """
+    合成 0-100 岁的 K 线数据点（与当前时间无关，可持久化）
+    
+    Args:
+        timeline_data: build_kline_timeline 生成的时间轴
+        scores: 101 个分数
+        peaks: 高峰列表
+        valleys: 低谷列表
+    """
+    # 生成年份数组和详细信息（0-100岁，共101年）
+    chart_points = []
+    for i, timeline_point in enumerate(timeline_data):
+        age = timeline_point['age']
+        year = timeline_point['year']
+        gan_zhi = timeline_point['gan_zhi']
+        da_yun = timeline_point['da_yun']
+        score = scores[i] if i < len(scores) else 60
+        
+        # 检查是否是高峰或低谷
+        is_peak = any(p.get('age') == age for p in peaks)
+        is_valley = any(v.get('age') == age for v in valleys)
+        
+        chart_points.append({
+            "age": age,
+            "year": year,
+            "gan_zhi": gan_zhi,
+            "da_yun": da_yun,
+            "score": score,
+            "is_peak": is_peak,
+            "is_valley": is_valley
+        })
+    
+    return chart_points
+
+
+def apply_kline_window(chart_data: Dict, from_age: Optional[int] = None, to_age: Optional[int] = None) -> Dict:
+    """
+    只保留 [from_age, to_age] 区间的数据点，并附带该区间的统计摘要 window
+    
+    其余字段（当前运势、5年趋势、人生阶段等）仍基于整条曲线。
+    """
+    start, end = resolve_window(from_age, to_age)
+    points = [point for point in chart_data['points'] if start <= point['age'] <= end]
+    chart_data['points'] = points
+    chart_data['window'] = summarize_window(
+        ((point['age'], point['score']) for point in points),
+        start, end, chart_data['peaks'], chart_data['valleys']
+    )
+    return chart_data
+
+
+def encode_kline_chart_data(chart_data: Dict, payload_format: Optional[str] = None) -> Dict:
+    """format=columnar 时将 points 改为列式编码（其余字段不变）"""
+    if payload_format == "columnar":
+        chart_data['points'] = to_columnar(chart_data['points'])
+    return chart_data
+
+
+def derive_kline_chart_data(chart_points: List[Dict], peaks: List[Dict], valleys: List[Dict], birth_year: int,
+                            from_age: Optional[int] = None, to_age: Optional[int] = None,
+                            bazi_report: Optional[Dict] = None) -> Dict:
+    """
+    由 K 线数据点计算随时间变化的字段，组装前端使用的 chart_data
+    
+    当前年龄、当前运势、5年趋势、下个高峰/低谷、人生阶段中的当前阶段、当前年份详情
+    都取决于读取时的年份，因此不持久化，每次读取时重新计算。
+    
+    Args:
+        chart_points: build_kline_points 生成的 101 个数据点
+        peaks: 高峰列表
+        valleys: 低谷列表
+        birth_year: 出生年份
+        from_age / to_age: 返回的 points 只取该年龄区间（默认 0-100）
+        bazi_report: 排盘数据（当前年份详情按流年与原局的作用关系给出规则解读）
+    """
+    scores = [point['score'] for point in chart_points]
+    current_age = datetime.now().year - birth_year
+    
+    # 计算当前运势信息
+    current_score = scores[current_age] if current_age < len(scores) else 60
+    current_label = "吉" if current_score >= 70 else ("平" if current_score >= 50 else "凶")
+    
+    # 计算5年趋势（未来5年的平均分 vs 过去5年的平均分）
+    future_ages = [current_age + i for i in range(1, 6) if current_age + i < 101]
+    past_ages = [current_age - i for i in range(1, 6) if current_age - i >= 0]
+    
+    future_avg = sum(scores[age] for age in future_ages) / len(future_ages) if future_ages else current_score
+    past_avg = sum(scores[age] for age in past_ages) / len(past_ages) if past_ages else current_score
+    trend_value = future_avg - past_avg
+    trend_direction = "上升" if trend_value > 5 else ("下降" if trend_value < -5 else "平稳")
+    
+    # 找到下一个高峰和下一个低谷
+    next_peak = None
+    next_valley = None
+    for peak in sorted(peaks, key=lambda x: x.get('age', 0)):
+        if peak.get('age', 0) > current_age:
+            next_peak = peak
+            break
+    for valley in sorted(valleys, key=lambda x: x.get('age', 0)):
+        if valley.get('age', 0) > current_age:
+            next_valley = valley
+            break
+    
+    # 计算人生阶段分析
+    stages = [
+        {"name": "童年", "age_range": (0, 12), "scores": scores[0:13]},
+        {"name": "青年", "age_range": (13, 30), "scores": scores[13:31]},
+        {"name": "壮年", "age_range": (31, 50), "scores": scores[31:51]},
+        {"name": "中年", "age_range": (51, 65), "scores": scores[51:66]},
+        {"name": "老年", "age_range": (66, 100), "scores": scores[66:101]}
+    ]
+    
+    stage_analysis = []
+    for stage in stages:
+        stage_scores = stage["scores"]
+        if stage_scores:
+            avg_score = sum(stage_scores) / len(stage_scores)
+            stage_analysis.append({
+                "name": stage["name"],
+                "age_range": f"{stage['age_range'][0]}-{stage['age_range'][1]}岁",
+                "avg_score": round(avg_score, 1),
+                "is_current": stage["age_range"][0] <= current_age <= stage["age_range"][1]
+            })
+    
+    # 当前年份详情：流年作用关系的规则解读（模型解读见 GET /api/kline/{book_id}/years/{age}）
+    current_year_detail = None
+    if 0 <= current_age < len(chart_points):
+        facts = year_facts_from_points(chart_points, peaks, valleys, bazi_report, current_age)
+        current_year_detail = {
+            **{key: facts[key] for key in ('age', 'year', 'gan_zhi', 'da_yun', 'score', 'label')},
+            **rule_based_year_narrative(facts)
+        }
+    
+    # 构建返回数据
+    chart_data = {
+        "points": chart_points,  # 101个数据点，包含详细信息
+        "peaks": peaks,  # 高峰列表
+        "valleys": valleys,  # 低谷列表
+        "current_age": current_age,  # 当前年龄
+        "current_fortune": {  # 当前运势信息
+            "score": current_score,
+            "label": current_label
+        },
+        "trend_5years": {  # 5年趋势
+            "direction": trend_direction,
+            "value": round(trend_value, 1),
+            "description": f"{trend_direction}" + (f"（{abs(round(trend_value, 1))}分）" if abs(trend_value) > 5 else "")
+        },
+        "next_peak": {  # 下个高峰
+            "age": next_peak.get('age') if next_peak else None,
+            "years_left": next_peak.get('age') - current_age if next_peak else None,
+            "score": next_peak.get('score') if next_peak else None,
+            "reason": next_peak.get('reason') if next_peak else None
+        } if next_peak else None,
+        "next_valley": {  # 需注意时期
+            "age": next_valley.get('age') if next_valley else None,
+            "years_left": next_valley.get('age') - current_age if next_valley else None,
+            "score": next_valley.get('score') if next_valley else None,
+            "reason": next_valley.get('reason') if next_valley else None
+        } if next_valley else None,
+        "stage_analysis": stage_analysis,  # 人生阶段分析
+        "current_year_detail": current_year_detail  # 当前年份详细信息
+    }
+    
+    return apply_kline_window(chart_data, from_age, to_age)
+
+
+def save_kline_curve(book_id: int, birth_year: int, chart_points: List[Dict], peaks: List[Dict],
+                     valleys: List[Dict], analysis_text: str, bazi_report: dict,
+                     chart_key: Optional[str] = None):
+    """保存（或覆盖）命书的 K 线曲线；失败只记录日志，不影响本次返回"""
+    db = SessionLocal()
+    try:
+        curve = db.query(KLineCurve).filter(KLineCurve.book_id == book_id).first()
+        if not curve:
+            curve = KLineCurve(book_id=book_id)
+            db.add(curve)
+        elif chart_key:
+            # 重新生成后分数可能变化，已缓存的流年解读作废
+            db.query(KLineYearDetail).filter(KLineYearDetail.chart_key == chart_key).delete()
+        curve.birth_year = birth_year
+        curve.chart_key = chart_key
+        curve.points = json.dumps(chart_points, ensure_ascii=False)
+        curve.peaks = json.dumps(peaks, ensure_ascii=False)
+        curve.valleys = json.dumps(valleys, ensure_ascii=False)
+        curve.analysis_text = analysis_text
+        curve.bazi_report = json.dumps(bazi_report, ensure_ascii=False)
+        curve.updated_at = datetime.utcnow()
+        db.commit()
+        print(f"💾 命书 {book_id} 的 K 线曲线已保存", flush=True)
+    except Exception as e:
+        db.rollback()
+        print(f"⚠️  保存 K 线曲线失败: {e}", flush=True)
+    finally:
+        db.close()
+
+
+def kline_curve_to_result(curve: KLineCurve, from_age: Optional[int] = None, to_age: Optional[int] = None) -> dict:
+    """由持久化的曲线组装与 complete 事件相同结构的结果（随时间变化的字段此时计算，points 按年龄窗口截取）"""
+    peaks = json.loads(curve.peaks)
+    valleys = json.loads(curve.valleys)
+    return {
+        "chart_data": derive_kline_chart_data(
+            json.loads(curve.points), peaks, valleys, curve.birth_year, from_age, to_age,
+            json.loads(curve.bazi_report) if curve.bazi_report else None
+        ),
+        "analysis_text": curve.analysis_text,
+        "bazi_report": json.loads(curve.bazi_report) if curve.bazi_report else None
+    }
+
+
+def load_kline_curve(book_id: int, from_age: Optional[int] = None, to_age: Optional[int] = None) -> Optional[dict]:
+    """读取命书的 K 线曲线（不存在时返回 None）"""
+    db = SessionLocal()
+    try:
+        curve = db.query(KLineCurve).filter(KLineCurve.book_id == book_id).first()
+        return kline_curve_to_result(curve, from_age, to_age) if curve else None
+    finally:
+        db.close()
+
+
+def kline_chart_key(birth_info: dict) -> str:
+    """出生信息指纹：排盘只依赖这些字段，指纹相同的命书 K 线曲线相同"""
+    raw = "|".join([
+        str(birth_info['birth_date']),
+        str(birth_info['birth_time']),
+        str(birth_info['gender']),
+        f"{float(birth_info['lng']):.4f}",
+        f"{float(birth_info['lat']):.4f}"
+    ])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def copy_kline_curve_by_chart_key(book_id: int, chart_key: str) -> bool:
+    """命盘相同的其他命书已有曲线时复制一份给当前命书，返回是否复制成功"""
+    db = SessionLocal()
+    try:
+        source = db.query(KLineCurve).filter(
+            KLineCurve.chart_key == chart_key,
+            KLineCurve.book_id != book_id
+        ).order_by(KLineCurve.updated_at.desc()).first()
+        if not source:
+            return False
+        curve = db.query(KLineCurve).filter(KLineCurve.book_id == book_id).first()
+        if not curve:
+            curve = KLineCurve(book_id=book_id)
+            db.add(curve)
+        for field in ('chart_key', 'birth_year', 'points', 'peaks', 'valleys', 'analysis_text', 'bazi_report'):
+            setattr(curve, field, getattr(source, field))
+        curve.updated_at = datetime.utcnow()
+        db.commit()
+        print(f"💾 命书 {book_id} 复用命书 {source.book_id} 的 K 线曲线", flush=True)
+        return True
+    except Exception as e:
+        db.rollback()
+        print(f"⚠️  复制 K 线曲线失败: {e}", flush=True)
+        return False
+    finally:
+        db.close()
+
+
+async def stream_stored_kline(result: dict):
+    """以与实时生成相同的事件序列推送已保存的 K 线"""
+    yield f"data: {json.dumps({'type': 'progress', 'progress': 100}, ensure_ascii=False)}\n\n"
+    if result.get('analysis_text'):
+        yield f"data: {json.dumps({'type': 'analysis', 'content': result['analysis_text']}, ensure_ascii=False)}\n\n"
+    yield f"data: {json.dumps({'type': 'chart_data', 'data': result['chart_data']}, ensure_ascii=False)}\n\n"
+    yield f"data: {json.dumps({'type': 'complete', 'data': result}, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def book_birth_info(book: FortuneBook) -> dict:
+    """命书记录 → K 线生成所需的出生信息"""
+    return {
+        "name": book.person_name,
+        "gender": book.gender,
+        "birth_date": book.birth_date,
+        "birth_time": book.birth_time,
+        "lat": book.lat,
+        "lng": book.lng,
+        "city": book.city,
+        "book_id": book.id,
+        "user_id": book.user_id
+    }
+
+
+def resolve_kline_birth_info(
     request: KLineGenerateRequest,
-    authorization: Optional[str] = Header(None),
+    authorization: Optional[str] = None,
     user_id: Optional[str] = None
-):
+) -> dict:
     """
-    生成人生K线数据
+    解析 K 线生成所需的出生信息
     
     支持两种入参方式：
     1. 传 book_id：从数据库查询八字信息（需要权限验证，只能使用自己的命书）
     2. 传 birth_data：直接使用表单数据（无需权限验证）
     
-    无论哪种方式，最终都调用相同的 LLM Service 逻辑生成K线数据
+    Returns:
+        出生信息（name, gender, birth_date, birth_time, lat, lng, city, book_id, user_id）
     """
-    try:
-        db = next(get_db())
-        
-        # 情况1：传了 book_id，从数据库查询
-        if request.book_id:
+    # 情况1：传了 book_id，从数据库查询
+    if request.book_id:
+        db = SessionLocal()
+        try:
             book = db.query(FortuneBook).filter(FortuneBook.id == request.book_id).first()
-            if not book:
-                raise HTTPException(status_code=404, detail="命书不存在")
-            
-            # 用户权限检查：确保用户只能使用自己的命书
-            current_user_id = get_current_user_id(authorization=authorization, user_id=user_id)
-            if book.user_id != current_user_id:
-                print(f"❌ 权限拒绝：用户 {current_user_id} 尝试使用用户 {book.user_id} 的命书生成K线", flush=True)
-                raise HTTPException(
-                    status_code=403,
-                    detail="无权访问：该命书不属于当前用户"
-                )
-            print(f"✅ 权限验证通过：用户 {current_user_id} 使用自己的命书生成K线", flush=True)
-            
-            # 从数据库获取数据
-            name = book.person_name
-            gender = book.gender
-            birth_date = book.birth_date
-            birth_time = book.birth_time
-            lat = book.lat
-            lng = book.lng
-            city = book.city
-        else:
-            # 情况2：传了 birth_data，直接使用
-            if not all([request.name, request.gender, request.birth_date, 
-                       request.birth_time, request.lat is not None, 
-                       request.lng is not None, request.city]):
-                raise HTTPException(
-                    status_code=400, 
-                    detail="当未提供 book_id 时，必须提供完整的出生信息（name, gender, birth_date, birth_time, lat, lng, city）"
-                )
-            
-            name = request.name
-            gender = request.gender
-            birth_date = request.birth_date
-            birth_time = request.birth_time
-            lat = request.lat
-            lng = request.lng
-            city = request.city
-        
-        # 统一的数据结构，传给 Service 层
-        # 1. 生成完整的 BaziReport（后端硬核判定）
-        bazi_report = calculator.generate_bazi_report(
-            birth_date=birth_date,
-            birth_time=birth_time,
-            lng=lng,
-            lat=lat,
-            gender=gender
-        )
-        
-        # 2. 调用 LLM 获取结构化的命理分析数据（复用现有逻辑）
-        llm_data = await call_llm_for_structured_data(
-            bazi_report,
-            name,
-            gender,
-            city,
-            birth_date,
-            birth_time
-        )
+        finally:
+            db.close()
+        if not book:
+            raise HTTPException(status_code=404, detail="命书不存在")
         
-        # 3. 构建 K 线生成专用的 System Prompt（使用完整的八字数据）
-        # 4. 调用 LLM 生成 K 线解读（必须使用真实八字，不能是 Mock）
-        if not compass_client:
+        # 用户权限检查：确保用户只能使用自己的命书
+        current_user_id = get_current_user_id(authorization=authorization, user_id=user_id)
+        if book.user_id != current_user_id:
+            print(f"❌ 权限拒绝：用户 {current_user_id} 尝试使用用户 {book.user_id} 的命书生成K线", flush=True)
             raise HTTPException(
-                status_code=500,
-                detail="Compass API 未配置，无法生成 K 线数据"
+                status_code=403,
+                detail="无权访问：该命书不属于当前用户"
             )
+        print(f"✅ 权限验证通过：用户 {current_user_id} 使用自己的命书生成K线", flush=True)
         
-        # 构建精简的 K 线 Prompt（只要求 JSON 输出，提速）
-        # 提取关键八字信息
-        chart = bazi_report['chart']
-        gods = bazi_report['gods']
-        da_yun = bazi_report['da_yun']
-        day_master = bazi_report.get('day_master', chart.get('day_gan', ''))
-        day_wuxing = gods.get('day_wuxing', '')
-        yong_shen = gods.get('useful_gods', [])
-        
-        # 计算出生年份和当前年龄
-        birth_year = datetime.strptime(birth_date, "%Y-%m-%d").year
-        current_year = datetime.now().year
-        current_age = current_year - birth_year
-        
-        # 生成 0-100 岁的时间轴（用于计算流年干支和大运）
-        # 使用已有的 calculator 实例
-        true_solar_time = calculator.calculate_true_solar_time(birth_date, birth_time, lng, lat)
-        si_zhu = calculator.get_si_zhu(true_solar_time)
-        
-        # 计算每个年龄的流年干支和大运
-        timeline_data = []
-        for age in range(101):  # 0-100岁
-            year = birth_year + age
-            from lunar_python import Solar
-            solar = Solar.fromYmd(year, 1, 1)
-            lunar = solar.getLunar()
-            year_gan = lunar.getYearGan()
-            year_zhi = lunar.getYearZhi()
-            liu_nian_gan_zhi = year_gan + year_zhi
-            
-            # 找到对应的大运
-            current_dayun = ''
-            for dy in da_yun:
-                age_start = dy.get('age_start', 0)
-                age_end = dy.get('age_end', 100)
-                if age_start <= age < age_end:
-                    current_dayun = dy.get('gan_zhi', '')
-                    break
-            
-            timeline_data.append({
-                'age': age,
-                'year': year,
-                'gan_zhi': liu_nian_gan_zhi,
-                'da_yun': current_dayun
-            })
-        
-        # 构建精简 Prompt（优化：减少冗余，提高速度）
-        kline_prompt = f"""根据八字生成0-100岁K线数据，只返回JSON：
+        return book_birth_info(book)
+    
+    # 情况2：传了 birth_data，直接使用
+    if not all([request.name, request.gender, request.birth_date, 
+               request.birth_time, request.lat is not None, 
+               request.lng is not None, request.city]):
+        raise HTTPException(
+            status_code=400, 
+            detail="当未提供 book_id 时，必须提供完整的出生信息（name, gender, birth_date, birth_time, lat, lng, city）"
+        )
+    
+    return {
+        "name": request.name,
+        "gender": request.gender,
+        "birth_date": request.birth_date,
+        "birth_time": request.birth_time,
+        "lat": request.lat,
+        "lng": request.lng,
+        "city": request.city,
+        "book_id": None,
+        "user_id": None
+    }
+
+
+async def prepare_kline_context(birth_info: dict, deadline: Deadline) -> dict:
+    """
+    K 线生成的确定性准备阶段：排盘、0-100 岁时间轴、精简 Prompt
+    
+    Args:
+        birth_info: resolve_kline_birth_info 返回的出生信息
+        deadline: 请求截止时间（排盘超出预算时抛出 asyncio.TimeoutError）
+    
+    Returns:
+        generate_kline_stream 所需的上下文
+    """
+    birth_date = birth_info['birth_date']
+    
+    # K 线管线实际只依赖两类数据：
+    # 1. BaziReport（日主、用神、大运）→ 构建 Prompt
+    # 2. 0-100 岁流年干支 → 构建时间轴
+    # 两者互不依赖，并发计算；call_llm_for_structured_data 的结构化解读 K 线并不使用，不再调用
+    birth_year = datetime.strptime(birth_date, "%Y-%m-%d").year
+    bazi_report, liu_nian_list = await deadline.run(asyncio.gather(
+        asyncio.to_thread(
+            calculator.generate_bazi_report,
+            birth_date=birth_date,
+            birth_time=birth_info['birth_time'],
+            lng=birth_info['lng'],
+            lat=birth_info['lat'],
+            gender=birth_info['gender']
+        ),
+        asyncio.to_thread(calculate_liu_nian_gan_zhi, birth_year)
+    ), reserve=DEADLINE_FALLBACK_RESERVE)
+    
+    # 构建精简的 K 线 Prompt（只要求 JSON 输出，提速）
+    da_yun = bazi_report['da_yun']
+    
+    # 计算当前年龄
+    current_year = datetime.now().year
+    current_age = current_year - birth_year
+    
+    # 生成 0-100 岁的时间轴（流年干支 + 所属大运）
+    timeline_data = build_kline_timeline(birth_year, liu_nian_list, da_yun)
+    
+    # 构建精简 Prompt（优化：减少冗余，提高速度）
+    kline_prompt = f"""根据八字生成0-100岁K线数据，只返回JSON：
 
-日主: {day_master}（{day_wuxing}）
-用神: {', '.join(yong_shen[:3]) if yong_shen else '无'}
-大运: {'; '.join([f"{dy.get('age_start', 0)}-{dy.get('age_end', 100)}岁:{dy.get('gan_zhi', '')}" for dy in da_yun[:6]])}
+{chart_codec.encode(bazi_report, ("day_master", "gods", "da_yun"))}
 
 返回格式（纯JSON，无Markdown）：
 {{
@@ -1765,507 +2467,1204 @@ async def generate_kline(
 
 要求：scores必须101个，peaks/valleys各3-5个，只返回JSON。
 """
+    
+    
+    return {
+        "bazi_report": bazi_report,
+        "timeline_data": timeline_data,
+        "kline_prompt": kline_prompt,
+        "birth_date": birth_date,
+        "birth_year": birth_year,
+        "current_age": current_age,
+        "book_id": birth_info.get('book_id'),
+        "chart_key": kline_chart_key(birth_info)
+    }
+
+
+async def generate_kline_stream(context: dict, deadline: Deadline, priority: int = PRIORITY_INTERACTIVE,
+                                slot_tag: Optional[str] = None):
+    """
+    流式生成K线数据
+    
+    先调用 Compass（流式），失败后回退 DeepSeek（流式），全部失败或耗时预算用尽时输出基于大运的默认数据。
+    
+    Args:
+        context: prepare_kline_context 返回的上下文
+        deadline: 请求截止时间
+        priority: LLM 槽位优先级（预计算使用 PRIORITY_BACKGROUND）
+        slot_tag: 槽位排队 tag（预计算使用其流 ID，用户等待时据此提升优先级）
+    
+    Yields:
+        SSE 数据帧（progress / text / error / analysis / chart_data / complete / [DONE]）
+    """
+    bazi_report = context['bazi_report']
+    timeline_data = context['timeline_data']
+    kline_prompt = context['kline_prompt']
+    birth_date = context['birth_date']
+    birth_year = context['birth_year']
+    current_age = context['current_age']
+    
+    # 调用 LLM API（流式，先传输分析文本，最后传输JSON数据）
+    print(f"📊 开始调用 LLM 生成 K 线数据（流式模式）", flush=True)
+    
+    response_text = ""
+    ai_call_success = False
+    
+    # 首先尝试 Compass API（流式）
+    if compass_client:
+        try:
+            print("🔄 尝试使用 Compass API（流式）...", flush=True)
+            stream = None
+            try:
+                # 使用流式API
+                stream = compass_client.models.generate_content_stream(
+                    model="gemini-2.5-flash",
+                    contents=kline_prompt,
+                    config={
+                        "response_mime_type": "application/json"
+                    }
+                )
+                print("✅ 使用流式 API（JSON 模式）", flush=True)
+            except (TypeError, AttributeError) as e1:
+                try:
+                    # 回退方案：不使用JSON模式，直接流式
+                    stream = compass_client.models.generate_content_stream(
+                        model="gemini-2.5-flash",
+                        contents=kline_prompt
+                    )
+                    print("✅ 使用流式 API（默认模式）", flush=True)
+                except Exception as e2:
+                    print(f"⚠️  流式 API 调用失败: {e2}", flush=True)
+                    stream = None
         
-        # 调用 LLM API（流式，先传输分析文本，最后传输JSON数据）
-        print(f"📊 开始调用 LLM 生成 K 线数据（流式模式）", flush=True)
-        
-        # 流式返回结果
-        async def generate_kline_stream():
-            """流式生成K线数据的生成器函数"""
-            # 确保 current_age 在函数内部可访问（从外部作用域获取）
-            nonlocal current_age
-            response_text = ""
-            ai_call_success = False
+            # 发送进度：30%（开始调用AI）
+            yield f"data: {json.dumps({'type': 'progress', 'progress': 30}, ensure_ascii=False)}\n\n"
             
-            # 首先尝试 Compass API（流式）
-            if compass_client:
+            # 流式处理响应
+            if stream:
                 try:
-                    print("🔄 尝试使用 Compass API（流式）...", flush=True)
-                    stream = None
-                    try:
-                        # 使用流式API
-                        stream = compass_client.models.generate_content_stream(
-                            model="gemini-2.5-flash",
-                            contents=kline_prompt,
-                            config={
-                                "response_mime_type": "application/json"
-                            }
-                        )
-                        print("✅ 使用流式 API（JSON 模式）", flush=True)
-                    except (TypeError, AttributeError) as e1:
-                        try:
-                            # 回退方案：不使用JSON模式，直接流式
-                            stream = compass_client.models.generate_content_stream(
-                                model="gemini-2.5-flash",
-                                contents=kline_prompt
-                            )
-                            print("✅ 使用流式 API（默认模式）", flush=True)
-                        except Exception as e2:
-                            print(f"⚠️  流式 API 调用失败: {e2}", flush=True)
-                            stream = None
-                
-                    # 发送进度：30%（开始调用AI）
-                    yield f"data: {json.dumps({'type': 'progress', 'progress': 30}, ensure_ascii=False)}\n\n"
-                    
-                    # 流式处理响应
-                    if stream:
-                        try:
-                            chunk_count = 0
-                            for chunk in stream:
-                                chunk_text = ""
-                                if hasattr(chunk, 'text'):
-                                    chunk_text = chunk.text
-                                elif hasattr(chunk, 'candidates') and chunk.candidates:
-                                    if hasattr(chunk.candidates[0], 'content'):
-                                        if hasattr(chunk.candidates[0].content, 'parts'):
-                                            for part in chunk.candidates[0].content.parts:
-                                                if hasattr(part, 'text'):
-                                                    chunk_text += part.text
-                                
-                                if chunk_text:
-                                    response_text += chunk_text
-                                    chunk_count += 1
-                                    # 每收到20个chunk，更新一次进度（30% -> 70%）
-                                    if chunk_count % 20 == 0:
-                                        progress = min(30 + int((chunk_count / 60) * 40), 70)
-                                        yield f"data: {json.dumps({'type': 'progress', 'progress': progress}, ensure_ascii=False)}\n\n"
-                            
-                            if response_text:
-                                print(f"✅ Compass API 流式调用成功，返回内容长度: {len(response_text)}", flush=True)
-                                ai_call_success = True
-                                # 发送进度：70%（AI调用完成）
-                                yield f"data: {json.dumps({'type': 'progress', 'progress': 70}, ensure_ascii=False)}\n\n"
-                        except Exception as stream_error:
-                            print(f"❌ 流式处理错误: {stream_error}", flush=True)
-                            stream = None
-                    else:
-                        print(f"⚠️  流式 API 调用失败，stream 为 None", flush=True)
+                    chunk_count = 0
+                    async for chunk in iter_sync_stream(stream, priority=priority, deadline=deadline,
+                                                        reserve=DEADLINE_FALLBACK_RESERVE, slot_tag=slot_tag):
+                        chunk_text = ""
+                        if hasattr(chunk, 'text'):
+                            chunk_text = chunk.text
+                        elif hasattr(chunk, 'candidates') and chunk.candidates:
+                            if hasattr(chunk.candidates[0], 'content'):
+                                if hasattr(chunk.candidates[0].content, 'parts'):
+                                    for part in chunk.candidates[0].content.parts:
+                                        if hasattr(part, 'text'):
+                                            chunk_text += part.text
                         
-                except Exception as compass_error:
-                    error_msg = str(compass_error)
-                    print(f"❌ Compass API 调用失败: {error_msg}", flush=True)
+                        if chunk_text:
+                            response_text += chunk_text
+                            chunk_count += 1
+                            # 每收到20个chunk，更新一次进度（30% -> 70%）
+                            if chunk_count % 20 == 0:
+                                progress = min(30 + int((chunk_count / 60) * 40), 70)
+                                yield f"data: {json.dumps({'type': 'progress', 'progress': progress}, ensure_ascii=False)}\n\n"
                     
-                    # 检查是否是余额不足或其他可恢复错误
-                    if "balance" in error_msg.lower() or "402" in error_msg or "quota" in error_msg.lower():
-                        print("⚠️  Compass API 余额不足，尝试使用 DeepSeek API 作为备用...", flush=True)
-                    else:
-                        print("⚠️  Compass API 调用异常，尝试使用 DeepSeek API 作为备用...", flush=True)
+                    if response_text:
+                        print(f"✅ Compass API 流式调用成功，返回内容长度: {len(response_text)}", flush=True)
+                        ai_call_success = True
+                        # 发送进度：70%（AI调用完成）
+                        yield f"data: {json.dumps({'type': 'progress', 'progress': 70}, ensure_ascii=False)}\n\n"
+                except Exception as stream_error:
+                    print(f"❌ 流式处理错误: {stream_error}", flush=True)
+                    stream = None
+            else:
+                print(f"⚠️  流式 API 调用失败，stream 为 None", flush=True)
+                
+        except Exception as compass_error:
+            error_msg = str(compass_error)
+            print(f"❌ Compass API 调用失败: {error_msg}", flush=True)
             
-            # 如果 Compass API 失败，尝试 DeepSeek API（流式）
-            if not ai_call_success and deepseek_api_key:
-                try:
-                    print("🔄 尝试使用 DeepSeek API（流式）...", flush=True)
-                    import httpx
-                    
-                    url = f"{deepseek_base_url}/chat/completions"
-                    headers = {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {deepseek_api_key}"
-                    }
-                    
-                    payload = {
-                        "model": "deepseek-chat",
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": "你是一位精通八字命理的大师，擅长根据八字和大运推演人生运势。请严格按照 JSON 格式返回结果，不要包含任何 markdown 标记。"
-                            },
-                            {
-                                "role": "user",
-                                "content": kline_prompt
-                            }
-                        ],
-                        "temperature": 0.7,
-                        "max_tokens": 2000,
-                        "response_format": {"type": "json_object"},  # 强制 JSON 输出
-                        "stream": True  # 启用流式
-                    }
-                    
-                    # 使用流式调用
-                    with httpx.Client(timeout=60.0) as client:
-                        with client.stream("POST", url, json=payload, headers=headers) as response:
-                            response.raise_for_status()
-                            for line in response.iter_lines():
-                                if line.startswith("data: "):
-                                    data_str = line[6:]  # 移除 "data: " 前缀
-                                    if data_str == "[DONE]":
-                                        break
-                                    try:
-                                        chunk_data = json.loads(data_str)
-                                        if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
-                                            delta = chunk_data["choices"][0].get("delta", {})
-                                            chunk_text = delta.get("content", "")
-                                            if chunk_text:
-                                                response_text += chunk_text
-                                                # 流式发送文本片段
-                                                yield f"data: {json.dumps({'type': 'text', 'content': chunk_text}, ensure_ascii=False)}\n\n"
-                                    except json.JSONDecodeError:
-                                        continue
-                    
-                    if response_text:
-                        print(f"✅ DeepSeek API 流式调用成功，返回内容长度: {len(response_text)}", flush=True)
-                        ai_call_success = True
-                        
-                except Exception as deepseek_error:
-                    print(f"❌ DeepSeek API 调用也失败: {deepseek_error}", flush=True)
-                    import traceback
-                    print(traceback.format_exc(), flush=True)
-            
-            # 如果所有 AI 服务都失败，使用默认数据
-            if not ai_call_success:
-                yield f"data: {json.dumps({'type': 'error', 'content': '所有 AI 服务调用失败，将使用默认数据'}, ensure_ascii=False)}\n\n"
-                # 继续处理，使用默认数据
-                response_text = "{}"  # 空JSON，将使用默认数据
+            # 检查是否是余额不足或其他可恢复错误
+            if "balance" in error_msg.lower() or "402" in error_msg or "quota" in error_msg.lower():
+                print("⚠️  Compass API 余额不足，尝试使用 DeepSeek API 作为备用...", flush=True)
+            else:
+                print("⚠️  Compass API 调用异常，尝试使用 DeepSeek API 作为备用...", flush=True)
+    
+    # 如果 Compass API 失败，尝试 DeepSeek API（流式），仅在仍有剩余预算时
+    if not ai_call_success and deepseek_api_key and deadline.timeout(reserve=DEADLINE_FALLBACK_RESERVE) > 0:
+        # 丢弃 Compass 超时前的半截输出
+        response_text = ""
+        try:
+            print("🔄 尝试使用 DeepSeek API（流式）...", flush=True)
+            import httpx
             
-            # 数据清洗：去除 Markdown 标记
-            clean_json = response_text.replace("```json", "").replace("```", "").strip()
+            url = f"{deepseek_base_url}/chat/completions"
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {deepseek_api_key}"
+            }
             
-            try:
-                # 尝试解析 JSON
-                try:
-                    data = json.loads(clean_json)
-                    print("✅ JSON 解析成功", flush=True)
-                except json.JSONDecodeError as e:
-                    print(f"❌ JSON 解析失败: {e}", flush=True)
-                    print(f"❌ 清洗后的内容（前500字符）: {clean_json[:500]}", flush=True)
-                    # 如果解析失败，尝试提取 JSON 对象
-                    import re
-                    json_match = re.search(r'\{.*\}', clean_json, re.DOTALL)
-                    if json_match:
-                        try:
-                            data = json.loads(json_match.group(0))
-                            print("✅ 从文本中提取 JSON 成功", flush=True)
-                        except json.JSONDecodeError:
-                            data = None
-                    else:
-                        data = None
-                
-                # 如果解析失败，使用默认数据
-                if not data:
-                    raise ValueError("无法解析 JSON，将使用默认数据")
-                
-                # 提取数据
-                scores = data.get("scores", [])
-                peaks = data.get("peaks", [])
-                valleys = data.get("valleys", [])
-                analysis_text = data.get("summary", "基于八字和大运分析，整体运势平稳发展。")
-                
-                # 验证数组长度（必须是101个）
-                if len(scores) != 101:
-                    print(f"⚠️  数组长度不正确: scores={len(scores)}，期望101个", flush=True)
-                    # 填充或截取到101个
-                    if len(scores) < 101:
-                        scores.extend([60] * (101 - len(scores)))
-                    elif len(scores) > 101:
-                        scores[:] = scores[:101]
-                
-                # 验证高峰和低谷数据
-                peaks = [p for p in peaks if isinstance(p, dict) and 'age' in p and 0 <= p['age'] <= 100]
-                valleys = [v for v in valleys if isinstance(v, dict) and 'age' in v and 0 <= v['age'] <= 100]
-                
-                # 生成年份数组和详细信息（0-100岁，共101年）
-                chart_points = []
-                for i, timeline_point in enumerate(timeline_data):
-                    age = timeline_point['age']
-                    year = timeline_point['year']
-                    gan_zhi = timeline_point['gan_zhi']
-                    da_yun = timeline_point['da_yun']
-                    score = scores[i] if i < len(scores) else 60
-                    
-                    # 检查是否是高峰或低谷
-                    is_peak = any(p.get('age') == age for p in peaks)
-                    is_valley = any(v.get('age') == age for v in valleys)
-                    
-                    chart_points.append({
-                        "age": age,
-                        "year": year,
-                        "gan_zhi": gan_zhi,
-                        "da_yun": da_yun,
-                        "score": score,
-                        "is_peak": is_peak,
-                        "is_valley": is_valley
-                    })
-                
-                # 计算当前运势信息
-                current_score = scores[current_age] if current_age < len(scores) else 60
-                current_label = "吉" if current_score >= 70 else ("平" if current_score >= 50 else "凶")
-                
-                # 计算5年趋势（未来5年的平均分 vs 过去5年的平均分）
-                future_ages = [current_age + i for i in range(1, 6) if current_age + i < 101]
-                past_ages = [current_age - i for i in range(1, 6) if current_age - i >= 0]
-                
-                future_avg = sum(scores[age] for age in future_ages) / len(future_ages) if future_ages else current_score
-                past_avg = sum(scores[age] for age in past_ages) / len(past_ages) if past_ages else current_score
-                trend_value = future_avg - past_avg
-                trend_direction = "上升" if trend_value > 5 else ("下降" if trend_value < -5 else "平稳")
-                
-                # 找到下一个高峰和下一个低谷
-                next_peak = None
-                next_valley = None
-                for peak in sorted(peaks, key=lambda x: x.get('age', 0)):
-                    if peak.get('age', 0) > current_age:
-                        next_peak = peak
-                        break
-                for valley in sorted(valleys, key=lambda x: x.get('age', 0)):
-                    if valley.get('age', 0) > current_age:
-                        next_valley = valley
-                        break
-                
-                # 计算人生阶段分析
-                stages = [
-                    {"name": "童年", "age_range": (0, 12), "scores": scores[0:13]},
-                    {"name": "青年", "age_range": (13, 30), "scores": scores[13:31]},
-                    {"name": "壮年", "age_range": (31, 50), "scores": scores[31:51]},
-                    {"name": "中年", "age_range": (51, 65), "scores": scores[51:66]},
-                    {"name": "老年", "age_range": (66, 100), "scores": scores[66:101]}
-                ]
-                
-                stage_analysis = []
-                for stage in stages:
-                    stage_scores = stage["scores"]
-                    if stage_scores:
-                        avg_score = sum(stage_scores) / len(stage_scores)
-                        stage_analysis.append({
-                            "name": stage["name"],
-                            "age_range": f"{stage['age_range'][0]}-{stage['age_range'][1]}岁",
-                            "avg_score": round(avg_score, 1),
-                            "is_current": stage["age_range"][0] <= current_age <= stage["age_range"][1]
-                        })
-                
-                # 获取当前年份的详细信息（需要调用 LLM 生成详细分析）
-                current_year_detail = {
-                    "age": current_age,
-                    "year": chart_points[current_age]["year"] if current_age < len(chart_points) else birth_year + current_age,
-                    "gan_zhi": chart_points[current_age]["gan_zhi"] if current_age < len(chart_points) else "",
-                    "da_yun": chart_points[current_age]["da_yun"] if current_age < len(chart_points) else "",
-                    "score": current_score,
-                    "label": current_label,
-                    "wealth": "财运稳健，升职加薪",  # 默认值，后续可通过 LLM 生成
-                    "interpersonal": "贵人提携",
-                    "relationship": "感情正式稳定",
-                    "health": "防止过劳",
-                    "suitable": "晋升加薪",
-                    "avoid": "背后议论"
-                }
-                
-                # 构建返回数据
-                chart_data = {
-                    "points": chart_points,  # 101个数据点，包含详细信息
-                    "peaks": peaks,  # 高峰列表
-                    "valleys": valleys,  # 低谷列表
-                    "current_age": current_age,  # 当前年龄
-                    "current_fortune": {  # 当前运势信息
-                        "score": current_score,
-                        "label": current_label
-                    },
-                    "trend_5years": {  # 5年趋势
-                        "direction": trend_direction,
-                        "value": round(trend_value, 1),
-                        "description": f"{trend_direction}" + (f"（{abs(round(trend_value, 1))}分）" if abs(trend_value) > 5 else "")
+            payload = {
+                "model": "deepseek-chat",
+                "messages": [
+                    {
+                        "role": "system",
+                        "content": "你是一位精通八字命理的大师，擅长根据八字和大运推演人生运势。请严格按照 JSON 格式返回结果，不要包含任何 markdown 标记。"
                     },
-                    "next_peak": {  # 下个高峰
-                        "age": next_peak.get('age') if next_peak else None,
-                        "years_left": next_peak.get('age') - current_age if next_peak else None,
-                        "score": next_peak.get('score') if next_peak else None,
-                        "reason": next_peak.get('reason') if next_peak else None
-                    } if next_peak else None,
-                    "next_valley": {  # 需注意时期
-                        "age": next_valley.get('age') if next_valley else None,
-                        "years_left": next_valley.get('age') - current_age if next_valley else None,
-                        "score": next_valley.get('score') if next_valley else None,
-                        "reason": next_valley.get('reason') if next_valley else None
-                    } if next_valley else None,
-                    "stage_analysis": stage_analysis,  # 人生阶段分析
-                    "current_year_detail": current_year_detail  # 当前年份详细信息
-                }
-                
-                print(f"✅ K 线数据生成成功: 共{len(chart_points)}个数据点，{len(peaks)}个高峰，{len(valleys)}个低谷", flush=True)
-                print(f"✅ 当前运势: {current_score}分 ({current_label}), 5年趋势: {trend_direction}", flush=True)
-                
-                # 发送进度：95%（数据生成完成）
-                yield f"data: {json.dumps({'type': 'progress', 'progress': 95}, ensure_ascii=False)}\n\n"
-                
-                # 流式发送分析文本
-                if analysis_text:
-                    yield f"data: {json.dumps({'type': 'analysis', 'content': analysis_text}, ensure_ascii=False)}\n\n"
-                
-                # 流式发送完整的图表数据
-                yield f"data: {json.dumps({'type': 'chart_data', 'data': chart_data}, ensure_ascii=False)}\n\n"
-                
-                # 发送进度：100%（完成）
-                yield f"data: {json.dumps({'type': 'progress', 'progress': 100}, ensure_ascii=False)}\n\n"
-                
-                # 发送完成标记
-                yield f"data: {json.dumps({'type': 'complete', 'data': {'chart_data': chart_data, 'analysis_text': analysis_text, 'bazi_report': bazi_report}}, ensure_ascii=False)}\n\n"
-                yield "data: [DONE]\n\n"
-                
-            except Exception as e:
-                print(f"⚠️  LLM API 调用失败: {e}", flush=True)
-                import traceback
-                print(traceback.format_exc(), flush=True)
-                
-                # 生成默认数据（兜底）
-                print(f"⚠️  使用默认数据（基于大运）", flush=True)
-                birth_year = datetime.strptime(birth_date, "%Y-%m-%d").year
-            current_year = datetime.now().year
-            current_age = current_year - birth_year
+                    {
+                        "role": "user",
+                        "content": kline_prompt
+                    }
+                ],
+                "temperature": 0.7,
+                "max_tokens": 2000,
+                "response_format": {"type": "json_object"},  # 强制 JSON 输出
+                "stream": True  # 启用流式
+            }
             
-            da_yun = bazi_report.get('da_yun', [])
-            base_score = 60
+            # 使用流式调用（异步客户端，避免阻塞事件循环；占用 LLM 并发槽位，客户端断开时随任务取消一并释放）
+            client_timeout = deadline.timeout(cap=60.0, reserve=DEADLINE_FALLBACK_RESERVE)
+            async with llm_scheduler.slot(priority, slot_tag), httpx.AsyncClient(timeout=client_timeout) as client:
+                async with client.stream("POST", url, json=payload, headers=headers) as response:
+                    response.raise_for_status()
+                    async for line in deadline.iterate(response.aiter_lines(), reserve=DEADLINE_FALLBACK_RESERVE):
+                        if line.startswith("data: "):
+                            data_str = line[6:]  # 移除 "data: " 前缀
+                            if data_str == "[DONE]":
+                                break
+                            try:
+                                chunk_data = json.loads(data_str)
+                                if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
+                                    delta = chunk_data["choices"][0].get("delta", {})
+                                    chunk_text = delta.get("content", "")
+                                    if chunk_text:
+                                        response_text += chunk_text
+                                        # 流式发送文本片段
+                                        yield f"data: {json.dumps({'type': 'text', 'content': chunk_text}, ensure_ascii=False)}\n\n"
+                            except json.JSONDecodeError:
+                                continue
             
-            # 生成 0-100 岁的默认数据
-            chart_points = []
-            for i, timeline_point in enumerate(timeline_data):
-                age = timeline_point['age']
-                year = timeline_point['year']
-                gan_zhi = timeline_point['gan_zhi']
-                da_yun_name = timeline_point['da_yun']
-                
-                # 根据大运简单调整分数
-                score = base_score
-                for dy in da_yun:
-                    age_start = dy.get('age_start', 0)
-                    age_end = dy.get('age_end', 100)
-                    if age_start <= age < age_end:
-                        score = base_score + 10  # 大运期间分数稍高
-                        break
+            if response_text:
+                print(f"✅ DeepSeek API 流式调用成功，返回内容长度: {len(response_text)}", flush=True)
+                ai_call_success = True
                 
-                chart_points.append({
-                    "age": age,
-                    "year": year,
-                    "gan_zhi": gan_zhi,
-                    "da_yun": da_yun_name,
-                    "score": score,
-                    "is_peak": False,
-                    "is_valley": False
+        except Exception as deepseek_error:
+            print(f"❌ DeepSeek API 调用也失败: {deepseek_error}", flush=True)
+            import traceback
+            print(traceback.format_exc(), flush=True)
+    
+    # 如果所有 AI 服务都失败（或耗时预算用尽），使用默认数据
+    if not ai_call_success:
+        fail_message = 'K 线生成超时，将使用默认数据' if deadline.timeout(reserve=DEADLINE_FALLBACK_RESERVE) <= 0 else '所有 AI 服务调用失败，将使用默认数据'
+        yield f"data: {json.dumps({'type': 'error', 'content': fail_message}, ensure_ascii=False)}\n\n"
+        # 继续处理，使用默认数据
+        response_text = "{}"  # 空JSON，将使用默认数据
+    
+    # 数据清洗：去除 Markdown 标记
+    clean_json = response_text.replace("```json", "").replace("```", "").strip()
+    
+    try:
+        # 尝试解析 JSON
+        try:
+            data = json.loads(clean_json)
+            print("✅ JSON 解析成功", flush=True)
+        except json.JSONDecodeError as e:
+            print(f"❌ JSON 解析失败: {e}", flush=True)
+            print(f"❌ 清洗后的内容（前500字符）: {clean_json[:500]}", flush=True)
+            # 如果解析失败，尝试提取 JSON 对象
+            import re
+            json_match = re.search(r'\{.*\}', clean_json, re.DOTALL)
+            if json_match:
+                try:
+                    data = json.loads(json_match.group(0))
+                    print("✅ 从文本中提取 JSON 成功", flush=True)
+                except json.JSONDecodeError:
+                    data = None
+            else:
+                data = None
+        
+        # 如果解析失败，使用默认数据
+        if not data:
+            raise ValueError("无法解析 JSON，将使用默认数据")
+        
+        # 提取数据
+        scores = data.get("scores", [])
+        peaks = data.get("peaks", [])
+        valleys = data.get("valleys", [])
+        analysis_text = data.get("summary", "基于八字和大运分析，整体运势平稳发展。")
+        
+        # 验证数组长度（必须是101个）
+        if len(scores) != 101:
+            print(f"⚠️  数组长度不正确: scores={len(scores)}，期望101个", flush=True)
+            # 填充或截取到101个
+            if len(scores) < 101:
+                scores.extend([60] * (101 - len(scores)))
+            elif len(scores) > 101:
+                scores[:] = scores[:101]
+        
+        # 验证高峰和低谷数据
+        peaks = [p for p in peaks if isinstance(p, dict) and 'age' in p and 0 <= p['age'] <= 100]
+        valleys = [v for v in valleys if isinstance(v, dict) and 'age' in v and 0 <= v['age'] <= 100]
+        
+        # 生成年份数组和详细信息（0-100岁，共101年）
+        chart_points = build_kline_points(timeline_data, scores, peaks, valleys)
+        
+        # 随时间变化的字段（当前年龄、5年趋势、下个高峰等）在组装时计算，points 按请求的年龄窗口截取
+        chart_data = derive_kline_chart_data(
+            chart_points, peaks, valleys, birth_year, *context.get('window', (None, None)), bazi_report=bazi_report
+        )
+        encode_kline_chart_data(chart_data, context.get('format'))
+        current_fortune = chart_data['current_fortune']
+        
+        print(f"✅ K 线数据生成成功: 共{len(chart_points)}个数据点，{len(peaks)}个高峰，{len(valleys)}个低谷", flush=True)
+        print(f"✅ 当前运势: {current_fortune['score']}分 ({current_fortune['label']}), 5年趋势: {chart_data['trend_5years']['direction']}", flush=True)
+        
+        # 命书的曲线与读取时间无关，持久化后再次打开只需读库
+        if context.get('book_id'):
+            await asyncio.to_thread(
+                save_kline_curve, context['book_id'], birth_year,
+                chart_points, peaks, valleys, analysis_text, bazi_report, context.get('chart_key')
+            )
+        
+        # 发送进度：95%（数据生成完成）
+        yield f"data: {json.dumps({'type': 'progress', 'progress': 95}, ensure_ascii=False)}\n\n"
+        
+        # 流式发送分析文本
+        if analysis_text:
+            yield f"data: {json.dumps({'type': 'analysis', 'content': analysis_text}, ensure_ascii=False)}\n\n"
+        
+        # 流式发送完整的图表数据
+        yield f"data: {json.dumps({'type': 'chart_data', 'data': chart_data}, ensure_ascii=False)}\n\n"
+        
+        # 发送进度：100%（完成）
+        yield f"data: {json.dumps({'type': 'progress', 'progress': 100}, ensure_ascii=False)}\n\n"
+        
+        # 发送完成标记
+        yield f"data: {json.dumps({'type': 'complete', 'data': {'chart_data': chart_data, 'analysis_text': analysis_text, 'bazi_report': bazi_report}}, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+        
+    except Exception as e:
+        print(f"⚠️  LLM API 调用失败: {e}", flush=True)
+        import traceback
+        print(traceback.format_exc(), flush=True)
+        
+        # 生成默认数据（兜底）
+        print(f"⚠️  使用默认数据（基于大运）", flush=True)
+        birth_year = datetime.strptime(birth_date, "%Y-%m-%d").year
+        current_year = datetime.now().year
+        current_age = current_year - birth_year
+        
+        da_yun = bazi_report.get('da_yun', [])
+        base_score = 60
+        
+        # 生成 0-100 岁的默认数据
+        chart_points = []
+        for i, timeline_point in enumerate(timeline_data):
+            age = timeline_point['age']
+            year = timeline_point['year']
+            gan_zhi = timeline_point['gan_zhi']
+            da_yun_name = timeline_point['da_yun']
+        
+            # 根据大运简单调整分数
+            score = base_score
+            for dy in da_yun:
+                age_start = dy.get('age_start', 0)
+                age_end = dy.get('age_end', 100)
+                if age_start <= age < age_end:
+                    score = base_score + 10  # 大运期间分数稍高
+                    break
+        
+            chart_points.append({
+                "age": age,
+                "year": year,
+                "gan_zhi": gan_zhi,
+                "da_yun": da_yun_name,
+                "score": score,
+                "is_peak": False,
+                "is_valley": False
+            })
+        
+        # 计算默认的当前运势信息
+        current_score = base_score
+        current_label = "平"
+        
+        # 计算5年趋势
+        trend_direction = "平稳"
+        trend_value = 0
+        
+        # 计算人生阶段分析
+        stages = [
+            {"name": "童年", "age_range": (0, 12), "scores": [base_score] * 13},
+            {"name": "青年", "age_range": (13, 30), "scores": [base_score] * 18},
+            {"name": "壮年", "age_range": (31, 50), "scores": [base_score] * 20},
+            {"name": "中年", "age_range": (51, 65), "scores": [base_score] * 15},
+            {"name": "老年", "age_range": (66, 100), "scores": [base_score] * 35}
+        ]
+        
+        stage_analysis = []
+        for stage in stages:
+            stage_scores = stage["scores"]
+            if stage_scores:
+                avg_score = sum(stage_scores) / len(stage_scores)
+                stage_analysis.append({
+                    "name": stage["name"],
+                    "age_range": f"{stage['age_range'][0]}-{stage['age_range'][1]}岁",
+                    "avg_score": round(avg_score, 1),
+                    "is_current": stage["age_range"][0] <= current_age <= stage["age_range"][1]
                 })
-            
-            # 计算默认的当前运势信息
-            current_score = base_score
-            current_label = "平"
-            
-            # 计算5年趋势
-            trend_direction = "平稳"
-            trend_value = 0
-            
-            # 计算人生阶段分析
-            stages = [
-                {"name": "童年", "age_range": (0, 12), "scores": [base_score] * 13},
-                {"name": "青年", "age_range": (13, 30), "scores": [base_score] * 18},
-                {"name": "壮年", "age_range": (31, 50), "scores": [base_score] * 20},
-                {"name": "中年", "age_range": (51, 65), "scores": [base_score] * 15},
-                {"name": "老年", "age_range": (66, 100), "scores": [base_score] * 35}
-            ]
-            
-            stage_analysis = []
-            for stage in stages:
-                stage_scores = stage["scores"]
-                if stage_scores:
-                    avg_score = sum(stage_scores) / len(stage_scores)
-                    stage_analysis.append({
-                        "name": stage["name"],
-                        "age_range": f"{stage['age_range'][0]}-{stage['age_range'][1]}岁",
-                        "avg_score": round(avg_score, 1),
-                        "is_current": stage["age_range"][0] <= current_age <= stage["age_range"][1]
-                    })
-            
-            # 获取当前年份的详细信息
-            current_point = chart_points[current_age] if current_age < len(chart_points) else None
+        
+        # 获取当前年份的详细信息（流年作用关系的规则解读）
+        current_year_detail = None
+        if 0 <= current_age < len(chart_points):
+            facts = year_facts_from_points(chart_points, [], [], bazi_report, current_age)
             current_year_detail = {
-                "age": current_age,
-                "year": current_point["year"] if current_point else birth_year + current_age,
-                "gan_zhi": current_point["gan_zhi"] if current_point else "",
-                "da_yun": current_point["da_yun"] if current_point else "",
-                "score": current_score,
-                "label": current_label,
-                "wealth": "财运一般",
-                "interpersonal": "人际关系平稳",
-                "relationship": "感情稳定",
-                "health": "注意健康",
-                "suitable": "稳步发展",
-                "avoid": "避免冲动"
+                **{key: facts[key] for key in ('age', 'year', 'gan_zhi', 'da_yun', 'score', 'label')},
+                **rule_based_year_narrative(facts)
             }
-            
-            chart_data = {
-                "points": chart_points,
-                "peaks": [],
-                "valleys": [],
-                "current_age": current_age,
-                "current_fortune": {
-                    "score": current_score,
-                    "label": current_label
-                },
-                "trend_5years": {
-                    "direction": trend_direction,
-                    "value": trend_value,
-                    "description": trend_direction
-                },
-                "next_peak": None,
-                "next_valley": None,
-                "stage_analysis": stage_analysis,
-                "current_year_detail": current_year_detail
-            }
-            # 生成更友好的分析文本
-            current_stage_name = '中年'
-            if stage_analysis:
-                for stage in stage_analysis:
-                    if stage.get('is_current'):
-                        current_stage_name = stage['name']
-                        break
-            
-            trend_advice = '保持现状，稳步发展'
-            if trend_direction == '上升':
-                trend_advice = '把握机会，积极进取'
-            elif trend_direction == '下降':
-                trend_advice = '谨慎行事，稳中求进'
-            
-                stage_text = '\n'.join([f'- {stage["name"]}（{stage["age_range"]}）：平均运势{stage["avg_score"]}分' for stage in stage_analysis])
-                
-                analysis_text = f"""基于您的八字和大运分析，整体运势呈现平稳发展态势。
+        
+        chart_data = {
+            "points": chart_points,
+            "peaks": [],
+            "valleys": [],
+            "current_age": current_age,
+            "current_fortune": {
+                "score": current_score,
+                "label": current_label
+            },
+            "trend_5years": {
+                "direction": trend_direction,
+                "value": trend_value,
+                "description": trend_direction
+            },
+            "next_peak": None,
+            "next_valley": None,
+            "stage_analysis": stage_analysis,
+            "current_year_detail": current_year_detail
+        }
+        apply_kline_window(chart_data, *context.get('window', (None, None)))
+        encode_kline_chart_data(chart_data, context.get('format'))
+        # 生成更友好的分析文本
+        current_stage_name = '中年'
+        if stage_analysis:
+            for stage in stage_analysis:
+                if stage.get('is_current'):
+                    current_stage_name = stage['name']
+                    break
+        
+        trend_advice = '保持现状，稳步发展'
+        if trend_direction == '上升':
+            trend_advice = '把握机会，积极进取'
+        elif trend_direction == '下降':
+            trend_advice = '谨慎行事，稳中求进'
+        
+        stage_text = '\n'.join([f'- {stage["name"]}（{stage["age_range"]}）：平均运势{stage["avg_score"]}分' for stage in stage_analysis])
+        
+        analysis_text = f"""基于您的八字和大运分析，整体运势呈现平稳发展态势。
 
 **当前运势（{current_age}岁）**：
 当前处于{current_stage_name}阶段，运势{current_label}，分数为{current_score}分。
 
-**5年趋势**：
-未来5年运势{trend_direction}，建议{trend_advice}。
+**5年趋势**：
+未来5年运势{trend_direction}，建议{trend_advice}。
+
+**人生阶段分析**：
+{stage_text}
+
+**建议**：
+请根据个人实际情况调整人生规划，在运势较好的年份把握机会，在运势较弱的年份谨慎行事，注意健康和安全。
+
+*注：当前数据基于大运推算，如需更详细的分析，请联系专业命理师。*"""
+        
+        # 流式发送分析文本
+        if analysis_text:
+            yield f"data: {json.dumps({'type': 'analysis', 'content': analysis_text}, ensure_ascii=False)}\n\n"
+        
+        # 流式发送完整的图表数据
+        yield f"data: {json.dumps({'type': 'chart_data', 'data': chart_data}, ensure_ascii=False)}\n\n"
+        
+        # 发送完成标记
+        yield f"data: {json.dumps({'type': 'complete', 'data': {'chart_data': chart_data, 'analysis_text': analysis_text, 'bazi_report': bazi_report}}, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+
+def kline_job_stream_id(job_id: str) -> str:
+    """K 线任务对应的 stream_hub 流 ID"""
+    return f"klinejob-{job_id}"
+
+
+def create_kline_job(birth_info: dict) -> str:
+    """创建 K 线后台任务记录，返回任务 ID"""
+    db = SessionLocal()
+    try:
+        job = KLineJob(
+            id=uuid.uuid4().hex,
+            user_id=birth_info.get('user_id'),
+            book_id=birth_info.get('book_id'),
+            status="queued",
+            progress=0,
+            birth_info=json.dumps(birth_info, ensure_ascii=False)
+        )
+        db.add(job)
+        db.commit()
+        return job.id
+    finally:
+        db.close()
+
+
+def update_kline_job(job_id: str, **fields):
+    """更新 K 线任务字段（status / progress / result / error）"""
+    db = SessionLocal()
+    try:
+        job = db.query(KLineJob).filter(KLineJob.id == job_id).first()
+        if not job:
+            return
+        for key, value in fields.items():
+            setattr(job, key, value)
+        job.updated_at = datetime.utcnow()
+        if fields.get('status') in ('completed', 'failed'):
+            job.finished_at = job.updated_at
+        db.commit()
+    finally:
+        db.close()
+
+
+def fail_interrupted_kline_jobs() -> int:
+    """
+    进程启动时把上次运行遗留的 queued / running 任务标记为失败
+    
+    任务只保存在进程内的队列里，重启后不会再被执行；不处理的话轮询和事件接口会一直等待。
+    返回处理的任务数。
+    """
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        count = db.query(KLineJob).filter(KLineJob.status.in_(("queued", "running"))).update(
+            {
+                KLineJob.status: "failed",
+                KLineJob.error: "服务重启，任务已中断，请重新提交",
+                KLineJob.updated_at: now,
+                KLineJob.finished_at: now
+            },
+            synchronize_session=False
+        )
+        db.commit()
+        return count
+    finally:
+        db.close()
+
+
+interrupted_kline_jobs = fail_interrupted_kline_jobs()
+if interrupted_kline_jobs:
+    print(f"⚠️  {interrupted_kline_jobs} 个 K 线任务因服务重启中断，已标记为失败", flush=True)
+
+
+def get_kline_job(job_id: str) -> Optional[dict]:
+    """读取 K 线任务（不存在时返回 None）"""
+    db = SessionLocal()
+    try:
+        job = db.query(KLineJob).filter(KLineJob.id == job_id).first()
+        return job.to_dict() if job else None
+    finally:
+        db.close()
+
+
+def parse_sse_frame(frame: str) -> Optional[dict]:
+    """解析单个 SSE 帧的 data 字段（[DONE] 或非 JSON 返回 None）"""
+    for line in frame.split("\n"):
+        if line.startswith("data: ") and line != "data: [DONE]":
+            try:
+                return json.loads(line[6:])
+            except json.JSONDecodeError:
+                return None
+    return None
+
+
+async def run_kline_job(job_id: str, birth_info: dict):
+    """
+    执行 K 线后台任务（由 kline_job_queue 的 worker 调用）
+    
+    生成过程发布到 stream_hub（流 ID 为 klinejob-{job_id}），供 SSE 订阅者实时接收；
+    进度和最终结果写入 kline_jobs 表，供轮询接口读取。
+    """
+    deadline = request_deadline("kline_job")
+    await asyncio.to_thread(update_kline_job, job_id, status="running")
+    try:
+        context = await prepare_kline_context(birth_info, deadline)
+        session = stream_hub.start(
+            generate_kline_stream(context, deadline),
+            kline_job_stream_id(job_id),
+            STREAM_EXPECTED_TOKENS["kline"]
+        )
+        
+        result = None
+        last_progress = 0
+        async for frame in session.subscribe():
+            event = parse_sse_frame(frame)
+            if not event:
+                continue
+            if event.get('type') == 'progress' and event.get('progress', 0) > last_progress:
+                last_progress = event['progress']
+                await asyncio.to_thread(update_kline_job, job_id, progress=last_progress)
+            elif event.get('type') == 'complete':
+                result = event.get('data')
+        
+        if result:
+            await asyncio.to_thread(
+                update_kline_job, job_id,
+                status="completed",
+                progress=100,
+                result=json.dumps(result, ensure_ascii=False)
+            )
+            print(f"✅ K 线任务 {job_id} 完成", flush=True)
+        else:
+            await asyncio.to_thread(update_kline_job, job_id, status="failed", error="生成中断，未得到 K 线数据")
+    except Exception as e:
+        print(f"❌ K 线任务 {job_id} 失败: {e}", flush=True)
+        await asyncio.to_thread(update_kline_job, job_id, status="failed", error=str(e) or "生成超时")
+
+
+def kline_precompute_stream_id(chart_key: str) -> str:
+    """K 线预计算对应的 stream_hub 流 ID（用户在预计算完成前打开 K 线页时直接订阅）"""
+    return f"klinepre-{chart_key[:32]}"
+
+
+async def precompute_kline_stream(birth_info: dict):
+    """预计算的完整生成过程（排盘 + 后台优先级的 LLM 生成），曲线由 generate_kline_stream 保存"""
+    deadline = request_deadline("kline_job")
+    context = await prepare_kline_context(birth_info, deadline)
+    async for frame in generate_kline_stream(context, deadline, priority=PRIORITY_BACKGROUND,
+                                             slot_tag=kline_precompute_stream_id(context['chart_key'])):
+        yield frame
+
+
+async def run_kline_precompute(birth_info: dict, chart_key: str):
+    """执行 K 线预计算；流在排盘前即注册到 stream_hub，此时打开 K 线页的用户可直接订阅"""
+    session = stream_hub.start(
+        precompute_kline_stream(birth_info),
+        kline_precompute_stream_id(chart_key),
+        STREAM_EXPECTED_TOKENS["kline"],
+        owner=birth_info.get('user_id')
+    )
+    # 预计算自身保持订阅，避免无人观看时被 stream_hub 当作已放弃而中止
+    try:
+        async for _ in session.subscribe():
+            pass
+    finally:
+        llm_scheduler.forget(session.stream_id)
+
+
+async def wait_kline_precompute(session: StreamSession, book_id: int, chart_key: str,
+                                window: Tuple[int, int], deadline: Deadline) -> Optional[dict]:
+    """
+    等待进行中的预计算完成，按请求的年龄窗口读取保存的曲线（预计算失败或超出预算时返回 None）
+    
+    用于带年龄窗口或列式格式的请求：预计算的流推送的是完整的逐条数据，不能直接转发。
+    """
+    async def drain():
+        async for _ in session.subscribe():
+            pass
+    try:
+        await deadline.run(drain(), reserve=DEADLINE_FALLBACK_RESERVE)
+    except asyncio.TimeoutError:
+        return None
+    if session.failed:
+        return None
+    await asyncio.to_thread(copy_kline_curve_by_chart_key, book_id, chart_key)
+    return await asyncio.to_thread(load_kline_curve, book_id, *window)
+
+
+def load_book_birth_info(book_id: int) -> Optional[dict]:
+    """读取命书的出生信息（命书不存在时返回 None）"""
+    db = SessionLocal()
+    try:
+        book = db.query(FortuneBook).filter(FortuneBook.id == book_id).first()
+        return book_birth_info(book) if book else None
+    finally:
+        db.close()
+
+
+async def precompute_kline_for_book(book_id: int):
+    """
+    保存命书后投机预生成 K 线
+    
+    已有曲线时跳过；命盘相同的其他命书已有曲线时直接复制；
+    同一命盘正在预计算时等待该任务完成后复制，不重复调用 LLM。
+    """
+    birth_info = await asyncio.to_thread(load_book_birth_info, book_id)
+    if not birth_info or not compass_client:
+        return
+    if await asyncio.to_thread(load_kline_curve, book_id):
+        return
+    
+    chart_key = kline_chart_key(birth_info)
+    if await asyncio.to_thread(copy_kline_curve_by_chart_key, book_id, chart_key):
+        return
+    
+    task = kline_precompute.schedule(chart_key, lambda: run_kline_precompute(birth_info, chart_key))
+    if not task:
+        return
+    print(f"🔮 命书 {book_id} 的 K 线预计算已开始", flush=True)
+    await asyncio.shield(task)
+    
+    # 同一命盘的预计算由另一本命书发起时，曲线保存在那本命书下
+    if not await asyncio.to_thread(load_kline_curve, book_id):
+        await asyncio.to_thread(copy_kline_curve_by_chart_key, book_id, chart_key)
+
+
+def schedule_kline_precompute(book_id: Optional[int]):
+    """命书保存成功后触发 K 线预计算（需设置 KLINE_PRECOMPUTE_ENABLED=true，默认不执行）"""
+    if book_id:
+        kline_precompute.spawn(precompute_kline_for_book(book_id))
+
+
+@app.post("/api/generate-kline")
+async def generate_kline(
+    request: KLineGenerateRequest,
+    authorization: Optional[str] = Header(None),
+    user_id: Optional[str] = None,
+    stream_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+    payload_format: Optional[str] = Query(None, alias="format")
+):
+    """
+    生成人生K线数据
+    
+    支持两种入参方式：
+    1. 传 book_id：从数据库查询八字信息（需要权限验证，只能使用自己的命书）
+    2. 传 birth_data：直接使用表单数据（无需权限验证）
+    
+    无论哪种方式，最终都调用相同的 LLM Service 逻辑生成K线数据。
+    携带已有的 stream_id 时直接续传该次生成，不重复调用 LLM。
+    
+    整个请求共享一个耗时预算（KLINE_DEADLINE_SECONDS）：排盘、Compass、DeepSeek 依次使用剩余预算，
+    预算耗尽时直接输出基于大运的默认数据。
+    
+    mode=job 时立即返回 202 和 job_id，由后台 worker 生成，
+    通过 GET /api/kline-jobs/{job_id} 轮询或 GET /api/kline-jobs/{job_id}/events 订阅。
+    
+    传 book_id 且该命书已有保存的曲线时直接读库返回（refresh=true 时重新生成并覆盖）。
+    
+    format=columnar 时 chart_data.points 以列式编码返回。
+    
+    stream_id 在生成前即被原子占用：同一 ID 的并发请求只启动一次生成。传 book_id 时流归属当前用户，
+    续传时校验；直接传出生信息的匿名请求不需要鉴权，流也不绑定用户。
+    """
+    validate_stream_id(stream_id)
+    try:
+        window = resolve_window(request.from_age, request.to_age)
+        validate_payload_format(payload_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    owner = get_current_user_id(authorization=authorization, user_id=user_id) if request.book_id else None
+    stream_session, created = stream_hub.reserve(stream_id, owner)
+    if not created:
+        return resume_owned_stream(stream_session, authorization, user_id, last_event_id)
+    
+    deadline = request_deadline("kline")
+    try:
+        birth_info = resolve_kline_birth_info(request, authorization, user_id)
+        
+        # 命书的曲线生成后即持久化，再次打开只需一次读库
+        stored = None
+        if birth_info['book_id'] and not request.refresh:
+            stored = await asyncio.to_thread(load_kline_curve, birth_info['book_id'], *window)
+        if not stored and birth_info['book_id'] and not request.refresh:
+            chart_key = kline_chart_key(birth_info)
+            # 命盘相同的其他命书已有曲线：复制后直接返回
+            if await asyncio.to_thread(copy_kline_curve_by_chart_key, birth_info['book_id'], chart_key):
+                stored = await asyncio.to_thread(load_kline_curve, birth_info['book_id'], *window)
+            # 保存命书时触发的预计算仍在进行：不重复调用 LLM，用户已在等待，预计算提升为交互优先级
+            elif request.mode != 'job':
+                precompute_session = stream_hub.get(kline_precompute_stream_id(chart_key))
+                if precompute_session and not precompute_session.done:
+                    print(f"🔮 命中进行中的 K 线预计算: 命书 {birth_info['book_id']}", flush=True)
+                    llm_scheduler.promote(precompute_session.stream_id, PRIORITY_INTERACTIVE)
+                    # 完整曲线、默认格式：直接订阅预计算的流；否则等它完成后按窗口和格式读库
+                    if window == resolve_window() and payload_format is None:
+                        return resumable_stream_response(precompute_session)
+                    stored = await wait_kline_precompute(
+                        precompute_session, birth_info['book_id'], chart_key, window, deadline
+                    )
+        if stored:
+            print(f"✅ 命中已保存的 K 线曲线: 命书 {birth_info['book_id']}", flush=True)
+            encode_kline_chart_data(stored['chart_data'], payload_format)
+            if request.mode == 'job':
+                job_id = await asyncio.to_thread(create_kline_job, birth_info)
+                await asyncio.to_thread(
+                    update_kline_job, job_id,
+                    status="completed",
+                    progress=100,
+                    result=json.dumps(stored, ensure_ascii=False)
+                )
+                return JSONResponse(status_code=202, content={
+                    "success": True,
+                    "job_id": job_id,
+                    "status": "completed",
+                    "queue_position": None,
+                    "status_url": f"/api/kline-jobs/{job_id}",
+                    "events_url": f"/api/kline-jobs/{job_id}/events"
+                })
+            return StreamingResponse(
+                stream_stored_kline(stored),
+                media_type="text/event-stream",
+                headers={
+                    "Cache-Control": "no-cache",
+                    "Connection": "keep-alive",
+                    "X-Accel-Buffering": "no"
+                }
+            )
+        
+        # K 线生成必须使用真实八字 + LLM，未配置时尽早失败，避免白算
+        if not compass_client:
+            raise HTTPException(
+                status_code=500,
+                detail="Compass API 未配置，无法生成 K 线数据"
+            )
+        
+        if request.mode == 'job':
+            job_id = await asyncio.to_thread(create_kline_job, birth_info)
+            try:
+                kline_job_queue.submit(job_id, lambda: run_kline_job(job_id, birth_info))
+            except asyncio.QueueFull:
+                await asyncio.to_thread(update_kline_job, job_id, status="failed", error="任务队列已满")
+                raise HTTPException(status_code=503, detail="K 线生成任务繁忙，请稍后重试")
+            print(f"📥 K 线任务已入队: {job_id}", flush=True)
+            return JSONResponse(status_code=202, content={
+                "success": True,
+                "job_id": job_id,
+                "status": "queued",
+                "queue_position": kline_job_queue.position(job_id),
+                "status_url": f"/api/kline-jobs/{job_id}",
+                "events_url": f"/api/kline-jobs/{job_id}/events"
+            })
+        
+        context = await prepare_kline_context(birth_info, deadline)
+        # LLM 一次给出整条曲线（完整保存），推送的 points 只取请求的年龄窗口
+        context['window'] = window
+        context['format'] = payload_format
+        
+        # 返回流式响应（生成在后台进行，断线后可凭 stream_id 续传）
+        return resumable_stream_response(stream_hub.start(
+            generate_kline_stream(context, deadline), stream_session.stream_id, STREAM_EXPECTED_TOKENS["kline"]
+        ))
+        
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        print(f"⏰ K 线排盘超出耗时预算", flush=True)
+        raise HTTPException(status_code=504, detail="生成K线数据超时")
+    except Exception as e:
+        print(f"❌ 生成K线数据失败: {str(e)}", flush=True)
+        import traceback
+        print(traceback.format_exc(), flush=True)
+        raise HTTPException(status_code=500, detail=f"生成K线数据失败: {str(e)}")
+    finally:
+        # 未走到生成（读库、任务模式或出错）时释放占用的流 ID
+        stream_hub.release(stream_session)
+
+
+def load_kline_job_for_user(job_id: str, authorization: Optional[str], user_id: Optional[str]) -> dict:
+    """读取 K 线任务并校验归属（基于命书创建的任务只能由命书所有者访问）"""
+    job = get_kline_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    if job['user_id']:
+        current_user_id = get_current_user_id(authorization=authorization, user_id=user_id)
+        if job['user_id'] != current_user_id:
+            raise HTTPException(status_code=403, detail="无权访问：该任务不属于当前用户")
+    return job
+
+
+@app.get("/api/kline/{book_id}")
+async def get_saved_kline(
+    book_id: int,
+    authorization: Optional[str] = Header(None),
+    user_id: Optional[str] = None,
+    from_age: Optional[int] = None,
+    to_age: Optional[int] = None,
+    payload_format: Optional[str] = Query(None, alias="format"),
+    db: Session = Depends(get_db)
+):
+    """
+    读取命书已保存的 K 线
+    
+    返回结构与 /api/generate-kline 的 complete 事件 data 相同；
+    current_age、trend_5years、next_peak、current_year_detail 等随时间变化的字段在读取时计算。
+    传 from_age / to_age 时 points 只含该年龄区间，chart_data.window 为区间统计摘要；
+    format=columnar 时 points 以列式编码返回。
+    尚未生成时返回 404，前端可改调 /api/generate-kline。
+    """
+    try:
+        window = resolve_window(from_age, to_age)
+        validate_payload_format(payload_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    book = db.query(FortuneBook).filter(FortuneBook.id == book_id).first()
+    if not book:
+        raise HTTPException(status_code=404, detail="命书不存在")
+    
+    # 用户权限检查：确保用户只能读取自己的命书
+    current_user_id = get_current_user_id(authorization=authorization, user_id=user_id)
+    if book.user_id != current_user_id:
+        raise HTTPException(status_code=403, detail="无权访问：该命书不属于当前用户")
+    
+    curve = db.query(KLineCurve).filter(KLineCurve.book_id == book_id).first()
+    if not curve:
+        raise HTTPException(status_code=404, detail="该命书尚未生成 K 线")
+    
+    result = kline_curve_to_result(curve, *window)
+    encode_kline_chart_data(result['chart_data'], payload_format)
+    return {
+        "success": True,
+        "data": result
+    }
+
+
+# 流年十神对应的宜忌（LLM 不可用时的规则解读）
+LIU_NIAN_SHI_SHEN_HINTS = {
+    '比肩': ('合作共事、巩固根基', '意气用事、与人争利'),
+    '劫财': ('团队协作、稳守现有', '借贷担保、冲动投资'),
+    '食神': ('学习进修、发挥才艺', '安于享乐、饮食无度'),
+    '伤官': ('创新突破、表达展示', '顶撞上级、口舌是非'),
+    '偏财': ('拓展副业、把握机会', '投机冒进、挥霍无度'),
+    '正财': ('稳健理财、踏实经营', '贪多求快、因财失义'),
+    '七杀': ('迎接挑战、锻炼魄力', '硬碰硬、冒险行事'),
+    '正官': ('求职晋升、建立规矩', '违规越界、消极怠工'),
+    '偏印': ('钻研技术、独立思考', '多疑孤僻、半途而废'),
+    '正印': ('考试深造、寻求贵人', '依赖他人、拖延观望')
+}
+
+YEAR_NARRATIVE_FIELDS = ("summary", "wealth", "interpersonal", "relationship", "health", "suitable", "avoid")
+
+
+def kline_year_label(score: int) -> str:
+    """分数 → 吉 / 平 / 凶（与 current_fortune 一致）"""
+    return "吉" if score >= 70 else ("平" if score >= 50 else "凶")
+
+
+def build_year_facts(curve: KLineCurve, age: int) -> dict:
+    """
+    某一年的确定性数据：K 线数据点 + 流年与原局 / 大运的作用关系
+    
+    Returns:
+        age, year, gan_zhi, da_yun, score, label, is_peak, is_valley, reason, liu_nian
+    """
+    return year_facts_from_points(
+        json.loads(curve.points), json.loads(curve.peaks), json.loads(curve.valleys),
+        json.loads(curve.bazi_report) if curve.bazi_report else None, age
+    )
+
+
+def year_facts_from_points(points: List[Dict], peaks: List[Dict], valleys: List[Dict],
+                           bazi_report: Optional[Dict], age: int) -> dict:
+    """build_year_facts 的实现（生成 K 线时尚未保存曲线，直接使用数据点）"""
+    point = points[age]
+    bazi_report = bazi_report or {}
+    pillars = bazi_report.get('chart', {}).get('si_zhu', {})
+    gods = bazi_report.get('gods', {})
+    
+    reason = None
+    for item in peaks + valleys:
+        if item.get('age') == age and item.get('reason'):
+            reason = item['reason']
+            break
+    
+    return {
+        "age": age,
+        "year": point['year'],
+        "gan_zhi": point['gan_zhi'],
+        "da_yun": point['da_yun'],
+        "score": point['score'],
+        "label": kline_year_label(point['score']),
+        "is_peak": point['is_peak'],
+        "is_valley": point['is_valley'],
+        "reason": reason,
+        "liu_nian": calculator.analyze_liu_nian(
+            pillars, point['gan_zhi'], point['da_yun'],
+            gods.get('useful_gods', []), gods.get('taboo_gods', [])
+        ) if pillars.get('day') else None
+    }
+
+
+def rule_based_year_narrative(facts: dict) -> dict:
+    """LLM 不可用或超时时，按分数和流年十神给出规则解读"""
+    liu_nian = facts.get('liu_nian') or {}
+    label = facts['label']
+    interaction_types = {item['type'] for item in liu_nian.get('interactions', [])}
+    suitable, avoid = LIU_NIAN_SHI_SHEN_HINTS.get(liu_nian.get('gan_shi_shen'), ('稳中求进', '冒进冲动'))
+    
+    summary = f"{facts['year']}年流年{facts['gan_zhi']}"
+    if liu_nian:
+        summary += f"，天干透{liu_nian['gan_shi_shen']}（{liu_nian['gan_effect']}），地支藏{liu_nian['zhi_shi_shen']}（{liu_nian['zhi_effect']}）"
+    summary += f"，整体运势{label}（{facts['score']}分）"
+    if liu_nian.get('tai_sui'):
+        summary += f"，逢{liu_nian['tai_sui']}"
+    
+    return {
+        "summary": summary + "。",
+        "wealth": {"吉": "财运顺遂，可适度进取", "平": "财运平稳，量入为出", "凶": "财运受阻，守财为上"}[label],
+        "interpersonal": "易有口舌摩擦，宜多包容" if '地支六害' in interaction_types or '地支相刑' in interaction_types else "人际和顺，多得助力",
+        "relationship": "感情和合，利于进一步发展" if '地支六合' in interaction_types or '天干五合' in interaction_types else "感情平稳，多加沟通",
+        "health": "奔波变动较多，注意出行与意外" if '地支六冲' in interaction_types or liu_nian.get('tai_sui') == '冲太岁' else "注意作息规律，防止过劳",
+        "suitable": suitable,
+        "avoid": avoid
+    }
+
+
+def load_year_narrative(chart_key: str, age: int) -> Optional[dict]:
+    """读取缓存的流年解读"""
+    db = SessionLocal()
+    try:
+        detail = db.query(KLineYearDetail).filter(KLineYearDetail.id == f"{chart_key}:{age}").first()
+        return json.loads(detail.narrative) if detail else None
+    finally:
+        db.close()
+
+
+def save_year_narrative(chart_key: str, age: int, narrative: dict):
+    """缓存流年解读；并发写入同一条时保留先写入的一条"""
+    db = SessionLocal()
+    try:
+        db.add(KLineYearDetail(
+            id=f"{chart_key}:{age}",
+            chart_key=chart_key,
+            age=age,
+            narrative=json.dumps(narrative, ensure_ascii=False)
+        ))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"⚠️  保存流年解读失败: {e}", flush=True)
+    finally:
+        db.close()
+
+
+async def generate_year_narrative(facts: dict, priority: int, deadline: Deadline,
+                                  slot_tag: Optional[str] = None) -> Optional[dict]:
+    """
+    调用 LLM 生成单一年份的解读（只生成用户查看的年份）
+    
+    排队等待 LLM 槽位的时间也计入耗时预算；slot_tag 供用户查看该年份时提升后台预取的优先级。
+    
+    Returns:
+        解读字典；LLM 未配置、失败或超出预算时返回 None
+    """
+    if not compass_client:
+        return None
+    
+    liu_nian = facts.get('liu_nian') or {}
+    interactions = "；".join(f"{item['target']}{item['detail']}" for item in liu_nian.get('interactions', [])) or "无明显合冲刑害"
+    prompt = f"""根据以下流年数据，为 {facts['year']} 年（{facts['age']} 岁）写一段运势解读，只返回JSON：
+
+流年: {facts['gan_zhi']}（{liu_nian.get('na_yin', '')}），所在大运: {facts['da_yun'] or '未起运'}
+流年十神: 天干{liu_nian.get('gan_shi_shen', '')}（{liu_nian.get('gan_effect', '')}），地支{liu_nian.get('zhi_shi_shen', '')}（{liu_nian.get('zhi_effect', '')}）
+星运: {liu_nian.get('xing_yun', '')}；太岁: {liu_nian.get('tai_sui') or '无'}
+合冲刑害: {interactions}
+K线分数: {facts['score']}（{facts['label']}）{('；' + facts['reason']) if facts.get('reason') else ''}
+
+返回格式（纯JSON，无Markdown，每项20字以内，summary 80字以内）：
+{{"summary": "", "wealth": "", "interpersonal": "", "relationship": "", "health": "", "suitable": "", "avoid": ""}}
+"""
+    async def call():
+        async with llm_scheduler.slot(priority, slot_tag):
+            return await asyncio.to_thread(
+                compass_client.models.generate_content,
+                model="gemini-2.5-flash",
+                contents=prompt,
+                config={"response_mime_type": "application/json"}
+            )
+    
+    try:
+        response = await deadline.run(call(), cap=30.0, reserve=DEADLINE_FALLBACK_RESERVE)
+        data = parse_llm_json_response(getattr(response, 'text', '') or '')
+    except asyncio.TimeoutError:
+        print(f"⏰ 流年解读（{facts['year']}年）超出耗时预算", flush=True)
+        return None
+    except Exception as e:
+        print(f"⚠️  流年解读（{facts['year']}年）生成失败: {e}", flush=True)
+        return None
+    
+    if not data or not data.get('summary'):
+        return None
+    return {field: str(data.get(field, '')) for field in YEAR_NARRATIVE_FIELDS}
+
 
-**人生阶段分析**：
-{stage_text}
+def year_prefetch_key(chart_key: str, age: int) -> str:
+    """相邻年份预取的 key（同时作为 LLM 槽位的 tag）"""
+    return f"{chart_key}:{age}"
 
-**建议**：
-请根据个人实际情况调整人生规划，在运势较好的年份把握机会，在运势较弱的年份谨慎行事，注意健康和安全。
 
-*注：当前数据基于大运推算，如需更详细的分析，请联系专业命理师。*"""
-                
-                # 流式发送分析文本
-                if analysis_text:
-                    yield f"data: {json.dumps({'type': 'analysis', 'content': analysis_text}, ensure_ascii=False)}\n\n"
-                
-                # 流式发送完整的图表数据
-                yield f"data: {json.dumps({'type': 'chart_data', 'data': chart_data}, ensure_ascii=False)}\n\n"
-                
-                # 发送完成标记
-                yield f"data: {json.dumps({'type': 'complete', 'data': {'chart_data': chart_data, 'analysis_text': analysis_text, 'bazi_report': bazi_report}}, ensure_ascii=False)}\n\n"
-                yield "data: [DONE]\n\n"
-        
-        # 返回流式响应
-        return StreamingResponse(
-            generate_kline_stream(),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no"
-            }
+async def prefetch_year_narrative(facts: dict, chart_key: str, age: int):
+    """以后台优先级生成并缓存相邻年份的解读（用户点开该年份时提升为交互优先级）"""
+    slot_tag = year_prefetch_key(chart_key, age)
+    try:
+        if await asyncio.to_thread(load_year_narrative, chart_key, age):
+            return
+        narrative = await generate_year_narrative(
+            facts, PRIORITY_BACKGROUND, request_deadline("kline_year"), slot_tag=slot_tag
         )
+        if narrative:
+            await asyncio.to_thread(save_year_narrative, chart_key, age, narrative)
+    finally:
+        llm_scheduler.forget(slot_tag)
+
+
+@app.get("/api/kline/{book_id}/years/{age}")
+async def get_kline_year_detail(
+    book_id: int,
+    age: int,
+    authorization: Optional[str] = Header(None),
+    user_id: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    K 线某一年的详情（点击 YearDetailCard 时调用）
+    
+    流年十神、合冲刑害等按规则即时计算；文字解读只为被查看的年份调用 LLM 生成，
+    按命盘 + 年龄缓存，并在后台预取前后相邻年份。该年份的预取仍在排队时提升为交互优先级并在预算内等待。
+    LLM 不可用或超出预算（KLINE_YEAR_DEADLINE_SECONDS）时返回规则解读（narrative_source=rule，不缓存）。
+    """
+    if not 0 <= age <= 100:
+        raise HTTPException(status_code=400, detail="age 必须在 0-100 之间")
+    
+    book = db.query(FortuneBook).filter(FortuneBook.id == book_id).first()
+    if not book:
+        raise HTTPException(status_code=404, detail="命书不存在")
+    
+    # 用户权限检查：确保用户只能读取自己的命书
+    current_user_id = get_current_user_id(authorization=authorization, user_id=user_id)
+    if book.user_id != current_user_id:
+        raise HTTPException(status_code=403, detail="无权访问：该命书不属于当前用户")
+    
+    curve = db.query(KLineCurve).filter(KLineCurve.book_id == book_id).first()
+    if not curve:
+        raise HTTPException(status_code=404, detail="该命书尚未生成 K 线")
+    
+    chart_key = curve.chart_key or kline_chart_key(book_birth_info(book))
+    facts = build_year_facts(curve, age)
+    
+    deadline = request_deadline("kline_year")
+    narrative = await asyncio.to_thread(load_year_narrative, chart_key, age)
+    narrative_source = "cache"
+    timed_out = False
+    if not narrative:
+        # 相邻年份预取正在生成这一年：提升为交互优先级，在预算内等待其完成
+        pending = kline_year_prefetch.running(year_prefetch_key(chart_key, age))
+        if pending:
+            llm_scheduler.promote(year_prefetch_key(chart_key, age), PRIORITY_INTERACTIVE)
+            try:
+                await deadline.run(asyncio.shield(pending), reserve=DEADLINE_FALLBACK_RESERVE)
+                narrative = await asyncio.to_thread(load_year_narrative, chart_key, age)
+            except asyncio.TimeoutError:
+                print(f"⏰ 等待流年解读预取（{facts['year']}年）超出耗时预算", flush=True)
+                timed_out = True
+    if not narrative and not timed_out:
+        narrative = await generate_year_narrative(facts, PRIORITY_INTERACTIVE, deadline)
+        narrative_source = "llm"
+        if narrative:
+            await asyncio.to_thread(save_year_narrative, chart_key, age, narrative)
+    if not narrative:
+        narrative = rule_based_year_narrative(facts)
+        narrative_source = "rule"
+    
+    # 用户往往会接着查看前后一年
+    for adjacent_age in (age - 1, age + 1):
+        if not 0 <= adjacent_age <= 100 or kline_year_prefetch.running(year_prefetch_key(chart_key, adjacent_age)):
+            continue
+        if not await asyncio.to_thread(load_year_narrative, chart_key, adjacent_age):
+            adjacent_facts = build_year_facts(curve, adjacent_age)
+            kline_year_prefetch.schedule(
+                year_prefetch_key(chart_key, adjacent_age),
+                lambda adjacent_facts=adjacent_facts, adjacent_age=adjacent_age: prefetch_year_narrative(
+                    adjacent_facts, chart_key, adjacent_age
+                ),
+                owner=current_user_id
+            )
+    
+    return {
+        "success": True,
+        "data": {
+            **facts,
+            "narrative": narrative,
+            "narrative_source": narrative_source
+        }
+    }
+
+
+@app.get("/api/kline-jobs/{job_id}")
+async def get_kline_job_status(
+    job_id: str,
+    authorization: Optional[str] = Header(None),
+    user_id: Optional[str] = None
+):
+    """
+    查询 K 线后台任务
+    
+    status: queued / running / completed / failed；completed 时 result 为 complete 事件的 data
+    """
+    job = await asyncio.to_thread(load_kline_job_for_user, job_id, authorization, user_id)
+    job['queue_position'] = kline_job_queue.position(job_id)
+    return {
+        "success": True,
+        "data": job
+    }
+
+
+async def stream_kline_job_events(job_id: str, last_event_id: Optional[str]):
+    """
+    K 线任务事件流
+    
+    任务执行中（或刚结束、仍在回放缓冲期内）时直接订阅 stream_hub；
+    排队中推送 job 状态事件并等待；已结束且缓冲过期时从数据库补发 complete / error 事件。
+    """
+    announced_status = None
+    while True:
+        session = stream_hub.get(kline_job_stream_id(job_id))
+        if session:
+            async for frame in session.subscribe(parse_last_event_id(last_event_id)):
+                yield frame
+            return
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"❌ 生成K线数据失败: {str(e)}", flush=True)
-        import traceback
-        print(traceback.format_exc(), flush=True)
-        raise HTTPException(status_code=500, detail=f"生成K线数据失败: {str(e)}")
+        job = await asyncio.to_thread(get_kline_job, job_id)
+        if not job:
+            yield "data: " + json.dumps({"type": "error", "content": "任务不存在"}, ensure_ascii=False) + "\n\n"
+            return
+        if job['status'] == 'completed':
+            yield "data: " + json.dumps({"type": "complete", "data": job['result']}, ensure_ascii=False) + "\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        if job['status'] == 'failed':
+            yield "data: " + json.dumps({"type": "error", "content": job['error']}, ensure_ascii=False) + "\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        if job['status'] != announced_status:
+            announced_status = job['status']
+            yield "data: " + json.dumps({
+                "type": "job",
+                "status": job['status'],
+                "queue_position": kline_job_queue.position(job_id)
+            }, ensure_ascii=False) + "\n\n"
+        await asyncio.sleep(1.0)
+
+
+@app.get("/api/kline-jobs/{job_id}/events")
+async def kline_job_events(
+    job_id: str,
+    authorization: Optional[str] = Header(None),
+    user_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None)
+):
+    """
+    订阅 K 线后台任务（SSE）
+    
+    事件与 /api/generate-kline 的流式响应相同，排队期间额外推送 {"type": "job", "status": "queued"}
+    """
+    await asyncio.to_thread(load_kline_job_for_user, job_id, authorization, user_id)
+    return StreamingResponse(
+        stream_kline_job_events(job_id, last_event_id),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
 
 
 class LifeLineRequest(BaseModel):
@@ -2279,6 +3678,8 @@ class LifeLineRequest(BaseModel):
     lat: float = Field(..., description="纬度")
     gender: str = Field(..., description="性别（male/female 或 男/女）")
     name: Optional[str] = Field("用户", description="姓名，默认为'用户'")
+    from_age: Optional[int] = Field(None, ge=0, le=100, description="只返回从该年龄开始的数据点（默认 0）")
+    to_age: Optional[int] = Field(None, ge=0, le=100, description="只返回到该年龄为止的数据点（默认 100）")
     
     @field_validator('gender')
     @classmethod
@@ -2317,6 +3718,7 @@ class DivinationRequest(BaseModel):
     lng: Optional[float] = Field(None, description="经度（阶段2和3需要）")
     city: Optional[str] = Field(None, description="出生地（阶段2和3需要）")
     name: Optional[str] = Field("有缘人", description="姓名")
+    mode: Optional[str] = Field(None, description="生成模式：sections（analysis 阶段分板块并发生成），默认单次生成")
     
     @field_validator('stage')
     @classmethod
@@ -2325,31 +3727,35 @@ class DivinationRequest(BaseModel):
         if v not in ['greeting', 'analysis', 'dayun']:
             raise ValueError('阶段必须是 greeting、analysis 或 dayun')
         return v
-
-
-class DivinationRequest(BaseModel):
-    """起卦请求模型"""
-    stage: str = Field(..., description="阶段：greeting（初始接待）、analysis（正式排盘）、dayun（大运推演）")
-    user_input: Optional[str] = Field(None, description="用户输入（生辰信息或'起大运'）")
-    birth_date: Optional[str] = Field(None, description="出生日期 YYYY-MM-DD（阶段2和3需要）")
-    birth_time: Optional[str] = Field(None, description="出生时间 HH:MM（阶段2和3需要）")
-    gender: Optional[str] = Field(None, description="性别（阶段2和3需要）")
-    lat: Optional[float] = Field(None, description="纬度（阶段2和3需要）")
-    lng: Optional[float] = Field(None, description="经度（阶段2和3需要）")
-    city: Optional[str] = Field(None, description="出生地（阶段2和3需要）")
-    name: Optional[str] = Field("有缘人", description="姓名")
     
-    @field_validator('stage')
+    @field_validator('mode')
     @classmethod
-    def validate_stage(cls, v):
-        """验证阶段字段"""
-        if v not in ['greeting', 'analysis', 'dayun']:
-            raise ValueError('阶段必须是 greeting、analysis 或 dayun')
+    def validate_mode(cls, v):
+        """验证生成模式"""
+        if v is not None and v != 'sections':
+            raise ValueError('mode 只支持 sections')
         return v
 
 
+def life_curve_response(result, payload_format: Optional[str] = None) -> Response:
+    """
+    人生 K 线响应：{"success": true, "data": ...}
+    
+    默认格式直接由 Pydantic 序列化为 JSON 字节（不经过 dict 和 jsonable_encoder）；
+    format=columnar 时 chart_data 以列式编码返回。
+    """
+    if payload_format == "columnar":
+        data = result.model_dump()
+        data["chart_data"] = to_columnar(data["chart_data"])
+        return JSONResponse(content={"success": True, "data": data})
+    return Response(
+        content=b'{"success":true,"data":' + result.model_dump_json().encode("utf-8") + b'}',
+        media_type="application/json"
+    )
+
+
 @app.post("/api/divination/life-line")
-async def generate_life_line(request: LifeLineRequest):
+async def generate_life_line(request: LifeLineRequest, payload_format: Optional[str] = Query(None, alias="format")):
     """
     生成人生 K 线数据
     
@@ -2359,11 +3765,23 @@ async def generate_life_line(request: LifeLineRequest):
     - user_profile: 用户信息（name, bazi）
     - chart_data: 0-100岁的数据列表（101个数据点）
     - summary: 总结信息（current_score, trend, peaks, valleys, advice）
+    - window: 年龄窗口的统计摘要
+    
+    传 from_age / to_age 时只逐年计算并返回该区间的数据点（如移动端一次取 10 年），
+    summary 仍为整条曲线的总结。format=columnar 时 chart_data 以列式编码返回。
     
     异常处理：
     - 如果 AI 返回的 JSON 解析失败或数组长度不够，使用默认值（score=60）填充
-    - 确保接口永远返回合法的 101 条数据，防止前端白屏
+    - 确保接口永远返回窗口内完整的数据（默认 101 条），防止前端白屏
+    - 超出耗时预算（LIFELINE_DEADLINE_SECONDS）时同样返回默认值
     """
+    deadline = request_deadline("lifeline")
+    try:
+        window_start, window_end = resolve_window(request.from_age, request.to_age)
+        validate_payload_format(payload_format)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=f"数据验证失败: {str(ve)}")
+    window_size = window_end - window_start + 1
     try:
         # 1. 格式化出生日期和时间
         birth_date = f"{request.year}-{request.month:02d}-{request.day:02d}"
@@ -2393,22 +3811,25 @@ async def generate_life_line(request: LifeLineRequest):
                 lng=request.lng,
                 lat=request.lat,
                 gender=request.gender,
-                name=request.name or "用户"
+                name=request.name or "用户",
+                deadline=deadline,
+                from_age=window_start,
+                to_age=window_end
             )
             
             # 3. 验证并修复数据
             chart_data = result.chart_data
             
-            # 确保有 101 个数据点（0-100岁）
-            if len(chart_data) < 101:
-                print(f"⚠️  数据点不足 101 个，当前有 {len(chart_data)} 个，使用默认值填充", flush=True)
+            # 确保窗口内每个年龄都有数据点（默认 0-100 岁共 101 个）
+            if len(chart_data) < window_size:
+                print(f"⚠️  数据点不足 {window_size} 个，当前有 {len(chart_data)} 个，使用默认值填充", flush=True)
                 # 使用默认值填充缺失的数据点
                 from schemas import ChartDataPoint
                 default_data = []
                 birth_year = request.year
-                for age in range(101):
-                    if age < len(chart_data):
-                        default_data.append(chart_data[age])
+                for offset, age in enumerate(range(window_start, window_end + 1)):
+                    if offset < len(chart_data):
+                        default_data.append(chart_data[offset])
                     else:
                         # 创建默认数据点
                         default_data.append(ChartDataPoint(
@@ -2424,22 +3845,15 @@ async def generate_life_line(request: LifeLineRequest):
                         ))
                 chart_data = default_data
             
-            # 验证每个数据点的分数是否在有效范围内
-            for i, point in enumerate(chart_data):
-                if not (0 <= point.score <= 100):
-                    print(f"⚠️  数据点 {i} 的分数 {point.score} 超出范围，修正为 60", flush=True)
-                    point.score = 60
+            # 分数范围已在 LifeLineService 中对整条数组统一校验（超出 0-100 记为 60）
             
             # 4. 更新 result 对象
             result.chart_data = chart_data
             
             print(f"✅ 人生 K 线生成成功，返回 {len(chart_data)} 个数据点", flush=True)
             
-            # 5. 返回数据（转换为字典，包装成前端期望的格式）
-            return {
-                "success": True,
-                "data": result.dict()
-            }
+            # 5. 返回数据（直接序列化为 JSON，包装成前端期望的格式）
+            return life_curve_response(result, payload_format)
             
         except ValueError as ve:
             # 数据验证错误
@@ -2487,6 +3901,9 @@ async def generate_life_line(request: LifeLineRequest):
                 base_score = 60
                 variation = random.randint(-2, 5)  # 轻微波动
                 score = max(55, min(70, base_score + variation))
+                # 整条曲线照常抽样，窗口内外的分数与完整请求一致
+                if not window_start <= age <= window_end:
+                    continue
                 
                 default_chart_data.append(ChartDataPoint(
                     age=age,
@@ -2513,14 +3930,15 @@ async def generate_life_line(request: LifeLineRequest):
                     "peaks": [],
                     "valleys": [],
                     "advice": "AI 服务暂时不可用，当前显示为默认数据。请稍后重试或联系管理员。"
-                }
+                },
+                window=summarize_window(
+                    ((point.age, point.score) for point in default_chart_data),
+                    window_start, window_end
+                )
             )
             
             print(f"✅ 返回兜底数据（Mock），共 {len(default_chart_data)} 个数据点", flush=True)
-            return {
-                "success": True,
-                "data": default_response.dict()
-            }
+            return life_curve_response(default_response, payload_format)
     
     except HTTPException:
         raise
@@ -2536,56 +3954,430 @@ async def health_check():
     """健康检查"""
     return {
         "status": "healthy",
-        "compass_configured": compass_client is not None
+        "compass_configured": compass_client is not None,
+        "streams": stream_hub.stats(),
+        "llm_slots": llm_scheduler.stats(),
+        "kline_jobs": kline_job_queue.stats(),
+        "kline_precompute": kline_precompute.stats(),
+        "kline_year_prefetch": kline_year_prefetch.stats(),
+        "chat_prefetch": chat_tab_prefetch.stats(),
+        "chat_sessions": chat_session_store.stats(),
+        "chat_context": chat_context.stats(),
+        "prompt_cache": prompt_cache.stats(),
+        "knowledge": faq_index.stats(),
+        "chart_codec": chart_codec.stats(),
+        "intent_router": intent_router.stats(),
+        "ziwei": ziwei_cache_stats()
     }
 
 
 class ChatDivinationRequest(BaseModel):
     """起卦对话请求模型（有状态版本）"""
-    messages: List[Dict[str, str]] = Field(..., description="对话历史记录，格式：[{'role': 'user', 'content': '...'}, {'role': 'assistant', 'content': '...'}, ...]，最后一条必须是用户消息")
+    messages: Optional[List[Dict[str, str]]] = Field(None, description="对话历史记录，格式：[{'role': 'user', 'content': '...'}, {'role': 'assistant', 'content': '...'}, ...]，最后一条必须是用户消息（使用服务端会话时不传）")
+    session_id: Optional[str] = Field(None, description="服务端会话ID（传入时只需发送 message，历史由服务端保存）")
+    message: Optional[str] = Field(None, description="本轮用户消息（不传 messages 时使用；不带 session_id 时创建新会话）")
     bazi_data: Optional[Dict] = Field(None, description="八字排盘数据（可选，如果前端已通过表单提交）")
+    prefetch_tabs: Optional[bool] = Field(False, description="首次回答完成后是否在后台预取各 tab（起大运、看事业等）的回答")
+
+
+# 首次回答后前端提供的快捷追问（顺序决定预取流 ID 的编号）
+CHAT_TABS = ["起大运", "看事业", "看姻缘", "看财运", "看健康", "详细分析"]
+
+BEIJING_TZ = ZoneInfo("Asia/Shanghai")
+
+
+def beijing_now() -> datetime:
+    """当前北京时间（不带时区）；起卦时刻按北京时间排盘，与服务器所在时区无关（容器默认 UTC）"""
+    return datetime.now(BEIJING_TZ).replace(tzinfo=None)
+
+
+def build_divination_facts(content: str, moment: Optional[datetime] = None, allow_bare_numbers: bool = False) -> str:
+    """
+    单一事件起卦的确定性排盘，模型只负责解读
+    
+    - 小六壬：按起卦时刻的农历月、日、时辰起课（见 services/xiaoliuren.py），不需要用户提供任何信息
+    - 奇门遁甲：按起卦时刻排时家奇门盘（见 services/qimen.py），同样只看时刻
+    - 梅花易数：用户给出三个数字时按三数起卦（见 services/meihua.py），没有数字时不附
+    
+    Args:
+        content: 用户消息
+        moment: 起卦时刻（北京时间，默认当前北京时间；带时区的时刻先换算为北京时间）
+        allow_bare_numbers: 本条消息是在回答“请提供三个数字”，不带“数字”提示的三个数也用来起卦
+    
+    Returns:
+        注入提示词的起卦结果（小六壬、奇门盘，有数字时再加梅花易数卦）
+    """
+    if moment is None:
+        moment = beijing_now()
+    elif moment.tzinfo:
+        moment = moment.astimezone(BEIJING_TZ).replace(tzinfo=None)
+    lesson = liuren_by_time(moment, calculator)
+    plate = qimen_plate(moment, calculator)
+    blocks = [
+        f"【小六壬排盘（后端已按农历月日时算出，请直接解读，不要重新掐算）】\n{format_liuren(lesson)}",
+        f"【奇门遁甲盘（后端已按起卦时刻排出，每宫为 八神 九星 八门 天盘/地盘，请直接解读，不要重新排盘）】\n{format_qimen(plate)}"
+    ]
+    numbers = extract_numbers(content, allow_bare=allow_bare_numbers)
+    summary = f"小六壬: {lesson['result']['name']}；奇门: {plate['jie_qi']}{plate['yuan']}{plate['dun']}{plate['ju']}局"
+    if numbers:
+        cast = cast_by_numbers(*numbers)
+        blocks.insert(0, f"【梅花易数排盘（后端已按三数起卦法算出，请直接解读，不要重新起卦）】\n{format_cast(cast)}")
+        summary = f"梅花易数起卦: {numbers} → {cast['primary']['name']} 之 {cast['changed']['name']}，{cast['relation']}；{summary}"
+    print(f"☯️  {summary}", flush=True)
+    return "\n\n".join(blocks)
+
+
+def build_ziwei_facts(bazi_report: Optional[Dict], gender: Optional[str] = None) -> str:
+    """
+    紫微斗数命盘事实（按真太阳时查表排盘，见 services/ziwei.py）
+    
+    Args:
+        bazi_report: 八字排盘数据（需含 true_solar_time）
+        gender: 性别，未提供时取 bazi_report 中的 gender；仍未知则不排大限
+    
+    Returns:
+        注入提示词的紫微命盘；缺少出生时间或排盘失败时返回空字符串
+    """
+    birth_time = (bazi_report or {}).get('true_solar_time')
+    if not birth_time:
+        return ""
+    try:
+        moment = datetime.strptime(birth_time, "%Y-%m-%d %H:%M:%S")
+        chart = ziwei_chart(moment, calculator, gender or bazi_report.get('gender'))
+    except Exception as e:
+        print(f"⚠️  紫微斗数排盘失败: {e}", flush=True)
+        return ""
+    return f"【紫微斗数命盘（后端已按真太阳时排出，请直接引用，不要重新安星）】\n{format_ziwei(chart)}"
+
+
+def build_tab_instruction(tab_type: str) -> str:
+    """tab 追问的隐藏指令（防止重复排盘，并注入当前时间）"""
+    now = datetime.now()
+    current_year = now.year
+    current_datetime_str = f"{now.year}年{now.month}月{now.day}日{now.hour}点{now.minute}分"
+    return f"用户基于已有的排盘信息请求详解【{tab_type}】板块。请勿重复排盘，直接根据上下文输出深度分析（≥300字）。\n\n【重要时间信息】当前时间是：{current_datetime_str}（北京时间）。当前年份是：{current_year}年。所有涉及年份的分析必须基于当前年份（{current_year}年）进行计算，严禁使用过时的年份（如2023、2024、2025等）。当用户问'明年'时，指的是{current_year + 1}年；问'后年'时，指的是{current_year + 2}年。"
+
+
+def chat_history_key(messages: List[Dict[str, str]]) -> str:
+    """对话历史指纹（前端回传的历史与预取时使用的历史一致时命中）"""
+    normalized = [[m.get("role", "user"), (m.get("content") or "").strip()] for m in messages]
+    return hashlib.sha1(json.dumps(normalized, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def chat_tab_stream_id(history_key: str, tab_type: str) -> str:
+    """预取回答对应的 stream_hub 流 ID"""
+    return f"chattab-{history_key[:40]}-{CHAT_TABS.index(tab_type)}"
+
+
+async def generate_chat_tab_answer(history_messages: List[Dict[str, str]], tab_type: str,
+                                   slot_tag: Optional[str] = None):
+    """
+    以后台优先级生成某个 tab 的回答（与用户点击 tab 时的后续对话请求一致）
+    
+    slot_tag 为预取流 ID：用户点击该 tab 时按它把排队中的生成提升为交互优先级。
+    失败时直接抛出，由 stream_hub 标记为 failed，点击时不再复用。
+    """
+    deadline = request_deadline("chat")
+    genai_history = [
+        {
+            "role": "model" if msg.get("role") == "assistant" else "user",
+            "parts": [{"text": msg.get("content", "")}]
+        }
+        for msg in history_messages
+    ]
+    chat = await asyncio.to_thread(compass_client.chats.create, model="gemini-2.5-flash", history=genai_history)
+    stream = await asyncio.to_thread(
+        chat.send_message, f"{build_tab_instruction(tab_type)}\n\n用户问题：{tab_type}", stream=True
+    )
+    
+    full_text = ""
+    async for chunk in iter_sync_stream(stream, priority=PRIORITY_BACKGROUND, deadline=deadline, slot_tag=slot_tag):
+        chunk_text = ""
+        if hasattr(chunk, 'text'):
+            chunk_text = chunk.text
+        elif hasattr(chunk, 'candidates') and chunk.candidates:
+            if hasattr(chunk.candidates[0], 'content'):
+                if hasattr(chunk.candidates[0].content, 'parts'):
+                    for part in chunk.candidates[0].content.parts:
+                        if hasattr(part, 'text'):
+                            chunk_text += part.text
+        
+        if chunk_text:
+            full_text += chunk_text
+            yield f"data: {json.dumps({'type': 'text', 'content': chunk_text}, ensure_ascii=False)}\n\n"
+    
+    yield "data: [DONE]\n\n"
+    print(f"⚡ 【{tab_type}】预取完成，总长度: {len(full_text)} 字符", flush=True)
+
+
+async def run_chat_tab_prefetch(history_messages: List[Dict[str, str]], tab_type: str, prefetch_stream_id: str,
+                                owner: Optional[str] = None):
+    """执行一个 tab 的预取；自身保持订阅，避免无人观看时被 stream_hub 中止"""
+    session = stream_hub.start(
+        generate_chat_tab_answer(history_messages, tab_type, slot_tag=prefetch_stream_id),
+        prefetch_stream_id,
+        STREAM_EXPECTED_TOKENS["chat"],
+        owner=owner
+    )
+    try:
+        async for _ in session.subscribe():
+            pass
+    finally:
+        llm_scheduler.forget(prefetch_stream_id)
+
+
+def start_chat_tab_prefetch(history_messages: List[Dict[str, str]], owner: str):
+    """首次回答完成后并发预取全部 tab 的回答（每个 tab 计入一次用户预算）"""
+    history_key = chat_history_key(history_messages)
+    for tab_type in CHAT_TABS:
+        prefetch_stream_id = chat_tab_stream_id(history_key, tab_type)
+        if stream_hub.get(prefetch_stream_id):
+            continue
+        chat_tab_prefetch.schedule(
+            prefetch_stream_id,
+            lambda tab_type=tab_type, prefetch_stream_id=prefetch_stream_id: run_chat_tab_prefetch(
+                history_messages, tab_type, prefetch_stream_id, owner
+            ),
+            owner=owner
+        )
+
+
+def create_chat_session_record(user_id: str, messages: List[Dict[str, str]], bazi_data: Optional[Dict]) -> dict:
+    """创建对话会话记录，返回会话状态"""
+    db = SessionLocal()
+    try:
+        record = ChatSession(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            messages=json.dumps(messages, ensure_ascii=False),
+            bazi_data=json.dumps(bazi_data, ensure_ascii=False) if bazi_data else None
+        )
+        db.add(record)
+        db.commit()
+        return record.to_dict()
+    finally:
+        db.close()
+
+
+def load_chat_session_record(session_id: str) -> Optional[dict]:
+    """从数据库读取对话会话（不存在时返回 None）"""
+    db = SessionLocal()
+    try:
+        record = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+        return record.to_dict() if record else None
+    finally:
+        db.close()
+
+
+def save_chat_session_messages(session_id: str, messages: List[Dict[str, str]]):
+    """保存对话历史；失败只记录日志（热缓存中的历史仍然可用）"""
+    db = SessionLocal()
+    try:
+        record = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+        if not record:
+            return
+        record.messages = json.dumps(messages, ensure_ascii=False)
+        record.updated_at = datetime.utcnow()
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"⚠️  保存对话会话失败: {e}", flush=True)
+    finally:
+        db.close()
+
+
+async def get_chat_session(session_id: str, owner: str) -> dict:
+    """读取对话会话（先查热缓存，未命中再读库）并校验归属"""
+    state = chat_session_store.get(session_id)
+    if state is None:
+        state = await asyncio.to_thread(load_chat_session_record, session_id)
+        if state is None:
+            raise HTTPException(status_code=404, detail="会话不存在或已过期")
+        chat_session_store.put(session_id, state)
+    if state['user_id'] != owner:
+        raise HTTPException(status_code=403, detail="无权访问：该会话不属于当前用户")
+    return state
+
+
+async def append_chat_turn(session_id: str, turn: List[Dict[str, str]]):
+    """把一轮问答追加到会话历史（热缓存立即可见，同时写库）"""
+    state = chat_session_store.append(session_id, turn)
+    if state is None:
+        state = await asyncio.to_thread(load_chat_session_record, session_id)
+        if state is None:
+            return
+        state['messages'].extend(turn)
+        chat_session_store.put(session_id, state)
+    await asyncio.to_thread(save_chat_session_messages, session_id, list(state['messages']))
+
+
+async def record_prefetched_chat_turn(session: StreamSession, chat_session_id: str, user_message: Dict[str, str]):
+    """命中预取的回答时，等预取生成完后把这一轮记入服务端会话"""
+    full_text = ""
+    async for frame in session.subscribe():
+        payload = frame.split("data: ", 1)[-1].strip()
+        if payload.startswith("{"):
+            event = json.loads(payload)
+            if event.get('type') == 'text':
+                full_text += event.get('content', '')
+    if full_text and not session.failed:
+        await append_chat_turn(chat_session_id, [user_message, {"role": "assistant", "content": full_text}])
+
+
+async def summarize_chat_turns(previous_summary: Optional[str], turns: List[Dict[str, str]]) -> Optional[str]:
+    """
+    把较早的对话轮次折叠进滚动摘要（后台优先级，不占用用户请求的耗时）
+    
+    Returns:
+        新摘要；LLM 未配置、失败或超出预算时返回 None（下次请求重试）
+    """
+    if not compass_client:
+        return None
+    deadline = request_deadline("chat_summary")
+    dialogue = "\n\n".join(
+        f"{'助手' if msg.get('role') == 'assistant' else '用户'}：{msg.get('content', '')}" for msg in turns
+    )
+    prompt = f"""以下是一段命理咨询对话的较早部分，请更新对话摘要，供后续回答参考。
+
+已有摘要：{previous_summary or '无'}
+
+新增对话：
+{dialogue}
+
+要求：保留用户关心的问题、已经给出的关键判断（涉及的年份、大运、流年、建议）和用户补充的个人信息，不复述排盘过程；只输出摘要正文，300字以内。
+"""
+    try:
+        async with llm_scheduler.slot(PRIORITY_BACKGROUND):
+            response = await deadline.run(asyncio.to_thread(
+                compass_client.models.generate_content,
+                model="gemini-2.5-flash",
+                contents=prompt
+            ), cap=30.0)
+    except asyncio.TimeoutError:
+        print(f"⏰ 对话摘要超出耗时预算", flush=True)
+        return None
+    summary = (getattr(response, 'text', '') or '').strip()
+    if summary:
+        print(f"📝 对话摘要已更新（折叠 {len(turns)} 条消息，摘要 {len(summary)} 字）", flush=True)
+    return summary or None
+
+
+def with_chat_session_header(response: StreamingResponse, chat_session_id: Optional[str]) -> StreamingResponse:
+    """在响应头中返回服务端会话ID"""
+    if chat_session_id:
+        response.headers["X-Chat-Session-Id"] = chat_session_id
+    return response
+
+
+@app.get("/api/chat/sessions/{session_id}")
+async def get_chat_session_history(
+    session_id: str,
+    authorization: Optional[str] = Header(None),
+    user_id: Optional[str] = None
+):
+    """读取服务端保存的对话历史（需为会话所有者）"""
+    owner = get_current_user_id(authorization=authorization, user_id=user_id)
+    state = await get_chat_session(session_id, owner)
+    return {
+        "success": True,
+        "data": {
+            "session_id": session_id,
+            "messages": state['messages'],
+            "bazi_data": state.get('bazi_data')
+        }
+    }
 
 
 @app.post("/api/chat/divination")
-async def chat_divination(request: ChatDivinationRequest):
+async def chat_divination(
+    request: ChatDivinationRequest,
+    stream_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+    authorization: Optional[str] = Header(None),
+    user_id: Optional[str] = None
+):
     """
     起卦对话接口（有状态版本）
     
     处理算命逻辑的对话式接口，支持上下文管理。
     
     Args:
-        request: 包含 messages（对话历史，包含 role 和 content）和 bazi_data（八字数据）
+        request: 包含 messages（对话历史，包含 role 和 content）和 bazi_data（八字数据）；
+                 或 session_id + message（服务端会话，只发送本轮消息）
+        stream_id: 已有流的 ID（断线重连时携带，直接续传，不重复调用 LLM）
+        last_event_id: 客户端已收到的最后一个事件编号
+        authorization / user_id: 当前用户（会话归属、tab 预取的每日预算）
     
     Returns:
         流式返回 AI 回复
+    
+    只传 message（不带 messages / session_id）时创建服务端会话，会话ID 通过首个
+    {"type": "session"} 事件和 X-Chat-Session-Id 响应头返回；之后每轮传 session_id + message，
+    回答完成后服务端把本轮问答追加到会话历史。
+    
+    prefetch_tabs=true 时，首次回答完成后在后台并发生成各 tab 的回答；
+    之后点击 tab（历史与首次回答一致）直接订阅预取结果，无需等待重新生成。
+    
+    stream_id 在读取会话前即被原子占用：同一 ID 的并发请求只启动一次生成。使用服务端会话时流归属当前用户，
+    续传时校验；直接传 messages 的匿名对话不需要鉴权，流也不绑定用户。
     """
+    validate_stream_id(stream_id)
+    owner = None
+    if request.session_id or not request.messages:
+        owner = get_current_user_id(authorization=authorization, user_id=user_id)
+    stream_session, created = stream_hub.reserve(stream_id, owner)
+    if not created:
+        return resume_owned_stream(stream_session, authorization, user_id, last_event_id)
+    
+    deadline = request_deadline("chat")
     if not compass_client:
+        stream_hub.release(stream_session)
         raise HTTPException(
             status_code=503,
             detail="AI 服务未配置，请在 .env 文件中设置 COMPASS_API_KEY"
         )
     
     try:
-        # 1. 解析消息列表
-        if not request.messages or len(request.messages) == 0:
-            raise HTTPException(status_code=400, detail="messages 不能为空")
+        # 1. 解析消息列表（服务端会话：历史从会话读取，本轮只带新消息）
+        chat_session_id = None
+        bazi_data = request.bazi_data
+        if request.session_id or not request.messages:
+            if not request.message:
+                raise HTTPException(status_code=400, detail="messages 和 message 不能同时为空")
+            if request.session_id:
+                chat_state = await get_chat_session(request.session_id, owner)
+                chat_session_id = request.session_id
+                bazi_data = bazi_data or chat_state.get('bazi_data')
+                messages = chat_state['messages'] + [{"role": "user", "content": request.message}]
+            else:
+                chat_state = await asyncio.to_thread(create_chat_session_record, owner, [], bazi_data)
+                chat_session_id = chat_state['session_id']
+                chat_session_store.put(chat_session_id, chat_state)
+                messages = [{"role": "user", "content": request.message}]
+        else:
+            messages = request.messages
         
         # 分离历史消息和最新消息
-        history_messages = request.messages[:-1]  # 除最后一条外的所有消息
-        latest_message = request.messages[-1]  # 最后一条消息（用户当前输入）
+        history_messages = messages[:-1]  # 除最后一条外的所有消息
+        latest_message = messages[-1]  # 最后一条消息（用户当前输入）
         
         # 判断是否是首次对话（history 为空）
         is_first_message = len(history_messages) == 0
         
         print(f"📨 收到对话请求，历史消息数: {len(history_messages)}, 是否首次: {is_first_message}", flush=True)
         
+        # 长对话：首轮问答（排盘）固定保留，较早轮次折叠为后台生成的摘要，只原样发送最近几轮
+        upstream_history = chat_context.compact(history_messages, summarize_chat_turns)
+        if len(upstream_history) != len(history_messages):
+            print(f"📝 对话历史已压缩: {len(history_messages)} → {len(upstream_history)} 条", flush=True)
+        
         # 2. 将前端消息格式转换为 Google GenAI 的 history 格式
         # Google GenAI 的 history 格式：List[Dict] 其中每个 Dict 包含 'role' 和 'parts'
         # role: 'user' 或 'model'
         # parts: List[Dict] 其中每个 Dict 包含 'text'
         genai_history = []
         
-        for msg in history_messages:
+        for msg in upstream_history:
             role = msg.get("role", "user")
             content = msg.get("content", "")
             
@@ -2599,8 +4391,9 @@ async def chat_divination(request: ChatDivinationRequest):
         
         # 3. 构建 System Prompt（仅在首次对话时注入）
         # 获取当前时间信息（用于所有对话）
-        current_time = datetime.now().strftime("%Y年%m月%d日 %H:%M")
-        current_time_obj = datetime.now()
+        # 起卦时刻与提示词中的“当前时间”都以北京时间为准
+        current_time_obj = beijing_now()
+        current_time = current_time_obj.strftime("%Y年%m月%d日 %H:%M")
         current_year = current_time_obj.year
         current_month = current_time_obj.month
         current_day = current_time_obj.day
@@ -2611,35 +4404,51 @@ async def chat_divination(request: ChatDivinationRequest):
         next_year_2 = current_year + 2
         
         system_instruction = None
+        static_prompt_key = None  # 首轮使用的静态提示词（可引用上游缓存）
+        static_prompt = None
+        # 一次扫描识别意图（单一事件起卦 / tab 点击），意图表见 intents.json
+        route = intent_router.route(latest_message.get('content', ''))
+        is_single_event = False
+        # 单一事件起卦由后端排盘：本条消息是起卦问题，或在单一事件对话中回答“请提供三个数字”/明确给出数字时，
+        # 按当前时刻排小六壬、奇门盘，有数字时再加梅花易数卦；普通追问不重新排盘。
+        # 只认“数字/号码”后的三个数，或本条正在回答上一条“请提供三个数字”，避免把生日、时间当成起卦数
+        divination_facts = None
+        latest_content = latest_message.get('content', '')
+        asked_for_numbers = bool(history_messages) and history_messages[-1].get('role') != 'user' and \
+            '数字' in history_messages[-1].get('content', '')
+        if route['intent'] == 'single_event' or (
+            history_messages and intent_router.route(history_messages[0].get('content', ''))['intent'] == 'single_event'
+            and (asked_for_numbers or extract_numbers(latest_content))
+        ):
+            divination_facts = build_divination_facts(
+                latest_content, current_time_obj, allow_bare_numbers=asked_for_numbers
+            )
         if is_first_message:
             # 检测是否是单一事件起卦需求
-            latest_content_for_check = latest_message.get('content', '')
-            single_event_keywords = [
-                "论文", "paper", "投稿", "中稿", "发表", "期刊", "会议", "录用", "审稿",
-                "求职", "面试", "offer", "工作", "跳槽", "升职",
-                "投资", "股票", "基金", "理财", "赚钱",
-                "感情", "恋爱", "分手", "复合", "结婚", "离婚",
-                "考试", "考研", "考公", "录取", "通过",
-                "能不能", "会不会", "能否", "是否", "成功", "失败"
-            ]
-            is_single_event = any(keyword in latest_content_for_check for keyword in single_event_keywords)
+            is_single_event = route['intent'] == 'single_event'
             
             if is_single_event:
                 # 使用单一事件起卦专用 System Prompt，并在第一行注入当前时间
                 system_prompt = f"当前系统时间：{current_time} (模型必须以此为准)。\n" + SINGLE_EVENT_DIVINATION_PROMPT
+                static_prompt_key, static_prompt = "single_event_divination", SINGLE_EVENT_DIVINATION_PROMPT
                 # 注入当前时间信息
                 system_prompt += f"\n\n【重要时间信息】\n当前时间是：{current_datetime_str}（北京时间）。\n当前年份是：{current_year}年。\n所有涉及年份的分析必须基于当前年份（{current_year}年）进行计算，严禁使用过时的年份（如2023、2024、2025等）。\n当用户问'明年'时，指的是{next_year}年；问'后年'时，指的是{next_year_2}年。"
+                if divination_facts:
+                    system_prompt += f"\n\n{divination_facts}"
                 print(f"📊 首次对话，使用单一事件起卦 System Prompt，当前时间: {current_time}", flush=True)
             else:
                 # 使用普通命理咨询 System Prompt，并在第一行注入当前时间
                 system_prompt = f"当前系统时间：{current_time} (模型必须以此为准)。\n" + DIVINATION_SYSTEM_PROMPT
+                static_prompt_key, static_prompt = "divination", DIVINATION_SYSTEM_PROMPT
                 # 注入当前时间信息
                 system_prompt += f"\n\n【重要时间信息】\n当前时间是：{current_datetime_str}（北京时间）。\n当前年份是：{current_year}年。\n所有涉及年份的分析必须基于当前年份（{current_year}年）进行计算，严禁使用过时的年份（如2023、2024、2025等）。\n当用户问'明年'时，指的是{next_year}年；问'后年'时，指的是{next_year_2}年。\n未来3年流年预警必须从{current_year}年开始分析（{current_year}年、{next_year}年、{next_year_2}年）。"
                 # 如果提供了八字数据，添加到 System Prompt 中
-                if request.bazi_data:
-                    bazi_json = json.dumps(request.bazi_data, ensure_ascii=False, indent=2)
-                    system_prompt += f"\n\n【当前用户的八字排盘数据】\n{bazi_json}\n\n请基于以上八字数据进行精准分析。"
-                print(f"📊 首次对话，使用普通命理咨询 System Prompt，当前时间: {current_time}，八字数据: {bool(request.bazi_data)}", flush=True)
+                if bazi_data:
+                    system_prompt += f"\n\n【当前用户的八字排盘数据】\n{chart_codec.encode(bazi_data)}\n\n请基于以上八字数据进行精准分析。"
+                    ziwei_facts = build_ziwei_facts(bazi_data)
+                    if ziwei_facts:
+                        system_prompt += f"\n\n{ziwei_facts}"
+                print(f"📊 首次对话，使用普通命理咨询 System Prompt，当前时间: {current_time}，八字数据: {bool(bazi_data)}", flush=True)
             
             system_instruction = system_prompt
         else:
@@ -2650,18 +4459,9 @@ async def chat_divination(request: ChatDivinationRequest):
         
         # 检测是否是单一事件起卦需求（已在首次对话时检测过，这里用于后续对话）
         is_single_event_divination = False
-        if not is_first_message:
-            single_event_keywords = [
-                "论文", "paper", "投稿", "中稿", "发表", "期刊", "会议", "录用", "审稿",
-                "求职", "面试", "offer", "工作", "跳槽", "升职",
-                "投资", "股票", "基金", "理财", "赚钱",
-                "感情", "恋爱", "分手", "复合", "结婚", "离婚",
-                "考试", "考研", "考公", "录取", "通过",
-                "能不能", "会不会", "能否", "是否", "成功", "失败"
-            ]
-            if any(keyword in latest_content for keyword in single_event_keywords):
-                is_single_event_divination = True
-                print(f"🔍 检测到单一事件起卦需求（后续对话）", flush=True)
+        if not is_first_message and route['intent'] == 'single_event':
+            is_single_event_divination = True
+            print(f"🔍 检测到单一事件起卦需求（后续对话），命中: {'、'.join(route['matched'])}", flush=True)
         
         # 兼容旧代码：保留 is_paper_divination 变量
         is_paper_divination = is_single_event_divination
@@ -2669,18 +4469,25 @@ async def chat_divination(request: ChatDivinationRequest):
         # 检测用户点击的tab类型
         tab_type = None
         if not is_single_event_divination:
-            if "起大运" in latest_content or "大运" in latest_content:
-                tab_type = "起大运"
-            elif "看事业" in latest_content or "事业" in latest_content:
-                tab_type = "看事业"
-            elif "看姻缘" in latest_content or "姻缘" in latest_content or "婚姻" in latest_content:
-                tab_type = "看姻缘"
-            elif "看财运" in latest_content or "财运" in latest_content:
-                tab_type = "看财运"
-            elif "看健康" in latest_content or "健康" in latest_content:
-                tab_type = "看健康"
-            elif "详细分析" in latest_content:
-                tab_type = "详细分析"
+            tab_type = route['tab_type']
+        
+        # 首次回答后已预取该 tab：直接订阅预取结果（生成中则从头回放并继续接收）
+        if tab_type and not is_first_message:
+            prefetched = stream_hub.get(chat_tab_stream_id(chat_history_key(history_messages), tab_type))
+            if prefetched and prefetched.owner and owner is None:
+                # 预取结果属于某个用户：识别当前用户，匿名请求不复用
+                try:
+                    owner = get_current_user_id(authorization=authorization, user_id=user_id)
+                except HTTPException:
+                    pass
+            if prefetched and not prefetched.failed and prefetched.owner in (None, owner):
+                print(f"⚡ 命中预取的【{tab_type}】回答", flush=True)
+                # 预取仍在排队或生成：用户已在等待，提升为交互优先级
+                if not prefetched.done:
+                    llm_scheduler.promote(prefetched.stream_id, PRIORITY_INTERACTIVE)
+                if chat_session_id:
+                    chat_session_store.spawn(record_prefetched_chat_turn(prefetched, chat_session_id, latest_message))
+                return with_chat_session_header(resumable_stream_response(prefetched), chat_session_id)
         
         # 5. 如果检测到快捷指令或单一事件起卦，追加隐藏的 system instruction（防重复机制）
         additional_instruction = None
@@ -2690,12 +4497,19 @@ async def chat_divination(request: ChatDivinationRequest):
             print(f"🔍 检测到单一事件起卦需求（后续对话），追加起卦指令，当前时间: {current_datetime_str}", flush=True)
         elif tab_type and not is_first_message:
             # 后续对话中的tab点击，追加指令（包含当前时间）
-            additional_instruction = f"用户基于已有的排盘信息请求详解【{tab_type}】板块。请勿重复排盘，直接根据上下文输出深度分析（≥300字）。\n\n【重要时间信息】当前时间是：{current_datetime_str}（北京时间）。当前年份是：{current_year}年。所有涉及年份的分析必须基于当前年份（{current_year}年）进行计算，严禁使用过时的年份（如2023、2024、2025等）。当用户问'明年'时，指的是{next_year}年；问'后年'时，指的是{next_year_2}年。"
+            additional_instruction = build_tab_instruction(tab_type)
             print(f"🔍 检测到用户点击tab: {tab_type}，追加防重复指令，当前时间: {current_datetime_str}", flush=True)
         elif not is_first_message:
             # 所有后续对话都注入当前时间信息（确保时间准确性）
             additional_instruction = f"【重要时间信息】当前时间是：{current_datetime_str}（北京时间）。当前年份是：{current_year}年。所有涉及年份的分析必须基于当前年份（{current_year}年）进行计算，严禁使用过时的年份（如2023、2024、2025等）。当用户问'明年'时，指的是{next_year}年；问'后年'时，指的是{next_year_2}年。"
             print(f"📅 后续对话，注入当前时间信息: {current_datetime_str}", flush=True)
+        if divination_facts and not is_first_message:
+            additional_instruction = f"{additional_instruction}\n\n{divination_facts}" if additional_instruction else divination_facts
+        
+        # 首次回答完成后预取各 tab 的回答（需请求方开启，按用户计入每日预算）
+        prefetch_owner = None
+        if request.prefetch_tabs and is_first_message and not is_single_event:
+            prefetch_owner = owner or get_current_user_id(authorization=authorization, user_id=user_id)
         
         # 6. 创建聊天会话（使用 chats.create）
         model_name = "gemini-2.5-flash"  # 使用最快的模型
@@ -2711,23 +4525,43 @@ async def chat_divination(request: ChatDivinationRequest):
                 "model": model_name,
                 "history": genai_history,
             }
+            message_content = latest_content
             
-            # 仅在首次对话时添加 system_instruction
-            if system_instruction:
+            # 仅在首次对话时添加 system_instruction；静态提示词已在上游缓存时只引用缓存，
+            # 时间、八字等随请求变化的部分放在本轮消息前
+            cache_name = cached_prompt_handle(static_prompt_key, static_prompt, model_name) if static_prompt else None
+            if cache_name:
+                chat_config["config"] = {"cached_content": cache_name}
+                dynamic_instruction = system_instruction.replace(static_prompt, "", 1).strip()
+                message_content = f"{dynamic_instruction}\n\n用户问题：{latest_content}"
+            elif system_instruction:
                 chat_config["system_instruction"] = system_instruction
             
-            chat = compass_client.chats.create(**chat_config)
-            print(f"✅ 创建聊天会话成功，history 长度: {len(genai_history)}", flush=True)
-            
-            # 使用 chat.send_message() 发送消息并获取流式响应
-            stream = chat.send_message(latest_content, stream=True)
+            try:
+                chat = compass_client.chats.create(**chat_config)
+                print(f"✅ 创建聊天会话成功，history 长度: {len(genai_history)}", flush=True)
+                
+                # 使用 chat.send_message() 发送消息并获取流式响应
+                stream = chat.send_message(message_content, stream=True)
+            except Exception:
+                if not cache_name:
+                    raise
+                # 上游缓存可能已失效：作废后改为发送完整系统提示词
+                print(f"⚠️  使用提示词缓存失败，改为发送完整提示词", flush=True)
+                prompt_cache.invalidate(static_prompt_key)
+                chat_config.pop("config", None)
+                chat_config["system_instruction"] = system_instruction
+                chat = compass_client.chats.create(**chat_config)
+                stream = chat.send_message(latest_content, stream=True)
             print(f"✅ 发送消息成功: {latest_content[:50]}...", flush=True)
             
             # 流式返回结果
             async def generate_response():
                 full_text = ""
+                if chat_session_id:
+                    yield f"data: {json.dumps({'type': 'session', 'session_id': chat_session_id}, ensure_ascii=False)}\n\n"
                 try:
-                    for chunk in stream:
+                    async for chunk in iter_sync_stream(stream, deadline=deadline):
                         chunk_text = ""
                         if hasattr(chunk, 'text'):
                             chunk_text = chunk.text
@@ -2742,23 +4576,29 @@ async def chat_divination(request: ChatDivinationRequest):
                             full_text += chunk_text
                             yield f"data: {json.dumps({'type': 'text', 'content': chunk_text}, ensure_ascii=False)}\n\n"
                     
+                    if chat_session_id and full_text:
+                        await append_chat_turn(chat_session_id, [latest_message, {"role": "assistant", "content": full_text}])
+                    
+                    if prefetch_owner and full_text:
+                        start_chat_tab_prefetch(
+                            messages + [{"role": "assistant", "content": full_text}], prefetch_owner
+                        )
+                    
                     # 发送完成标记
                     yield "data: [DONE]\n\n"
                     print(f"✅ 起卦对话完成，总长度: {len(full_text)} 字符", flush=True)
                     
+                except asyncio.TimeoutError:
+                    print(f"⏰ 起卦对话超出耗时预算，已生成 {len(full_text)} 字符", flush=True)
+                    yield f"data: {json.dumps({'type': 'error', 'content': '回复生成超时，请稍后重试'}, ensure_ascii=False)}\n\n"
+                    yield "data: [DONE]\n\n"
                 except Exception as e:
                     print(f"❌ 流式输出错误: {e}", flush=True)
                     yield f"data: {json.dumps({'type': 'error', 'content': f'生成错误: {str(e)}'}, ensure_ascii=False)}\n\n"
             
-            return StreamingResponse(
-                generate_response(),
-                media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "X-Accel-Buffering": "no"
-                }
-            )
+            return with_chat_session_header(resumable_stream_response(stream_hub.start(
+                generate_response(), stream_session.stream_id, STREAM_EXPECTED_TOKENS["chat"]
+            )), chat_session_id)
             
         except Exception as e:
             print(f"❌ 创建聊天会话或发送消息失败: {e}", flush=True)
@@ -2772,7 +4612,7 @@ async def chat_divination(request: ChatDivinationRequest):
                 full_prompt = f"{system_instruction}\n\n用户：{latest_content}"
             else:
                 history_text = ""
-                for msg in history_messages:
+                for msg in upstream_history:
                     role = msg.get("role", "user")
                     content = msg.get("content", "")
                     if role == "user":
@@ -2793,8 +4633,10 @@ async def chat_divination(request: ChatDivinationRequest):
             # 3. 流式返回结果
             async def generate_response():
                 full_text = ""
+                if chat_session_id:
+                    yield f"data: {json.dumps({'type': 'session', 'session_id': chat_session_id}, ensure_ascii=False)}\n\n"
                 try:
-                    for chunk in stream:
+                    async for chunk in iter_sync_stream(stream, deadline=deadline):
                         chunk_text = ""
                         if hasattr(chunk, 'text'):
                             chunk_text = chunk.text
@@ -2809,23 +4651,29 @@ async def chat_divination(request: ChatDivinationRequest):
                             full_text += chunk_text
                             yield f"data: {json.dumps({'type': 'text', 'content': chunk_text}, ensure_ascii=False)}\n\n"
                     
+                    if chat_session_id and full_text:
+                        await append_chat_turn(chat_session_id, [latest_message, {"role": "assistant", "content": full_text}])
+                    
+                    if prefetch_owner and full_text:
+                        start_chat_tab_prefetch(
+                            messages + [{"role": "assistant", "content": full_text}], prefetch_owner
+                        )
+                    
                     # 发送完成标记
                     yield "data: [DONE]\n\n"
                     print(f"✅ 起卦对话完成，总长度: {len(full_text)} 字符", flush=True)
                     
+                except asyncio.TimeoutError:
+                    print(f"⏰ 起卦对话超出耗时预算，已生成 {len(full_text)} 字符", flush=True)
+                    yield f"data: {json.dumps({'type': 'error', 'content': '回复生成超时，请稍后重试'}, ensure_ascii=False)}\n\n"
+                    yield "data: [DONE]\n\n"
                 except Exception as e:
                     print(f"❌ 流式输出错误: {e}", flush=True)
                     yield f"data: {json.dumps({'type': 'error', 'content': f'生成错误: {str(e)}'}, ensure_ascii=False)}\n\n"
             
-            return StreamingResponse(
-                generate_response(),
-                media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "X-Accel-Buffering": "no"
-                }
-            )
+            return with_chat_session_header(resumable_stream_response(stream_hub.start(
+                generate_response(), stream_session.stream_id, STREAM_EXPECTED_TOKENS["chat"]
+            )), chat_session_id)
             
         except Exception as e:
             print(f"❌ LLM 调用失败: {e}", flush=True)
@@ -2846,6 +4694,9 @@ async def chat_divination(request: ChatDivinationRequest):
             status_code=500,
             detail=f"起卦对话失败: {str(e)}"
         )
+    finally:
+        # 命中预取或出错时释放占用的流 ID
+        stream_hub.release(stream_session)
 
 
 if __name__ == "__main__":
@@ -2867,20 +4718,10 @@ def build_divination_prompt(stage: str, bazi_report: dict, name: str, gender: st
     Returns:
         提示词字符串
     """
-    chart = bazi_report.get('chart', {})
-    si_zhu = chart.get('si_zhu', {})
-    day_master = bazi_report.get('day_master', '')
-    gods = bazi_report.get('gods', {})
-    five_elements = bazi_report.get('five_elements_legacy', bazi_report.get('five_elements', {}))
-    da_yun = bazi_report.get('da_yun', [])
-    
-    # 格式化大运信息
-    dayun_text = ""
-    for i, dy in enumerate(da_yun[:4]):  # 只取前4步大运
-        age_start = dy.get('age_start', 0)
-        age_end = dy.get('age_end', 10)
-        gan_zhi = dy.get('gan_zhi', '')
-        dayun_text += f"第{i+1}步大运：{age_start}-{age_end}岁，{gan_zhi}\n"
+    # 命盘紧凑编码（含四柱、藏干、十神、五行、喜用神与大运，见 services/chart_codec.py）
+    chart_text = chart_codec.encode(bazi_report)
+    # 紫微斗数命盘（十二宫、主星、四化、大限，见 services/ziwei.py）
+    ziwei_text = build_ziwei_facts(bazi_report, gender)
     
     if stage == 'analysis':
         prompt = f"""你是一位精通子平八字、紫微斗数、皇极经世书的"AI 命理先知"。你熟读台湾无居士《拆穿铁板神数》与王亭之的斗数论述，深谙阴阳五行与现代心理学。
@@ -2890,10 +4731,9 @@ def build_divination_prompt(stage: str, bazi_report: dict, name: str, gender: st
 请为 {name}（{gender}，生于{city}）进行命理分析。
 
 【八字排盘】
-年柱：{si_zhu.get('year_gan', '')}{si_zhu.get('year_zhi', '')}
-月柱：{si_zhu.get('month_gan', '')}{si_zhu.get('month_zhi', '')}
-日柱：{si_zhu.get('day_gan', '')}{si_zhu.get('day_zhi', '')}（日主：{day_master}）
-时柱：{si_zhu.get('hour_gan', '')}{si_zhu.get('hour_zhi', '')}
+{chart_text}
+
+{ziwei_text}
 
 【分析要求】
 请按照以下格式输出，使用 Markdown 格式，关键结论用 **加粗** 或 > 引用标出：
@@ -2929,7 +4769,7 @@ def build_divination_prompt(stage: str, bazi_report: dict, name: str, gender: st
 
 要求：
 - 语言风格：半文半白，通俗易懂，权威客观，带有悲悯之心
-- 结合子平法（旺衰、格局、调候）和紫微斗数
+- 结合子平法（旺衰、格局、调候）和紫微斗数（以上方紫微命盘为准）
 - 将古代术语转化为现代职场/情感建议
 - 不要一次性输出所有内容，分阶段引导"""
     
@@ -2941,13 +4781,9 @@ def build_divination_prompt(stage: str, bazi_report: dict, name: str, gender: st
 请为 {name}（{gender}，生于{city}）进行大运推演。
 
 【八字排盘】
-年柱：{si_zhu.get('year_gan', '')}{si_zhu.get('year_zhi', '')}
-月柱：{si_zhu.get('month_gan', '')}{si_zhu.get('month_zhi', '')}
-日柱：{si_zhu.get('day_gan', '')}{si_zhu.get('day_zhi', '')}（日主：{day_master}）
-时柱：{si_zhu.get('hour_gan', '')}{si_zhu.get('hour_zhi', '')}
+{chart_text}
 
-【大运信息】
-{dayun_text}
+{ziwei_text}
 
 【分析要求】
 请按照以下格式输出，使用 Markdown 格式，关键结论用 **加粗** 或 > 引用标出：
@@ -2965,7 +4801,7 @@ def build_divination_prompt(stage: str, bazi_report: dict, name: str, gender: st
 
 要求：
 - 语言风格：半文半白，通俗易懂，权威客观，带有悲悯之心
-- 结合子平法（旺衰、格局、调候）和紫微斗数
+- 结合子平法（旺衰、格局、调候）和紫微斗数（以上方紫微命盘为准）
 - 将古代术语转化为现代职场/情感建议"""
     
     else:
@@ -2974,20 +4810,106 @@ def build_divination_prompt(stage: str, bazi_report: dict, name: str, gender: st
     return prompt
 
 
-@app.post("/api/divination")
-async def divination(request: DivinationRequest):
+# analysis 报告的板块拆分（按文档顺序）
+# prompt 为 None 的板块由后端直接生成（排盘事实），其余板块各自调用一次模型、并发生成
+DIVINATION_REPORT_SECTIONS = [
+    {"key": "chart", "heading": "## 一、八字排盘", "prompt": None},
+    {"key": "basics", "heading": "## 二、基本面分析", "prompt": "基于月令与日主关系，分析强弱、格局（≥300字）。"},
+    {"key": "personality", "heading": "## 三、五大板块详解\n\n### 1. 个性", "prompt": "关键词+≥300字深度解析，结合十神心性。"},
+    {"key": "career", "heading": "### 2. 事业", "prompt": "适合行业+成就高低，≥300字。"},
+    {"key": "wealth", "heading": "### 3. 财运", "prompt": "正财vs偏财，一生财源，≥300字。"},
+    {"key": "marriage", "heading": "### 4. 婚姻", "prompt": "配偶特征+早晚婚建议，≥300字。"},
+    {"key": "health", "heading": "### 5. 健康", "prompt": "五行强弱对应的脏腑隐患，≥300字。"},
+    {"key": "liunian", "heading": "### 6. 未来1年流年趋势", "prompt": "≥300字。"},
+]
+
+DIVINATION_REPORT_ENDING = "如果你愿意，下一步我可以为你精准起大运（每十年），并指出哪一年是你真正的转命点。你只需说一句：『起大运』"
+
+
+def build_divination_chart_section(bazi_report: dict) -> str:
+    """「八字排盘」板块：纯排盘事实，直接由后端生成"""
+    chart = bazi_report.get('chart', {})
+    gods = bazi_report.get('gods', {})
+    lines = []
+    for pillar in chart.get('pillars', []):
+        lines.append(f"- **{pillar.get('name', '')}**：{pillar.get('gan_zhi', '')}（{pillar.get('gan_wuxing', '')}{pillar.get('zhi_wuxing', '')}）")
+    day_master = bazi_report.get('day_master', chart.get('day_gan', ''))
+    lines.append(f"\n> **日主：{day_master}**（五行属{gods.get('day_wuxing', '')}，{gods.get('strength_status', '中和')}）")
+    return "\n".join(lines)
+
+
+def build_divination_section_prompt(section: dict, bazi_report: dict, name: str, gender: str, city: str) -> str:
     """
-    起卦功能接口
+    构建单个板块的提示词
     
-    分三个阶段：
-    1. greeting: 初始接待，引导用户提供生辰信息
-    2. analysis: 正式排盘，八字排盘+五大板块分析
-    3. dayun: 大运推演，当用户输入"起大运"后执行
+    所有板块共享同一份命盘上下文（与 build_divination_prompt 的 analysis 阶段一致），
+    只要求模型输出当前板块的正文，便于并发生成后按顺序拼接。
+    """
+    heading = section['heading'].split('\n')[-1].lstrip('# ').strip()
+    
+    return f"""你是一位精通子平八字、紫微斗数、皇极经世书的"AI 命理先知"。你熟读台湾无居士《拆穿铁板神数》与王亭之的斗数论述，深谙阴阳五行与现代心理学。
+
+你的语言风格：半文半白但通俗易懂，语气权威、客观、带有悲悯之心，像一位隐居的得道高人。
+
+请为 {name}（{gender}，生于{city}）进行命理分析。
+
+【八字排盘】
+{chart_codec.encode(bazi_report)}
+
+{build_ziwei_facts(bazi_report, gender)}
+
+【本次任务】
+这是一份完整命理报告中的【{heading}】板块，其他板块由他人撰写。
+只输出本板块正文：{section['prompt']}
+
+要求：
+- 不要输出板块标题，不要输出其他板块的内容，不要寒暄或引导追问
+- 使用 Markdown 格式，关键结论用 **加粗** 或 > 引用标出
+- 结合子平法（旺衰、格局、调候）和紫微斗数（以上方紫微命盘为准）
+- 将古代术语转化为现代职场/情感建议"""
+
+
+async def generate_divination_section(section: dict, bazi_report: dict, name: str, gender: str, city: str,
+                                      deadline: Optional[Deadline] = None) -> str:
     """
+    生成单个板块正文（失败或超出耗时预算时返回占位提示，不影响其他板块）
+    
+    每个板块占用一个 LLM 并发槽位，排队时间计入耗时预算。
+    """
+    if section['prompt'] is None:
+        return build_divination_chart_section(bazi_report)
+    
+    prompt = build_divination_section_prompt(section, bazi_report, name, gender, city)
     try:
-        if request.stage == 'greeting':
-            # 阶段1：初始接待
-            greeting_text = """**AI算命·命理先知**
+        call = call_sync_llm(
+            compass_client.models.generate_content,
+            model="gemini-2.5-flash",
+            contents=prompt
+        )
+        response = await (deadline.run(call, reserve=DEADLINE_FALLBACK_RESERVE) if deadline else call)
+        text = extract_response_text(response)
+        if text:
+            return text.strip()
+    except Exception as e:
+        print(f"⚠️  板块 {section['key']} 生成失败: {e}", flush=True)
+    return "> 该板块暂时无法生成，请稍后重试。"
+
+
+def start_divination_sections(bazi_report: dict, name: str, gender: str, city: str,
+                              deadline: Optional[Deadline] = None) -> List[asyncio.Task]:
+    """
+    并发启动所有板块的生成任务
+    
+    Returns:
+        与 DIVINATION_REPORT_SECTIONS 顺序一致的任务列表
+    """
+    return [
+        asyncio.create_task(generate_divination_section(section, bazi_report, name, gender, city, deadline))
+        for section in DIVINATION_REPORT_SECTIONS
+    ]
+
+
+DIVINATION_GREETING_TEXT = """**AI算命·命理先知**
 
 有缘人，你好。
 
@@ -3002,83 +4924,52 @@ async def divination(request: DivinationRequest):
 4. 出生地（城市名称即可）
 
 待你提供完整信息后，我当为你排盘推演，解析命理。"""
-            
-            return {
-                "success": True,
-                "stage": "greeting",
-                "content": greeting_text,
-                "next_stage": "analysis"
-            }
+
+
+def validate_divination_birth_info(request: DivinationRequest):
+    """analysis / dayun 阶段必须提供完整生辰信息"""
+    if not all([request.birth_date, request.birth_time, request.gender, request.lat, request.lng]):
+        stage_label = "阶段2（正式排盘）" if request.stage == 'analysis' else "阶段3（大运推演）"
+        raise HTTPException(
+            status_code=400,
+            detail=f"{stage_label}需要提供：birth_date, birth_time, gender, lat, lng"
+        )
+
+
+def build_divination_fallback(stage: str, bazi_report: dict, gender: str) -> str:
+    """
+    LLM 不可用时的基础排盘 / 大运文本
+    
+    Args:
+        stage: analysis 或 dayun
+        bazi_report: 八字排盘数据
+        gender: 性别
+    
+    Returns:
+        Markdown 文本
+    """
+    if stage == 'dayun':
+        da_yun = bazi_report.get('da_yun', [])
+        dayun_text = "\n".join([
+            f"第{i+1}步大运：{dy.get('age_start', 0)}-{dy.get('age_end', 10)}岁，{dy.get('gan_zhi', '')}"
+            for i, dy in enumerate(da_yun[:4])
+        ])
         
-        elif request.stage == 'analysis':
-            # 阶段2：正式排盘
-            # 验证必需字段
-            if not all([request.birth_date, request.birth_time, request.gender, request.lat, request.lng]):
-                raise HTTPException(
-                    status_code=400,
-                    detail="阶段2（正式排盘）需要提供：birth_date, birth_time, gender, lat, lng"
-                )
-            
-            # 生成八字排盘
-            bazi_report = calculator.generate_bazi_report(
-                birth_date=request.birth_date,
-                birth_time=request.birth_time,
-                lng=request.lng,
-                lat=request.lat,
-                gender=request.gender
-            )
-            
-            # 构建提示词
-            prompt = build_divination_prompt(
-                stage='analysis',
-                bazi_report=bazi_report,
-                name=request.name,
-                gender=request.gender,
-                city=request.city or "未知"
-            )
-            
-            # 调用 LLM 生成分析
-            if not compass_client:
-                # 如果没有 LLM，返回基础分析
-                return {
-                    "success": True,
-                    "stage": "analysis",
-                    "content": "AI 服务未配置，无法生成详细分析。",
-                    "bazi_report": bazi_report
-                }
-            
-            try:
-                response = compass_client.models.generate_content(
-                    model="gemini-2.5-flash",
-                    contents=prompt
-                )
-                
-                # 获取返回文本
-                analysis_text = ""
-                if hasattr(response, 'text'):
-                    analysis_text = response.text
-                elif hasattr(response, 'candidates') and response.candidates:
-                    if hasattr(response.candidates[0], 'content'):
-                        if hasattr(response.candidates[0].content, 'parts'):
-                            for part in response.candidates[0].content.parts:
-                                if hasattr(part, 'text'):
-                                    analysis_text += part.text
-                
-                return {
-                    "success": True,
-                    "stage": "analysis",
-                    "content": analysis_text,
-                    "bazi_report": bazi_report,
-                    "next_stage": "dayun"
-                }
-            except Exception as e:
-                print(f"⚠️  LLM 调用失败: {e}", flush=True)
-                # 返回基础分析
-                chart = bazi_report.get('chart', {})
-                si_zhu = chart.get('si_zhu', {})
-                day_master = bazi_report.get('day_master', '')
-                
-                basic_analysis = f"""## 一、八字排盘
+        return f"""## 一、起运原理
+
+根据你的八字，大运按{'顺' if gender == 'male' else '逆'}行推算。
+
+## 二、大运流变
+
+{dayun_text}
+
+> AI 服务暂时不可用，当前显示为基础大运信息。如需详细分析，请稍后重试。"""
+    
+    chart = bazi_report.get('chart', {})
+    si_zhu = chart.get('si_zhu', {})
+    day_master = bazi_report.get('day_master', '')
+    
+    return f"""## 一、八字排盘
 
 **年柱**：{si_zhu.get('year_gan', '')}{si_zhu.get('year_zhi', '')}
 **月柱**：{si_zhu.get('month_gan', '')}{si_zhu.get('month_zhi', '')}
@@ -3086,100 +4977,106 @@ async def divination(request: DivinationRequest):
 **时柱**：{si_zhu.get('hour_gan', '')}{si_zhu.get('hour_zhi', '')}
 
 > AI 服务暂时不可用，当前显示为基础排盘信息。如需详细分析，请稍后重试。"""
-                
-                return {
-                    "success": True,
-                    "stage": "analysis",
-                    "content": basic_analysis,
-                    "bazi_report": bazi_report,
-                    "next_stage": "dayun"
-                }
-        
-        elif request.stage == 'dayun':
-            # 阶段3：大运推演
-            # 验证必需字段
-            if not all([request.birth_date, request.birth_time, request.gender, request.lat, request.lng]):
-                raise HTTPException(
-                    status_code=400,
-                    detail="阶段3（大运推演）需要提供：birth_date, birth_time, gender, lat, lng"
-                )
-            
-            # 生成八字排盘
-            bazi_report = calculator.generate_bazi_report(
-                birth_date=request.birth_date,
-                birth_time=request.birth_time,
-                lng=request.lng,
-                lat=request.lat,
-                gender=request.gender
-            )
-            
-            # 构建提示词
-            prompt = build_divination_prompt(
-                stage='dayun',
-                bazi_report=bazi_report,
-                name=request.name,
-                gender=request.gender,
-                city=request.city or "未知"
-            )
-            
-            # 调用 LLM 生成分析
-            if not compass_client:
-                return {
-                    "success": True,
-                    "stage": "dayun",
-                    "content": "AI 服务未配置，无法生成大运分析。",
-                    "bazi_report": bazi_report
-                }
-            
-            try:
-                response = compass_client.models.generate_content(
-                    model="gemini-2.5-flash",
-                    contents=prompt
-                )
-                
-                # 获取返回文本
-                analysis_text = ""
-                if hasattr(response, 'text'):
-                    analysis_text = response.text
-                elif hasattr(response, 'candidates') and response.candidates:
-                    if hasattr(response.candidates[0], 'content'):
-                        if hasattr(response.candidates[0].content, 'parts'):
-                            for part in response.candidates[0].content.parts:
-                                if hasattr(part, 'text'):
-                                    analysis_text += part.text
-                
-                return {
-                    "success": True,
-                    "stage": "dayun",
-                    "content": analysis_text,
-                    "bazi_report": bazi_report
-                }
-            except Exception as e:
-                print(f"⚠️  LLM 调用失败: {e}", flush=True)
-                # 返回基础大运信息
-                da_yun = bazi_report.get('da_yun', [])
-                dayun_text = "\n".join([
-                    f"第{i+1}步大运：{dy.get('age_start', 0)}-{dy.get('age_end', 10)}岁，{dy.get('gan_zhi', '')}"
-                    for i, dy in enumerate(da_yun[:4])
-                ])
-                
-                basic_dayun = f"""## 一、起运原理
 
-根据你的八字，大运按{'顺' if request.gender == 'male' else '逆'}行推算。
 
-## 二、大运流变
+def extract_response_text(response) -> str:
+    """从 GenAI 响应（或流式 chunk）中提取文本"""
+    if hasattr(response, 'text') and response.text:
+        return response.text
+    text = ""
+    if hasattr(response, 'candidates') and response.candidates:
+        if hasattr(response.candidates[0], 'content'):
+            if hasattr(response.candidates[0].content, 'parts'):
+                for part in response.candidates[0].content.parts or []:
+                    if hasattr(part, 'text') and part.text:
+                        text += part.text
+    return text
 
-{dayun_text}
 
-> AI 服务暂时不可用，当前显示为基础大运信息。如需详细分析，请稍后重试。"""
-                
-                return {
-                    "success": True,
-                    "stage": "dayun",
-                    "content": basic_dayun,
-                    "bazi_report": bazi_report
-                }
+@app.post("/api/divination")
+async def divination(request: DivinationRequest):
+    """
+    起卦功能接口
+    
+    分三个阶段：
+    1. greeting: 初始接待，引导用户提供生辰信息
+    2. analysis: 正式排盘，八字排盘+五大板块分析
+    3. dayun: 大运推演，当用户输入"起大运"后执行
+    
+    analysis / dayun 阶段需要逐字输出时请使用 POST /api/divination/stream；
+    超出耗时预算（DIVINATION_DEADLINE_SECONDS）时返回基础排盘文本
+    """
+    deadline = request_deadline("divination")
+    try:
+        if request.stage == 'greeting':
+            # 阶段1：初始接待
+            return {
+                "success": True,
+                "stage": "greeting",
+                "content": DIVINATION_GREETING_TEXT,
+                "next_stage": "analysis"
+            }
+        
+        # 阶段2：正式排盘 / 阶段3：大运推演
+        # 验证必需字段
+        validate_divination_birth_info(request)
+        
+        # 生成八字排盘
+        bazi_report = calculator.generate_bazi_report(
+            birth_date=request.birth_date,
+            birth_time=request.birth_time,
+            lng=request.lng,
+            lat=request.lat,
+            gender=request.gender
+        )
+        
+        # 构建提示词
+        prompt = build_divination_prompt(
+            stage=request.stage,
+            bazi_report=bazi_report,
+            name=request.name,
+            gender=request.gender,
+            city=request.city or "未知"
+        )
+        
+        result = {
+            "success": True,
+            "stage": request.stage,
+            "bazi_report": bazi_report
+        }
+        if request.stage == 'analysis':
+            result["next_stage"] = "dayun"
+        
+        # 调用 LLM 生成分析
+        if not compass_client:
+            # 如果没有 LLM，返回基础分析
+            result["content"] = "AI 服务未配置，无法生成详细分析。" if request.stage == 'analysis' else "AI 服务未配置，无法生成大运分析。"
+            result.pop("next_stage", None)
+            return result
         
+        if request.stage == 'analysis' and request.mode == 'sections':
+            # 分板块并发生成，总耗时取决于最慢的板块
+            tasks = start_divination_sections(bazi_report, request.name, request.gender, request.city or "未知", deadline)
+            contents = await asyncio.gather(*tasks)
+            parts = [f"{section['heading']}\n\n{content}" for section, content in zip(DIVINATION_REPORT_SECTIONS, contents)]
+            parts.append(f"## 结尾引导\n\n{DIVINATION_REPORT_ENDING}")
+            result["content"] = "\n\n".join(parts)
+            return result
+        
+        try:
+            response = await deadline.run(asyncio.to_thread(
+                compass_client.models.generate_content,
+                model="gemini-2.5-flash",
+                contents=prompt
+            ), reserve=DEADLINE_FALLBACK_RESERVE)
+            result["content"] = extract_response_text(response)
+        except Exception as e:
+            print(f"⚠️  LLM 调用失败: {e}", flush=True)
+            # 返回基础分析
+            result["content"] = build_divination_fallback(request.stage, bazi_report, request.gender)
+        
+        return result
+    
     except HTTPException:
         raise
     except Exception as e:
@@ -3189,6 +5086,150 @@ async def divination(request: DivinationRequest):
         raise HTTPException(status_code=500, detail=f"起卦功能失败: {str(e)}")
 
 
+async def stream_divination(request: DivinationRequest, bazi_report: dict, prompt: str,
+                            deadline: Optional[Deadline] = None):
+    """
+    起卦 analysis / dayun 阶段的流式输出
+    
+    事件顺序：bazi_report（排盘，首帧）→ text（逐块正文）→ stage（阶段信息）→ [DONE]
+    LLM 中途失败或超出耗时预算时，若尚未输出正文则补发基础排盘文本。
+    """
+    yield "data: " + json.dumps({
+        "type": "bazi_report",
+        "data": bazi_report
+    }, ensure_ascii=False) + "\n\n"
+    
+    sent_any_text = False
+    if compass_client:
+        try:
+            stream = compass_client.models.generate_content_stream(
+                model="gemini-2.5-flash",
+                contents=prompt
+            )
+            async for chunk in iter_sync_stream(stream, deadline=deadline, reserve=DEADLINE_FALLBACK_RESERVE):
+                chunk_text = extract_response_text(chunk)
+                if chunk_text:
+                    sent_any_text = True
+                    yield "data: " + json.dumps({
+                        "type": "text",
+                        "content": chunk_text
+                    }, ensure_ascii=False) + "\n\n"
+        except Exception as e:
+            print(f"⚠️  起卦流式 LLM 调用失败: {e}", flush=True)
+            if sent_any_text:
+                yield "data: " + json.dumps({
+                    "type": "error",
+                    "content": f"生成中断: {str(e) or '生成超时'}"
+                }, ensure_ascii=False) + "\n\n"
+    
+    if not sent_any_text:
+        yield "data: " + json.dumps({
+            "type": "text",
+            "content": build_divination_fallback(request.stage, bazi_report, request.gender)
+        }, ensure_ascii=False) + "\n\n"
+    
+    yield "data: " + json.dumps({
+        "type": "stage",
+        "stage": request.stage,
+        "next_stage": "dayun" if request.stage == 'analysis' else None
+    }, ensure_ascii=False) + "\n\n"
+    yield "data: [DONE]\n\n"
+
+
+async def stream_divination_sections(request: DivinationRequest, bazi_report: dict,
+                                     deadline: Optional[Deadline] = None):
+    """
+    analysis 阶段的分板块并发流式输出
+    
+    所有板块同时开始生成，按文档顺序推送：某板块完成且其之前的板块都已推送时立即推送。
+    每个板块以 text 事件推送（附带 section 字段），兼容现有的 onText 渲染。
+    """
+    yield "data: " + json.dumps({
+        "type": "bazi_report",
+        "data": bazi_report
+    }, ensure_ascii=False) + "\n\n"
+    
+    tasks = start_divination_sections(bazi_report, request.name, request.gender, request.city or "未知", deadline)
+    try:
+        for section, task in zip(DIVINATION_REPORT_SECTIONS, tasks):
+            content = await task
+            yield "data: " + json.dumps({
+                "type": "text",
+                "section": section['key'],
+                "content": f"{section['heading']}\n\n{content}\n\n"
+            }, ensure_ascii=False) + "\n\n"
+        
+        yield "data: " + json.dumps({
+            "type": "text",
+            "section": "ending",
+            "content": f"## 结尾引导\n\n{DIVINATION_REPORT_ENDING}"
+        }, ensure_ascii=False) + "\n\n"
+        yield "data: " + json.dumps({
+            "type": "stage",
+            "stage": "analysis",
+            "next_stage": "dayun"
+        }, ensure_ascii=False) + "\n\n"
+        yield "data: [DONE]\n\n"
+    finally:
+        # 客户端断开时不再等待剩余板块：仍在排队的不再发起，已发出的上游调用无法中止，在线程中跑完后归还槽位
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+@app.post("/api/divination/stream")
+async def divination_stream(request: DivinationRequest):
+    """
+    起卦功能接口（SSE 流式版本）
+    
+    analysis / dayun 阶段先推送排盘数据，再逐块推送模型正文，首字延迟约 1 秒；
+    analysis 阶段传 mode=sections 时各板块并发生成、按顺序推送；
+    greeting 阶段直接推送固定文案。
+    """
+    deadline = request_deadline("divination")
+    if request.stage == 'greeting':
+        async def greeting_stream():
+            yield "data: " + json.dumps({"type": "text", "content": DIVINATION_GREETING_TEXT}, ensure_ascii=False) + "\n\n"
+            yield "data: " + json.dumps({"type": "stage", "stage": "greeting", "next_stage": "analysis"}, ensure_ascii=False) + "\n\n"
+            yield "data: [DONE]\n\n"
+        
+        stream = greeting_stream()
+    else:
+        validate_divination_birth_info(request)
+        try:
+            bazi_report = calculator.generate_bazi_report(
+                birth_date=request.birth_date,
+                birth_time=request.birth_time,
+                lng=request.lng,
+                lat=request.lat,
+                gender=request.gender
+            )
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"排盘失败: {str(e)}")
+        
+        prompt = build_divination_prompt(
+            stage=request.stage,
+            bazi_report=bazi_report,
+            name=request.name,
+            gender=request.gender,
+            city=request.city or "未知"
+        )
+        if request.stage == 'analysis' and request.mode == 'sections' and compass_client:
+            stream = stream_divination_sections(request, bazi_report, deadline)
+        else:
+            stream = stream_divination(request, bazi_report, prompt, deadline)
+    
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
 class ChatDivinationRequest(BaseModel):
     """起卦对话请求模型（有状态版本）"""
     messages: List[Dict[str, str]] = Field(..., description="对话历史记录，格式：[{'role': 'user', 'content': '...'}, {'role': 'assistant', 'content': '...'}, ...]，最后一条必须是用户消息")
@@ -3317,7 +5358,7 @@ async def chat_divination(request: ChatDivinationRequest):
                 bazi_info = f"""
 【用户生辰信息】
 请基于以下实际数据进行精准分析，不要使用通用模板：
-{json.dumps(request.bazi_data, ensure_ascii=False, indent=2)}
+{chart_codec.encode(request.bazi_data)}
 """
                 conversation_parts.append(bazi_info)
                 print(f"📊 八字数据已添加到 prompt: {json.dumps(request.bazi_data, ensure_ascii=False)[:200]}...", flush=True)
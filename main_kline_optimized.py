@@ -7,15 +7,17 @@ import re
 from datetime import datetime
 from fastapi import HTTPException
 from fastapi.responses import JSONResponse
+from services.deadline import Deadline
 
-async def generate_kline_optimized(request, calculator, compass_client, deepseek_api_key, deepseek_base_url):
+async def generate_kline_optimized(request, calculator, compass_client, deepseek_api_key, deepseek_base_url, deadline=None):
     """
     优化后的K线生成函数
     - 移除多余的LLM调用
     - 使用非流式API（更快更稳定）
-    - 添加30秒超时
+    - 每个供应商最多30秒，且不超过请求剩余预算（deadline，默认60秒）
     - 改进错误处理
     """
+    deadline = deadline or Deadline(60.0)
     try:
         # 1. 准备数据（复用现有逻辑）
         birth_date = request.birth_date
@@ -94,9 +96,10 @@ async def generate_kline_optimized(request, calculator, compass_client, deepseek
         if compass_client:
             try:
                 print("🔄 调用 Compass API（非流式，30秒超时）...", flush=True)
-                # 使用 asyncio.wait_for 添加超时
+                # 在剩余预算内等待（同步 SDK 调用放到线程中，超时才能生效）
                 async def call_compass():
-                    response = compass_client.models.generate_content(
+                    response = await asyncio.to_thread(
+                        compass_client.models.generate_content,
                         model="gemini-2.5-flash",
                         contents=kline_prompt,
                         config={
@@ -114,7 +117,7 @@ async def generate_kline_optimized(request, calculator, compass_client, deepseek
                     return None
                 
                 try:
-                    response_text = await asyncio.wait_for(call_compass(), timeout=30.0)
+                    response_text = await deadline.run(call_compass(), cap=30.0, reserve=1.0)
                     if response_text:
                         ai_response = response_text
                         ai_call_success = True
@@ -127,7 +130,7 @@ async def generate_kline_optimized(request, calculator, compass_client, deepseek
                 print(f"❌ Compass API 异常: {e}", flush=True)
         
         # 如果Compass失败，尝试DeepSeek
-        if not ai_call_success and deepseek_api_key:
+        if not ai_call_success and deepseek_api_key and deadline.timeout(reserve=1.0) > 0:
             try:
                 print("🔄 调用 DeepSeek API（非流式，30秒超时）...", flush=True)
                 import httpx
@@ -162,7 +165,7 @@ async def generate_kline_optimized(request, calculator, compass_client, deepseek
                         return result["choices"][0]["message"]["content"]
                 
                 try:
-                    response_text = await asyncio.wait_for(call_deepseek(), timeout=30.0)
+                    response_text = await deadline.run(call_deepseek(), cap=30.0, reserve=1.0)
                     if response_text:
                         ai_response = response_text
                         ai_call_success = True
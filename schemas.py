@@ -2,8 +2,28 @@
 人生 K 线数据模型
 定义与前端 Recharts 兼容的数据结构
 """
-from typing import List, Dict, Optional
-from pydantic import BaseModel, Field
+from typing import Any, List, Dict, Optional
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+
+# 分数数组整体校验一次（代替逐个 ChartDataPoint 的字段校验）
+SCORES_ADAPTER = TypeAdapter(List[int])
+
+
+def validate_scores(scores: List[Any], default: int = 60) -> List[int]:
+    """
+    一次性校验整条分数数组
+    
+    无法转为整数或超出 0-100 的分数替换为 default，
+    之后的 ChartDataPoint 可以用 model_construct 直接构造，不再逐点校验。
+    """
+    try:
+        values = SCORES_ADAPTER.validate_python(scores)
+    except ValidationError as e:
+        values = list(scores)
+        for error in e.errors():
+            values[error['loc'][0]] = default
+        values = SCORES_ADAPTER.validate_python(values)
+    return [value if 0 <= value <= 100 else default for value in values]
 
 
 class PeakValley(BaseModel):
@@ -30,8 +50,9 @@ class ChartDataPoint(BaseModel):
 class LifeCurveResponse(BaseModel):
     """人生 K 线响应数据"""
     user_profile: Dict = Field(..., description="用户信息（name, bazi list）")
-    chart_data: List[ChartDataPoint] = Field(..., description="0-100岁的数据列表（101个数据点）")
+    chart_data: List[ChartDataPoint] = Field(..., description="0-100岁的数据列表（101个数据点；指定年龄窗口时只含窗口内的数据点）")
     summary: Dict = Field(..., description="总结信息（current_score, trend, peaks, valleys, advice）")
+    window: Optional[Dict] = Field(None, description="年龄窗口的统计摘要（from_age, to_age, count, avg_score, best, worst, trend, peaks, valleys）")
     
     class Config:
         json_schema_extra = {
@@ -2,5 +2,41 @@
 人生 K 线服务模块
 """
 from .lifeline import LifeLineService, lifeline_service
+from .stream_hub import StreamHub, StreamSession, stream_hub
+from .llm_scheduler import LLMScheduler, llm_scheduler
+from .deadline import Deadline
+from .job_queue import JobQueue, kline_job_queue
+from .timeline import resolve_window, summarize_window
+from .columnar import to_columnar, from_columnar, validate_payload_format
+from .chat_sessions import ChatSessionStore, chat_session_store
+from .chat_context import RollingChatContext, chat_context
+from .prompt_cache import PromptCache, prompt_cache
+from .knowledge import KnowledgeIndex, faq_index
+from .chart_codec import ChartCodec, chart_codec
+from .intent_router import IntentRouter, intent_router
+from .meihua import cast_by_numbers, extract_numbers, format_cast
+from .xiaoliuren import liuren_by_numbers, liuren_by_time, format_liuren
+from .qimen import qimen_plate, format_qimen
+from .ziwei import ziwei_chart, format_ziwei, ziwei_cache_stats
+from .precompute import SpeculativePrecompute, kline_precompute, kline_year_prefetch, chat_tab_prefetch
 
-__all__ = ['LifeLineService', 'lifeline_service']
+__all__ = [
+    'LifeLineService', 'lifeline_service',
+    'StreamHub', 'StreamSession', 'stream_hub',
+    'LLMScheduler', 'llm_scheduler',
+    'Deadline',
+    'JobQueue', 'kline_job_queue',
+    'resolve_window', 'summarize_window',
+    'to_columnar', 'from_columnar', 'validate_payload_format',
+    'ChatSessionStore', 'chat_session_store',
+    'RollingChatContext', 'chat_context',
+    'PromptCache', 'prompt_cache',
+    'KnowledgeIndex', 'faq_index',
+    'ChartCodec', 'chart_codec',
+    'IntentRouter', 'intent_router',
+    'cast_by_numbers', 'extract_numbers', 'format_cast',
+    'liuren_by_numbers', 'liuren_by_time', 'format_liuren',
+    'qimen_plate', 'format_qimen',
+    'ziwei_chart', 'format_ziwei', 'ziwei_cache_stats',
+    'SpeculativePrecompute', 'kline_precompute', 'kline_year_prefetch', 'chat_tab_prefetch'
+]
@@ -0,0 +1,245 @@
+"""
+命盘紧凑编码
+各处提示词原先各自拼接排盘数据，起卦对话首轮更是把整份报告（新旧两种格式）以缩进 JSON 注入。
+这里统一为按行的紧凑摘要，每行一个字段组，例如：
+
+    生辰：男 公历1990-05-15 14:30 出生地北京 真太阳时1990-05-15 14:21:03
+    四柱：年庚午(金火) 月辛巳(金火) 日庚辰(金土) 时癸未(水土)
+    藏干：年丁5己3 月丙7戊3庚2 日戊5乙3癸2 时己5丁3乙2
+    十神：年比肩 月偏印 时七杀
+    日主：庚金 偏强 偏印格 同党42 异党33
+    五行%：木5 火31 土35 金21 水8 最旺土 最弱木 五行齐全
+    喜用：水 金 喜木 忌土 火
+    大运：0-10壬午 10-20癸未 ...
+
+同一份报告对象只编码一次（按对象缓存，不做序列化），并发生成的多个板块共用结果。
+"""
+import json
+import os
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+PILLAR_KEYS = (("year", "年"), ("month", "月"), ("day", "日"), ("hour", "时"))
+WUXING = ("木", "火", "土", "金", "水")
+
+
+GENDER_NAMES = {"male": "男", "female": "女", "m": "男", "f": "女"}
+
+
+def _birth_line(report: Dict) -> Optional[str]:
+    """生辰信息（前端回传的数据可能带有姓名、性别、公历生日与出生地，排盘报告自带真太阳时）"""
+    sources = [report] + [report[key] for key in ("birth_info", "user_info") if isinstance(report.get(key), dict)]
+
+    def pick(*keys: str) -> str:
+        for source in sources:
+            for key in keys:
+                if source.get(key):
+                    return str(source[key])
+        return ""
+
+    parts = []
+    if pick("name"):
+        parts.append(pick("name"))
+    gender = pick("gender")
+    if gender:
+        parts.append(GENDER_NAMES.get(gender.lower(), gender))
+    birth = " ".join(value for value in (pick("birth_date"), pick("birth_time")) if value)
+    if birth:
+        parts.append(f"公历{birth}")
+    if pick("city", "birth_place"):
+        parts.append(f"出生地{pick('city', 'birth_place')}")
+    if pick("true_solar_time"):
+        parts.append(f"真太阳时{pick('true_solar_time')}")
+    return "生辰：" + " ".join(parts) if parts else None
+
+
+def _pillar_rows(report: Dict) -> List[Dict]:
+    """四柱明细（兼容 chart.pillars 列表、pillars 字典和只有 si_zhu 的精简报告）"""
+    chart = report.get("chart") or {}
+    detailed = chart.get("pillars") or []
+    new_format = report.get("pillars") if isinstance(report.get("pillars"), dict) else {}
+    si_zhu = chart.get("si_zhu") or {}
+    shi_shen = chart.get("shi_shen") or {}
+    rows = []
+    for index, (key, label) in enumerate(PILLAR_KEYS):
+        pillar = detailed[index] if index < len(detailed) else {}
+        extra = new_format.get(key) or {}
+        gan_zhi = pillar.get("gan_zhi") or si_zhu.get(key) or (extra.get("stem", "") + extra.get("branch", ""))
+        rows.append({
+            "label": label,
+            "gan_zhi": gan_zhi,
+            "wuxing": pillar.get("gan_wuxing", "") + pillar.get("zhi_wuxing", ""),
+            "hidden": pillar.get("cang_gan") or [{"gan": gan} for gan in extra.get("hidden", [])],
+            "shi_shen": pillar.get("shi_shen") or shi_shen.get(f"{key}_shi_shen") or extra.get("main_star", ""),
+            "na_yin": extra.get("na_yin") or pillar.get("na_yin", "")
+        })
+    return rows
+
+
+def _pillars_line(report: Dict) -> Optional[str]:
+    rows = [row for row in _pillar_rows(report) if row["gan_zhi"]]
+    if not rows:
+        return None
+    return "四柱：" + " ".join(
+        f"{row['label']}{row['gan_zhi']}" + (f"({row['wuxing']})" if row["wuxing"] else "") for row in rows
+    )
+
+
+def _hidden_line(report: Dict) -> Optional[str]:
+    parts = []
+    for row in _pillar_rows(report):
+        stems = "".join(f"{item.get('gan', '')}{item.get('score', '')}" for item in row["hidden"])
+        if stems:
+            parts.append(f"{row['label']}{stems}")
+    return "藏干：" + " ".join(parts) if parts else None
+
+
+def _shi_shen_line(report: Dict) -> Optional[str]:
+    parts = [f"{row['label']}{row['shi_shen']}" for row in _pillar_rows(report)
+             if row["shi_shen"] and row["shi_shen"] != "日主"]
+    return "十神：" + " ".join(parts) if parts else None
+
+
+def _na_yin_line(report: Dict) -> Optional[str]:
+    parts = [f"{row['label']}{row['na_yin']}" for row in _pillar_rows(report) if row["na_yin"]]
+    return "纳音：" + " ".join(parts) if parts else None
+
+
+def _day_master_line(report: Dict) -> Optional[str]:
+    chart = report.get("chart") or {}
+    gods = report.get("gods") or {}
+    day_master = report.get("day_master") or chart.get("day_gan") or gods.get("day_gan")
+    if not day_master:
+        return None
+    parts = [f"{day_master}{gods.get('day_wuxing', '')}"]
+    for key in ("strength_status", "pattern_name"):
+        if gods.get(key):
+            parts.append(gods[key])
+    if gods.get("tong_dang_score") is not None and gods.get("yi_dang_score") is not None:
+        parts.append(f"同党{gods['tong_dang_score']} 异党{gods['yi_dang_score']}")
+    return "日主：" + " ".join(parts)
+
+
+def _five_elements_line(report: Dict) -> Optional[str]:
+    legacy = report.get("five_elements_legacy")
+    current = report.get("five_elements")
+    if not isinstance(legacy, dict):
+        legacy = current if isinstance(current, dict) else {}
+    percentages = legacy.get("percentages") or {}
+    if not percentages and isinstance(current, list):
+        percentages = {item.get("name"): item.get("percent", 0) for item in current}
+    if not percentages:
+        return None
+    parts = [f"{name}{round(percentages.get(name, 0))}" for name in WUXING]
+    if legacy.get("strongest"):
+        parts.append(f"最旺{legacy['strongest']}")
+    if legacy.get("weakest"):
+        parts.append(f"最弱{legacy['weakest']}")
+    if legacy.get("missing"):
+        parts.append(legacy["missing"])
+    return "五行%：" + " ".join(parts)
+
+
+def _gods_line(report: Dict) -> Optional[str]:
+    gods = report.get("gods") or {}
+    useful = gods.get("useful_gods") or ([gods["useful_god"]] if gods.get("useful_god") else [])
+    if not useful:
+        return None
+    parts = [" ".join(useful)]
+    if gods.get("favorable_god"):
+        parts.append(f"喜{gods['favorable_god']}")
+    if gods.get("taboo_gods"):
+        parts.append("忌" + " ".join(gods["taboo_gods"]))
+    return "喜用：" + " ".join(parts)
+
+
+def _tags_line(report: Dict) -> Optional[str]:
+    tags = (report.get("gods") or {}).get("personality_tags") or report.get("personality_tags")
+    return "性格：" + " ".join(tags) if tags else None
+
+
+def _da_yun_line(report: Dict) -> Optional[str]:
+    da_yun = report.get("da_yun") or []
+    if not da_yun:
+        return None
+    return "大运：" + " ".join(
+        f"{dy.get('age_start', 0)}-{dy.get('age_end', '')}{dy.get('gan_zhi', '')}" for dy in da_yun
+    )
+
+
+SECTIONS: Dict[str, Callable[[Dict], Optional[str]]] = {
+    "birth": _birth_line,
+    "pillars": _pillars_line,
+    "hidden": _hidden_line,
+    "shi_shen": _shi_shen_line,
+    "na_yin": _na_yin_line,
+    "day_master": _day_master_line,
+    "five_elements": _five_elements_line,
+    "gods": _gods_line,
+    "tags": _tags_line,
+    "da_yun": _da_yun_line
+}
+
+ALL_SECTIONS = tuple(SECTIONS)
+# 只含命盘本身（提示词已单独给出生辰信息时使用）
+CHART_SECTIONS = tuple(name for name in SECTIONS if name != "birth")
+
+
+class ChartCodec:
+    """
+    命盘紧凑编码（按报告对象缓存）
+
+    缓存键是报告对象的 id 与字段组，条目同时持有报告本身：命中时校验是同一个对象，
+    且缓存期间对象不会被回收、id 不会被复用。报告编码后不应再修改。
+    """
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[Tuple[int, Tuple[str, ...]], Tuple[object, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, report: Optional[Dict], sections: Sequence[str] = ALL_SECTIONS) -> str:
+        """
+        排盘报告 → 按行的紧凑摘要
+
+        Args:
+            report: BaziReport（也接受前端回传的报告或只有 chart.si_zhu / da_yun 的精简数据）
+            sections: 需要输出的字段组（见 SECTIONS），按给定顺序输出
+
+        Returns:
+            紧凑摘要；无法识别为排盘报告时返回去掉缩进的 JSON
+        """
+        if not report:
+            return ""
+        key = (id(report), tuple(sections))
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] is report:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return cached[1]
+
+        self.misses += 1
+        encoded = None
+        if isinstance(report, dict):
+            produced = [(name, SECTIONS[name](report)) for name in sections]
+            # 只识别出生辰信息时说明不是排盘报告，仍按 JSON 注入
+            if any(line for name, line in produced if name != "birth"):
+                encoded = "\n".join(line for _, line in produced if line)
+        if encoded is None:
+            encoded = json.dumps(report, ensure_ascii=False, separators=(",", ":"), default=str)
+        self._cache[key] = (report, encoded)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return encoded
+
+    def stats(self) -> dict:
+        """缓存状态"""
+        return {
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+chart_codec = ChartCodec(max_entries=int(os.getenv("CHART_CODEC_CACHE_SIZE", "512")))
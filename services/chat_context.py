@@ -0,0 +1,142 @@
+"""
+对话上下文滚动窗口
+长对话每轮都把全部历史发给上游，延迟和成本随轮数线性增长。这里把历史压缩为：
+- 固定保留首轮问答（排盘结果等原始命盘信息）
+- 较早的轮次折叠为滚动摘要（在后台异步生成，不占用当前请求的耗时）
+- 最近 keep_turns 轮原样保留
+
+摘要按被折叠的历史前缀的内容指纹缓存，服务端会话和前端回传完整历史两种方式都能命中。
+摘要尚未生成时，未折叠的轮次原样发送，不丢失上下文。
+"""
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+Message = Dict[str, str]
+
+# 摘要生成函数：(上一段摘要, 需要折叠的新轮次) → 新摘要
+Summarizer = Callable[[Optional[str], List[Message]], Awaitable[Optional[str]]]
+
+# 固定保留的首轮问答（用户提供生辰 + 排盘结果）
+PINNED_MESSAGES = 2
+
+# 摘要以一组问答的形式插在首轮问答之后（保持 user / model 交替）
+SUMMARY_PROMPT = "【此前对话摘要】\n{summary}"
+SUMMARY_ACK = "好的，我已了解此前的对话内容，会结合命盘继续回答。"
+
+
+def _prefix_key(messages: List[Message]) -> str:
+    """历史前缀的内容指纹"""
+    normalized = [[m.get("role", "user"), (m.get("content") or "").strip()] for m in messages]
+    return hashlib.sha1(json.dumps(normalized, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class RollingChatContext:
+    """保留最近若干轮 + 滚动摘要的对话上下文"""
+
+    def __init__(self, enabled: bool = True, keep_turns: int = 6, fold_turns: int = 4,
+                 max_summaries: int = 2000):
+        """
+        Args:
+            enabled: 关闭时原样返回完整历史
+            keep_turns: 原样保留的最近轮数（一问一答为一轮）
+            fold_turns: 每次折叠进摘要的轮数
+            max_summaries: 内存中缓存的摘要数量上限
+        """
+        self.enabled = enabled
+        self.keep_turns = keep_turns
+        self.fold_turns = fold_turns
+        self.max_summaries = max_summaries
+        self.summaries: "OrderedDict[str, str]" = OrderedDict()
+        self.in_flight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self._background: Set[asyncio.Task] = set()
+
+    def compact(self, history: List[Message], summarize: Summarizer) -> List[Message]:
+        """
+        压缩发往上游的历史
+
+        Args:
+            history: 完整对话历史（不含本轮用户消息）
+            summarize: 摘要生成函数（需要新摘要时在后台调用）
+
+        Returns:
+            首轮问答 + 摘要问答（已有摘要时）+ 未折叠的轮次
+        """
+        pinned, body = history[:PINNED_MESSAGES], history[PINNED_MESSAGES:]
+        fold_size = self.fold_turns * 2
+        foldable = len(body) - self.keep_turns * 2
+        if not self.enabled or fold_size <= 0 or foldable < fold_size:
+            return history
+
+        # 应折叠到的位置（fold_size 的整数倍，保证剩余部分从用户消息开始）
+        target = foldable - foldable % fold_size
+        boundary, summary = 0, None
+        for candidate in range(target, 0, -fold_size):
+            key = _prefix_key(history[:PINNED_MESSAGES + candidate])
+            if key in self.summaries:
+                boundary, summary = candidate, self.summaries[key]
+                self.summaries.move_to_end(key)
+                break
+
+        if boundary == target:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._schedule(history, boundary, summary, target, summarize)
+        if summary is None:
+            return history
+        return pinned + [
+            {"role": "user", "content": SUMMARY_PROMPT.format(summary=summary)},
+            {"role": "assistant", "content": SUMMARY_ACK}
+        ] + body[boundary:]
+
+    def _schedule(self, history: List[Message], boundary: int, summary: Optional[str],
+                  target: int, summarize: Summarizer):
+        """在后台把 [boundary, target) 的轮次折叠进摘要（同一前缀只生成一次）"""
+        key = _prefix_key(history[:PINNED_MESSAGES + target])
+        if key in self.in_flight:
+            return
+        turns = history[PINNED_MESSAGES + boundary:PINNED_MESSAGES + target]
+        task = asyncio.create_task(self._fold(key, summary, turns, summarize))
+        self.in_flight[key] = task
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _fold(self, key: str, summary: Optional[str], turns: List[Message], summarize: Summarizer):
+        try:
+            folded = await summarize(summary, turns)
+            if folded:
+                self.summaries[key] = folded
+                self.generated += 1
+                while len(self.summaries) > self.max_summaries:
+                    self.summaries.popitem(last=False)
+        except Exception as e:
+            print(f"⚠️  对话摘要生成失败: {e}", flush=True)
+        finally:
+            self.in_flight.pop(key, None)
+
+    def stats(self) -> dict:
+        """摘要缓存状态"""
+        return {
+            "enabled": self.enabled,
+            "keep_turns": self.keep_turns,
+            "fold_turns": self.fold_turns,
+            "cached": len(self.summaries),
+            "in_flight": len(self.in_flight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "generated": self.generated
+        }
+
+
+chat_context = RollingChatContext(
+    enabled=os.getenv("CHAT_CONTEXT_SUMMARY_ENABLED", "true").lower() == "true",
+    keep_turns=int(os.getenv("CHAT_CONTEXT_KEEP_TURNS", "6")),
+    fold_turns=int(os.getenv("CHAT_CONTEXT_FOLD_TURNS", "4"))
+)
@@ -0,0 +1,88 @@
+"""
+对话会话热数据层
+起卦对话的历史保存在服务端（数据库为持久层），客户端每轮只需发送 session_id 和新消息：
+- 最近活跃的会话缓存在内存中（LRU + 空闲 TTL），命中时不读库
+- 未命中或过期时由调用方从数据库加载后 put 回来
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Dict, List, Optional, Set
+
+
+class ChatSessionStore:
+    """对话会话的内存热缓存（冷数据在数据库）"""
+
+    def __init__(self, max_sessions: int = 1000, ttl_seconds: float = 1800.0):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self._background: Set[asyncio.Task] = set()
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        """
+        读取热缓存中的会话
+
+        Returns:
+            会话状态（user_id, messages, bazi_data）；未缓存或空闲超时返回 None
+        """
+        state = self._sessions.get(session_id)
+        if state is not None and time.time() - self._touched[session_id] > self.ttl_seconds:
+            self.evict(session_id)
+            state = None
+        if state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._sessions.move_to_end(session_id)
+        self._touched[session_id] = time.time()
+        return state
+
+    def put(self, session_id: str, state: Dict):
+        """写入热缓存（超出容量时淘汰最久未用的会话）"""
+        self._sessions[session_id] = state
+        self._sessions.move_to_end(session_id)
+        self._touched[session_id] = time.time()
+        while len(self._sessions) > self.max_sessions:
+            oldest, _ = self._sessions.popitem(last=False)
+            self._touched.pop(oldest, None)
+
+    def append(self, session_id: str, messages: List[Dict[str, str]]) -> Optional[Dict]:
+        """向缓存中的会话追加消息（会话不在缓存中时返回 None）"""
+        state = self._sessions.get(session_id)
+        if state is None:
+            return None
+        state["messages"].extend(messages)
+        self._sessions.move_to_end(session_id)
+        self._touched[session_id] = time.time()
+        return state
+
+    def evict(self, session_id: str):
+        """移出热缓存"""
+        self._sessions.pop(session_id, None)
+        self._touched.pop(session_id, None)
+
+    def spawn(self, coro: Awaitable[None]):
+        """在后台运行协程（保留引用，避免任务被提前回收）"""
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def stats(self) -> dict:
+        """缓存状态"""
+        return {
+            "cached": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+chat_session_store = ChatSessionStore(
+    max_sessions=int(os.getenv("CHAT_SESSION_CACHE_SIZE", "1000")),
+    ttl_seconds=float(os.getenv("CHAT_SESSION_CACHE_TTL_SECONDS", "1800"))
+)
@@ -0,0 +1,90 @@
+"""
+列式紧凑编码
+K 线 / 人生 K 线的数据点每条都重复 age、score、gan_zhi、label 等键名，
+format=columnar 时改为每个字段一个并列数组：
+- 重复度高的字符串字段（干支、大运、标签、说明）做字典编码：dicts 存取值表，列中存下标
+- is_peak / is_valley 这类布尔字段改为下标列表（peaks / valleys）
+"""
+from typing import Dict, Iterable, List, Optional, Sequence
+
+PAYLOAD_FORMATS = ("columnar",)
+
+# 需要字典编码的字符串字段
+DICT_FIELDS = ("gan_zhi", "da_yun", "label", "details")
+
+# 以下标列表表示的布尔字段 → 输出键名
+FLAG_FIELDS = {"is_peak": "peaks", "is_valley": "valleys"}
+
+
+def validate_payload_format(payload_format: Optional[str]) -> Optional[str]:
+    """
+    校验响应格式参数（None 表示默认的逐条对象）
+
+    Raises:
+        ValueError: 不支持的格式
+    """
+    if payload_format is not None and payload_format not in PAYLOAD_FORMATS:
+        raise ValueError(f"format 只支持 {'、'.join(PAYLOAD_FORMATS)}")
+    return payload_format
+
+
+def to_columnar(points: Iterable[Dict], dict_fields: Sequence[str] = DICT_FIELDS) -> Dict:
+    """
+    数据点列表 → 列式编码
+
+    Returns:
+        {"format": "columnar", "count": n, "columns": {字段: [...]},
+         "dicts": {字段: [取值表]}, "peaks": [下标], "valleys": [下标]}
+        dict_fields 中的字段在 columns 里存的是 dicts 对应取值表的下标
+    """
+    rows = list(points)
+    fields: List[str] = []
+    for row in rows:
+        for field in row:
+            if field not in fields and field not in FLAG_FIELDS:
+                fields.append(field)
+
+    columns: Dict[str, List] = {field: [] for field in fields}
+    dicts: Dict[str, List] = {field: [] for field in fields if field in dict_fields}
+    codes: Dict[str, Dict] = {field: {} for field in dicts}
+    flags: Dict[str, List[int]] = {name: [] for name in FLAG_FIELDS.values()}
+
+    for index, row in enumerate(rows):
+        for field in fields:
+            value = row.get(field)
+            if field in codes:
+                code = codes[field].get(value)
+                if code is None:
+                    code = codes[field][value] = len(dicts[field])
+                    dicts[field].append(value)
+                value = code
+            columns[field].append(value)
+        for flag, name in FLAG_FIELDS.items():
+            if row.get(flag):
+                flags[name].append(index)
+
+    return {
+        "format": "columnar",
+        "count": len(rows),
+        "columns": columns,
+        "dicts": dicts,
+        **flags
+    }
+
+
+def from_columnar(encoded: Dict) -> List[Dict]:
+    """列式编码 → 数据点列表（to_columnar 的逆过程）"""
+    columns = encoded["columns"]
+    dicts = encoded.get("dicts", {})
+    rows = []
+    for index in range(encoded["count"]):
+        row = {}
+        for field, values in columns.items():
+            value = values[index]
+            row[field] = dicts[field][value] if field in dicts else value
+        rows.append(row)
+    for flag, name in FLAG_FIELDS.items():
+        marked = set(encoded.get(name, []))
+        for index, row in enumerate(rows):
+            row[flag] = index in marked
+    return rows
@@ -0,0 +1,56 @@
+"""
+请求级截止时间
+在接口入口创建一次，沿调用链向下传递；每个阶段用剩余预算作为自己的超时，
+预算耗尽时由调用方降级为确定性结果，保证接口耗时有硬上限。
+"""
+import asyncio
+import os
+import time
+from typing import AsyncIterator, Awaitable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class Deadline:
+    """请求截止时间（基于单调时钟）"""
+
+    def __init__(self, budget_seconds: float):
+        self.budget_seconds = budget_seconds
+        self.expires_at = time.monotonic() + budget_seconds
+
+    @classmethod
+    def from_env(cls, name: str, default: float) -> "Deadline":
+        """从环境变量读取预算（秒）"""
+        return cls(float(os.getenv(name, str(default))))
+
+    def remaining(self) -> float:
+        """剩余秒数（不小于 0）"""
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: Optional[float] = None, reserve: float = 0.0) -> float:
+        """
+        当前阶段可用的超时
+
+        Args:
+            cap: 本阶段自身的超时上限（如单个供应商 30 秒）
+            reserve: 为后续阶段（兜底、序列化）预留的秒数
+        """
+        available = max(self.remaining() - reserve, 0.0)
+        return min(available, cap) if cap is not None else available
+
+    async def run(self, awaitable: Awaitable[T], cap: Optional[float] = None, reserve: float = 0.0) -> T:
+        """在剩余预算内等待，超时抛出 asyncio.TimeoutError"""
+        return await asyncio.wait_for(awaitable, timeout=self.timeout(cap, reserve))
+
+    async def iterate(self, iterator: AsyncIterator[T], reserve: float = 0.0) -> AsyncIterator[T]:
+        """逐项等待异步迭代器，预算耗尽时抛出 asyncio.TimeoutError"""
+        it = iterator.__aiter__()
+        while True:
+            try:
+                item = await asyncio.wait_for(it.__anext__(), timeout=self.timeout(reserve=reserve))
+            except StopAsyncIteration:
+                return
+            yield item
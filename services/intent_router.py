@@ -0,0 +1,177 @@
+"""
+对话意图路由
+起卦对话原先每轮对几十个关键词逐个做子串查找，再串行判断 tab 类型。这里把意图表（intents.json）
+中的全部关键词编译为一个 Aho–Corasick 自动机，对消息只扫描一遍即可得到意图、tab 类型和命中的词，
+耗时只与消息长度有关，不随关键词数量增长。
+
+意图表按顺序决定优先级（靠前的意图优先），增删关键词只需修改 intents.json，文件修改后自动重新编译。
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+
+class KeywordAutomaton:
+    """多模式串匹配（Aho–Corasick）"""
+
+    def __init__(self, patterns: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[int]] = [[]]
+        self.patterns = patterns
+        for index, pattern in enumerate(patterns):
+            self._insert(pattern, index)
+        self._link()
+
+    def _insert(self, pattern: str, index: int):
+        node = 0
+        for char in pattern:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            node = nxt
+        self.output[node].append(index)
+
+    def _link(self):
+        """按层建立失配指针，并把后缀节点的输出并入当前节点"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(char, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text: str) -> List[int]:
+        """返回命中的模式下标（按在文本中结束的位置排序，可能重复）"""
+        hits = []
+        node = 0
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            if self.output[node]:
+                hits.extend(self.output[node])
+        return hits
+
+
+class IntentRouter:
+    """基于意图表的消息路由（意图表文件变化时自动重新编译）"""
+
+    def __init__(self, path: str, reload_check_seconds: float = 5.0):
+        """
+        Args:
+            path: 意图表文件（JSON，见 intents.json）
+            reload_check_seconds: 检查文件是否修改的最小间隔
+        """
+        self.path = path
+        self.reload_check_seconds = reload_check_seconds
+        self.intents: List[Dict] = []
+        self.automaton = KeywordAutomaton([])
+        self.owners: List[List[int]] = []  # 关键词下标 → 包含该词的意图下标
+        self.mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.routed = 0
+        self.reload()
+
+    def reload(self):
+        """读取意图表并编译自动机（文件不存在或格式错误时保留原有意图表）"""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, "r", encoding="utf-8") as f:
+                intents = json.load(f)["intents"]
+        except FileNotFoundError:
+            print(f"⚠️  意图表文件 {self.path} 不存在，对话将不做意图识别", flush=True)
+            self.mtime = None
+            return
+        except Exception as e:
+            print(f"⚠️  读取意图表文件 {self.path} 失败: {e}，保留原有意图表", flush=True)
+            return
+
+        keywords: List[str] = []
+        positions: Dict[str, int] = {}
+        owners: List[List[int]] = []
+        for intent_index, intent in enumerate(intents):
+            for keyword in intent.get("keywords", []):
+                keyword = keyword.lower()
+                if not keyword:
+                    continue
+                if keyword not in positions:
+                    positions[keyword] = len(keywords)
+                    keywords.append(keyword)
+                    owners.append([])
+                owners[positions[keyword]].append(intent_index)
+
+        # 整体替换，路由中的请求仍使用旧自动机
+        self.intents, self.automaton, self.owners = intents, KeywordAutomaton(keywords), owners
+        self.mtime = mtime
+        print(f"🧭 意图表已编译: {self.path}，{len(intents)} 个意图，{len(keywords)} 个关键词", flush=True)
+
+    def _reload_if_changed(self):
+        now = time.time()
+        if now - self._checked_at < self.reload_check_seconds:
+            return
+        with self._lock:
+            if now - self._checked_at < self.reload_check_seconds:
+                return
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                mtime = None
+            if mtime is not None and mtime != self.mtime:
+                self.reload()
+
+    def route(self, text: str) -> Dict:
+        """
+        识别消息意图
+
+        Returns:
+            {"intent": 意图名或 None, "tab_type": tab 名称或 None, "matched": 命中的关键词（按出现顺序去重）}
+            多个意图同时命中时取意图表中靠前的一个
+        """
+        self._reload_if_changed()
+        intents, automaton, owners = self.intents, self.automaton, self.owners
+        self.routed += 1
+
+        best: Optional[int] = None
+        matched: List[str] = []
+        seen = set()
+        for keyword_index in automaton.find((text or "").lower()):
+            if keyword_index in seen:
+                continue
+            seen.add(keyword_index)
+            matched.append(automaton.patterns[keyword_index])
+            first_owner = owners[keyword_index][0]
+            if best is None or first_owner < best:
+                best = first_owner
+
+        if best is None:
+            return {"intent": None, "tab_type": None, "matched": []}
+        intent = intents[best]
+        return {"intent": intent.get("intent"), "tab_type": intent.get("tab_type"), "matched": matched}
+
+    def stats(self) -> dict:
+        """意图表状态"""
+        return {
+            "path": self.path,
+            "intents": len(self.intents),
+            "keywords": len(self.automaton.patterns),
+            "routed": self.routed
+        }
+
+
+intent_router = IntentRouter(os.getenv("INTENTS_PATH", "intents.json"))
@@ -0,0 +1,92 @@
+"""
+后台任务队列
+固定数量的 worker 从队列中取任务执行，接口只负责入队并立即返回任务 ID，
+请求生命周期不再与耗时的 LLM 调用绑定。
+"""
+import asyncio
+import os
+from collections import deque
+from typing import Awaitable, Callable, List, Optional
+
+
+class JobQueue:
+    """固定 worker 数的异步任务队列"""
+
+    def __init__(self, name: str, workers: int = 2, max_pending: int = 100):
+        self.name = name
+        self.workers = max(workers, 1)
+        self.max_pending = max_pending
+        self.pending = deque()  # 排队中的任务 ID（按入队顺序）
+        self.running = set()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._loop = None
+
+    def _ensure_workers(self):
+        """在当前事件循环上按需启动 worker"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._worker_tasks:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self.pending.clear()
+        self.running.clear()
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(i)) for i in range(self.workers)
+        ]
+
+    def submit(self, job_id: str, job_factory: Callable[[], Awaitable[None]]):
+        """
+        任务入队
+
+        Args:
+            job_id: 任务 ID
+            job_factory: 返回待执行协程的函数（由 worker 调用）
+
+        Raises:
+            asyncio.QueueFull: 排队任务数已达上限
+        """
+        self._ensure_workers()
+        if len(self.pending) >= self.max_pending:
+            raise asyncio.QueueFull(f"{self.name} 队列已满")
+        self.pending.append(job_id)
+        self._queue.put_nowait((job_id, job_factory))
+
+    def position(self, job_id: str) -> Optional[int]:
+        """排队位置（1 表示下一个执行），不在队列中返回 None"""
+        try:
+            return self.pending.index(job_id) + 1
+        except ValueError:
+            return None
+
+    async def _worker(self, index: int):
+        while True:
+            job_id, job_factory = await self._queue.get()
+            try:
+                self.pending.remove(job_id)
+            except ValueError:
+                pass
+            self.running.add(job_id)
+            try:
+                await job_factory()
+            except Exception as e:
+                print(f"❌ {self.name} 任务 {job_id} 执行失败: {e}", flush=True)
+            finally:
+                self.running.discard(job_id)
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        """队列状态"""
+        return {
+            "workers": self.workers,
+            "pending": len(self.pending),
+            "running": len(self.running)
+        }
+
+
+# K 线后台生成队列
+kline_job_queue = JobQueue(
+    "K线生成",
+    workers=int(os.getenv("KLINE_JOB_WORKERS", "2")),
+    max_pending=int(os.getenv("KLINE_JOB_MAX_PENDING", "100"))
+)
@@ -0,0 +1,179 @@
+"""
+知识库检索
+faq.txt 在启动时切分为段落并建立进程内 BM25 索引（中文按字二元组、英文按单词切分），
+每次分析只注入与命盘相关的前 k 段，提示词长度不再随知识库增大而增长。
+文件修改后在下一次检索时自动重建索引。
+"""
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+_WORD = re.compile(r"[a-zA-Z0-9]+")
+_CJK = re.compile(r"[一-鿿]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """中文取单字和相邻二字组合，英文 / 数字取小写单词"""
+    tokens = [word.lower() for word in _WORD.findall(text)]
+    for run in _CJK.findall(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def split_chunks(text: str, max_chars: int = 400) -> List[str]:
+    """
+    按空行切分段落；超长段落按行拼接到不超过 max_chars
+
+    段落的首行（如 “二、十神含义”）作为标题带入该段切出的每一块。
+    """
+    chunks = []
+    for block in re.split(r"\n\s*\n", text):
+        lines = [line.rstrip() for line in block.strip().splitlines() if line.strip()]
+        if not lines:
+            continue
+        if sum(len(line) + 1 for line in lines) <= max_chars:
+            chunks.append("\n".join(lines))
+            continue
+        title, current = lines[0], [lines[0]]
+        for line in lines[1:]:
+            if current and sum(len(item) + 1 for item in current) + len(line) > max_chars:
+                chunks.append("\n".join(current))
+                current = [title]
+            current.append(line)
+        if len(current) > 1:
+            chunks.append("\n".join(current))
+    return chunks
+
+
+class KnowledgeIndex:
+    """文本知识库的 BM25 索引（文件变化时自动重建）"""
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, path: str, top_k: int = 4, max_chars: int = 1200, chunk_chars: int = 400,
+                 reload_check_seconds: float = 5.0):
+        """
+        Args:
+            path: 知识库文件
+            top_k: 每次最多返回的段落数
+            max_chars: 每次返回内容的总字数上限
+            chunk_chars: 切分段落的长度上限
+            reload_check_seconds: 检查文件是否修改的最小间隔
+        """
+        self.path = path
+        self.top_k = top_k
+        self.max_chars = max_chars
+        self.chunk_chars = chunk_chars
+        self.reload_check_seconds = reload_check_seconds
+        self.chunks: List[str] = []
+        self.doc_tokens: List[Counter] = []
+        self.doc_lengths: List[int] = []
+        self.doc_freq: Dict[str, int] = {}
+        self.avg_length = 0.0
+        self.mtime: Optional[float] = None
+        self.loaded_at = 0.0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """读取文件并重建索引（文件不存在或读取失败时为空索引）"""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            print(f"⚠️  知识库文件 {self.path} 不存在，将使用空知识库", flush=True)
+            mtime, text = None, ""
+        except Exception as e:
+            print(f"⚠️  读取知识库文件 {self.path} 失败: {e}，将使用空知识库", flush=True)
+            mtime, text = None, ""
+
+        chunks = split_chunks(text, self.chunk_chars)
+        doc_tokens = [Counter(tokenize(chunk)) for chunk in chunks]
+        doc_freq: Dict[str, int] = {}
+        for tokens in doc_tokens:
+            for token in tokens:
+                doc_freq[token] = doc_freq.get(token, 0) + 1
+        doc_lengths = [sum(tokens.values()) for tokens in doc_tokens]
+
+        # 整体替换，检索中的请求仍使用旧索引
+        self.chunks, self.doc_tokens, self.doc_lengths, self.doc_freq = chunks, doc_tokens, doc_lengths, doc_freq
+        self.avg_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+        self.mtime = mtime
+        self.loaded_at = time.time()
+        if chunks:
+            print(f"📚 知识库索引已建立: {self.path}，{len(chunks)} 段", flush=True)
+
+    def _reload_if_changed(self):
+        now = time.time()
+        if now - self._checked_at < self.reload_check_seconds:
+            return
+        with self._lock:
+            if now - self._checked_at < self.reload_check_seconds:
+                return
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                mtime = None
+            if mtime != self.mtime:
+                self.reload()
+
+    def search(self, query: str, top_k: Optional[int] = None) -> List[str]:
+        """
+        检索与 query 最相关的段落
+
+        Returns:
+            按原文顺序排列的段落（最多 top_k 段、总字数不超过 max_chars）
+        """
+        self._reload_if_changed()
+        chunks, doc_tokens, doc_lengths, doc_freq = self.chunks, self.doc_tokens, self.doc_lengths, self.doc_freq
+        if not chunks:
+            return []
+
+        total = len(chunks)
+        query_tokens = set(tokenize(query))
+        scores = []
+        for index, tokens in enumerate(doc_tokens):
+            score = 0.0
+            length_norm = self.K1 * (1 - self.B + self.B * doc_lengths[index] / (self.avg_length or 1))
+            for token in query_tokens:
+                tf = tokens.get(token)
+                if not tf:
+                    continue
+                idf = math.log(1 + (total - doc_freq[token] + 0.5) / (doc_freq[token] + 0.5))
+                score += idf * tf * (self.K1 + 1) / (tf + length_norm)
+            if score > 0:
+                scores.append((score, index))
+
+        selected, used = [], 0
+        for score, index in sorted(scores, reverse=True)[:top_k or self.top_k]:
+            if used + len(chunks[index]) > self.max_chars and selected:
+                continue
+            selected.append(index)
+            used += len(chunks[index])
+        return [chunks[index] for index in sorted(selected)]
+
+    def stats(self) -> dict:
+        """索引状态"""
+        return {
+            "path": self.path,
+            "chunks": len(self.chunks),
+            "chars": sum(len(chunk) for chunk in self.chunks),
+            "top_k": self.top_k,
+            "max_chars": self.max_chars
+        }
+
+
+faq_index = KnowledgeIndex(
+    os.getenv("FAQ_PATH", "faq.txt"),
+    top_k=int(os.getenv("FAQ_TOP_K", "4")),
+    max_chars=int(os.getenv("FAQ_MAX_CHARS", "1200"))
+)
@@ -5,11 +5,18 @@
 import os
 import json
 import re
+import asyncio
 import httpx
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from datetime import datetime, timedelta
 from calculator import FortuneCalculator
-from schemas import LifeCurveResponse, ChartDataPoint, PeakValley
+from schemas import LifeCurveResponse, ChartDataPoint, PeakValley, validate_scores
+from .deadline import Deadline
+from .timeline import resolve_window, summarize_window
+from .chart_codec import chart_codec
+
+# 为默认数据融合和序列化预留的秒数
+FALLBACK_RESERVE_SECONDS = 1.0
 
 
 class LifeLineService:
@@ -20,24 +27,19 @@ class LifeLineService:
         self.deepseek_api_key = os.getenv("DEEPSEEK_API_KEY", "")
         self.deepseek_base_url = os.getenv("DEEPSEEK_API_BASE_URL", "https://api.deepseek.com/v1")
     
-    def _calculate_timeline(
+    def _calculate_chart(
         self, 
         birth_date: str, 
         birth_time: str,
         lng: float,
         lat: float,
         gender: str
-    ) -> List[Dict]:
+    ) -> Tuple[int, List[str], List[Dict]]:
         """
-        Step A: 硬计算 - 生成 0-100 岁的时间轴
-        
-        使用 lunar_python 计算：
-        1. 八字原局
-        2. 大运列表
-        3. 每年对应的流年干支
+        Step A: 硬计算 - 八字原局与大运
         
         Returns:
-            时间轴列表，每个元素包含 age, year, gan_zhi, da_yun
+            (出生年份, 四柱干支列表, 大运列表)
         """
         # 1. 计算真太阳时
         true_solar_time = self.calculator.calculate_true_solar_time(
@@ -56,23 +58,31 @@ class LifeLineService:
         # 3. 计算大运
         da_yun_list = self.calculator.calculate_da_yun(si_zhu, gender, birth_date)
         
-        # 4. 生成 0-100 岁的时间轴（每年一个数据点）
-        timeline = []
-        birth_year = true_solar_time.year
-        birth_month = true_solar_time.month
-        birth_day = true_solar_time.day
+        return true_solar_time.year, bazi, da_yun_list
+    
+    def _iter_timeline(
+        self,
+        birth_year: int,
+        bazi: List[str],
+        da_yun_list: List[Dict],
+        from_age: int = 0,
+        to_age: int = 100
+    ) -> Iterator[Dict]:
+        """
+        逐年生成 [from_age, to_age] 区间的时间轴（只计算被取用的年份）
         
-        for age in range(101):  # 0-100 岁
+        Yields:
+            age, year, gan_zhi（流年干支）, da_yun（所在大运）, bazi
+        """
+        from lunar_python import Solar
+        for age in range(from_age, to_age + 1):
             year = birth_year + age
             
             # 计算该年龄对应的流年干支
             # 流年干支就是该年的农历年干支
-            from lunar_python import Solar
             solar = Solar.fromYmd(year, 1, 1)  # 使用该年的1月1日计算年干支
             lunar = solar.getLunar()
-            year_gan = lunar.getYearGan()
-            year_zhi = lunar.getYearZhi()
-            liu_nian_gan_zhi = year_gan + year_zhi
+            liu_nian_gan_zhi = lunar.getYearGan() + lunar.getYearZhi()
             
             # 判断当前年龄属于哪个大运
             # 大运通常每10年一换
@@ -93,15 +103,13 @@ class LifeLineService:
                     if age >= last_dayun.get('age_end', 80):
                         current_dayun = last_dayun.get('gan_zhi', '')
             
-            timeline.append({
+            yield {
                 'age': age,
                 'year': year,
                 'gan_zhi': liu_nian_gan_zhi,
                 'da_yun': current_dayun,
                 'bazi': bazi
-            })
-        
-        return timeline, bazi, da_yun_list
+            }
     
     def _clean_ai_response(self, text: str) -> Dict:
         """
@@ -158,24 +166,16 @@ class LifeLineService:
         
         将八字原局和大运列表放入 System Prompt
         """
-        # 格式化大运列表
-        dayun_text = ""
-        for i, dy in enumerate(da_yun_list):
-            age_start = dy.get('age_start', 0)
-            age_end = dy.get('age_end', 10)
-            gan_zhi = dy.get('gan_zhi', '')
-            dayun_text += f"{age_start}-{age_end}岁: {gan_zhi}\n"
+        # 四柱与大运使用统一的命盘紧凑编码
+        chart_text = chart_codec.encode(
+            {"chart": {"si_zhu": dict(zip(("year", "month", "day", "hour"), bazi))}, "da_yun": da_yun_list},
+            ("pillars", "da_yun")
+        )
         
         prompt = f"""你是一位精通八字命理的大师。请根据用户的八字原局和大运，推演其 0-100 岁的运势曲线。
 
-用户八字原局：
-年柱：{bazi[0]}
-月柱：{bazi[1]}
-日柱：{bazi[2]}
-时柱：{bazi[3]}
-
-大运列表：
-{dayun_text}
+用户八字原局与大运：
+{chart_text}
 
 请严格返回 JSON 格式，包含以下字段：
 {{
@@ -200,15 +200,19 @@ class LifeLineService:
         
         return prompt
     
-    async def _call_deepseek_api(self, prompt: str) -> Dict:
+    async def _call_deepseek_api(self, prompt: str, deadline: Optional[Deadline] = None) -> Dict:
         """
         Step C: 调用 DeepSeek API
         
-        使用 httpx 异步调用 DeepSeek API
+        使用 httpx 异步调用 DeepSeek API；传入 deadline 时超时取剩余预算（上限 60 秒）
         """
         if not self.deepseek_api_key:
             raise ValueError("DEEPSEEK_API_KEY 未配置，请在 .env 文件中设置")
         
+        timeout = deadline.timeout(cap=60.0, reserve=FALLBACK_RESERVE_SECONDS) if deadline else 60.0
+        if timeout <= 0:
+            raise asyncio.TimeoutError("耗时预算已用尽，跳过 DeepSeek 调用")
+        
         url = f"{self.deepseek_base_url}/chat/completions"
         headers = {
             "Content-Type": "application/json",
@@ -231,8 +235,8 @@ class LifeLineService:
             "max_tokens": 2000
         }
         
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(url, json=payload, headers=headers)
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            response = await asyncio.wait_for(client.post(url, json=payload, headers=headers), timeout=timeout)
             response.raise_for_status()
             result = response.json()
             
@@ -245,14 +249,15 @@ class LifeLineService:
     
     def _merge_data(
         self,
-        timeline: List[Dict],
+        timeline: Iterable[Dict],
         ai_response: Dict,
         birth_year: int
     ) -> List[ChartDataPoint]:
         """
         Step D: 数据融合
         
-        将 AI 返回的 scores、peaks、valleys 与时间轴合并
+        将 AI 返回的 scores、peaks、valleys 与时间轴合并（时间轴可以只是某个年龄窗口）
+        scores 须已经过 validate_scores，数据点直接构造，不再逐点校验
         """
         scores = ai_response.get("scores", [])
         peaks = ai_response.get("peaks", [])
@@ -263,14 +268,14 @@ class LifeLineService:
         valleys_dict = {v["age"]: v for v in valleys}
         
         chart_data = []
-        for i, point in enumerate(timeline):
+        for point in timeline:
             age = point["age"]
             year = point["year"]
             gan_zhi = point["gan_zhi"]
             da_yun = point.get("da_yun", "")
             
             # 获取分数（确保有 101 个数据点）
-            score = scores[i] if i < len(scores) else 60
+            score = scores[age] if age < len(scores) else 60
             
             # 判断是否为高峰或低谷
             is_peak = age in peaks_dict
@@ -299,7 +304,7 @@ class LifeLineService:
                 details = "运势较差，注意防范"
                 label = "凶"
             
-            chart_data.append(ChartDataPoint(
+            chart_data.append(ChartDataPoint.model_construct(
                 age=age,
                 year=year,
                 score=score,
@@ -320,7 +325,10 @@ class LifeLineService:
         lng: float,
         lat: float,
         gender: str,
-        name: str = "用户"
+        name: str = "用户",
+        deadline: Optional[Deadline] = None,
+        from_age: Optional[int] = None,
+        to_age: Optional[int] = None
     ) -> LifeCurveResponse:
         """
         生成人生 K 线数据
@@ -332,12 +340,19 @@ class LifeLineService:
             lat: 纬度
             gender: 性别 (male/female)
             name: 姓名
+            deadline: 请求截止时间（预算耗尽时使用默认数据）
+            from_age / to_age: 只返回该年龄区间的数据点（默认 0-100）
         
         Returns:
-            LifeCurveResponse 对象
+            LifeCurveResponse 对象（window 为该区间的统计摘要）
+        
+        Raises:
+            ValueError: 年龄区间不合法
         """
-        # Step A: 硬计算 - 生成时间轴
-        timeline, bazi, da_yun_list = self._calculate_timeline(
+        window_start, window_end = resolve_window(from_age, to_age)
+        
+        # Step A: 硬计算 - 八字原局与大运（时间轴在数据融合时按窗口逐年生成）
+        birth_year, bazi, da_yun_list = self._calculate_chart(
             birth_date, birth_time, lng, lat, gender
         )
         
@@ -348,7 +363,7 @@ class LifeLineService:
         ai_response = None
         try:
             print(f"🤖 开始调用 DeepSeek API...", flush=True)
-            ai_response = await self._call_deepseek_api(prompt)
+            ai_response = await self._call_deepseek_api(prompt, deadline)
             print(f"✅ DeepSeek API 调用成功", flush=True)
         except Exception as e:
             print(f"⚠️  DeepSeek API 调用失败: {e}", flush=True)
@@ -384,19 +399,24 @@ class LifeLineService:
                 scores = scores[:101]
             ai_response["scores"] = scores
         
-        # Step D: 数据融合
+        # 整条分数数组校验一次（非整数 / 超出 0-100 的分数记为 60）
+        ai_response["scores"] = validate_scores(ai_response["scores"])
+        
+        # Step D: 数据融合（只为窗口内的年份生成时间轴和数据点）
+        timeline = self._iter_timeline(birth_year, bazi, da_yun_list, window_start, window_end)
         birth_year = datetime.strptime(birth_date, "%Y-%m-%d").year
         chart_data = self._merge_data(timeline, ai_response, birth_year)
+        scores = ai_response["scores"]
         
         # 计算当前分数（假设当前年龄为 30 岁，实际应该根据当前日期计算）
         current_age = 30  # 可以改为根据当前日期计算
-        current_score = chart_data[current_age].score if current_age < len(chart_data) else 60
+        current_score = scores[current_age] if current_age < len(scores) else 60
         
         # 计算趋势（简单判断：最近 5 年的平均分数趋势）
-        if len(chart_data) >= 5:
-            recent_scores = [d.score for d in chart_data[-5:]]
+        if len(scores) >= 5:
+            recent_scores = scores[-5:]
             avg_recent = sum(recent_scores) / len(recent_scores)
-            earlier_scores = [d.score for d in chart_data[-10:-5]] if len(chart_data) >= 10 else recent_scores
+            earlier_scores = scores[-10:-5] if len(scores) >= 10 else recent_scores
             avg_earlier = sum(earlier_scores) / len(earlier_scores) if earlier_scores else avg_recent
             if avg_recent > avg_earlier + 5:
                 trend = "上升"
@@ -413,7 +433,7 @@ class LifeLineService:
                 age=p["age"],
                 year=birth_year + p["age"],
                 reason=p.get("reason", ""),
-                score=chart_data[p["age"]].score if p["age"] < len(chart_data) else None
+                score=scores[p["age"]] if p["age"] < len(scores) else None
             )
             for p in ai_response.get("peaks", [])
         ]
@@ -423,13 +443,13 @@ class LifeLineService:
                 age=v["age"],
                 year=birth_year + v["age"],
                 reason=v.get("reason", ""),
-                score=chart_data[v["age"]].score if v["age"] < len(chart_data) else None
+                score=scores[v["age"]] if v["age"] < len(scores) else None
             )
             for v in ai_response.get("valleys", [])
         ]
         
-        # 构建响应
-        return LifeCurveResponse(
+        # 构建响应（各部分均已校验，直接构造）
+        return LifeCurveResponse.model_construct(
             user_profile={
                 "name": name,
                 "bazi": bazi
@@ -438,10 +458,15 @@ class LifeLineService:
             summary={
                 "current_score": current_score,
                 "trend": trend,
-                "peaks": [p.dict() for p in peaks],
-                "valleys": [v.dict() for v in valleys],
+                "peaks": [p.model_dump() for p in peaks],
+                "valleys": [v.model_dump() for v in valleys],
                 "advice": ai_response.get("advice", "请根据个人实际情况调整人生规划")
-            }
+            },
+            window=summarize_window(
+                ((point.age, point.score) for point in chart_data),
+                window_start, window_end,
+                [p.model_dump() for p in peaks], [v.model_dump() for v in valleys]
+            )
         )
 
 
@@ -0,0 +1,96 @@
+"""
+LLM 并发槽位调度
+限制同时进行的上游 LLM 调用数量，排队时按优先级放行（数值越小越优先）：
+- PRIORITY_INTERACTIVE：用户正在等待的流式生成
+- PRIORITY_BACKGROUND：预计算、预取等后台任务
+后台任务可以带 tag 排队；用户开始等待该任务的结果时，按 tag 把它提升为交互优先级。
+"""
+import asyncio
+import heapq
+import itertools
+import os
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+class LLMScheduler:
+    """按优先级排队的并发槽位"""
+
+    def __init__(self, max_concurrency: int = 8):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.active = 0
+        self._waiters = []  # (priority, seq, future, tag)
+        self._counter = itertools.count()
+        self._promoted: Dict[str, int] = {}  # tag → 提升后的优先级
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE, tag: Optional[str] = None):
+        """占用一个槽位，没有空闲槽位时排队等待"""
+        if tag in self._promoted:
+            priority = min(priority, self._promoted[tag])
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future, tag))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 槽位已移交但调用方同时被取消：归还槽位
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        """归还槽位；有排队者时直接移交给优先级最高的一个"""
+        while self._waiters:
+            _, _, future, _ = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def promote(self, tag: str, priority: int = PRIORITY_INTERACTIVE):
+        """
+        提升带 tag 的请求的优先级（正在排队的立即生效，之后才排队的按提升后的优先级排队）
+
+        调用方在任务结束后应调用 forget(tag)。
+        """
+        self._promoted[tag] = min(priority, self._promoted.get(tag, priority))
+        changed = False
+        for index, (waiter_priority, seq, future, waiter_tag) in enumerate(self._waiters):
+            if waiter_tag == tag and waiter_priority > priority and not future.done():
+                self._waiters[index] = (priority, seq, future, waiter_tag)
+                changed = True
+        if changed:
+            heapq.heapify(self._waiters)
+
+    def forget(self, tag: str):
+        """清除 tag 的优先级提升记录"""
+        self._promoted.pop(tag, None)
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_INTERACTIVE, tag: Optional[str] = None):
+        """在 async with 块内占用一个槽位"""
+        await self.acquire(priority, tag)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        """当前槽位占用情况"""
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "waiting": sum(1 for _, _, f, _ in self._waiters if not f.done())
+        }
+
+
+# 创建全局实例
+llm_scheduler = LLMScheduler(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+)
@@ -0,0 +1,182 @@
+"""
+梅花易数起卦
+单一事件起卦原先由模型根据用户的三个数字自行起卦、推体用，输出冗长且同样的数字每次结果不同。
+这里按三数起卦法在后端确定性地算出主卦、互卦、变卦、动爻与体用生克，模型只负责解读：
+- 第一个数取上卦，第二个数取下卦（除 8 取余，先天八卦数：乾1 兑2 离3 震4 巽5 坎6 艮7 坤8）
+- 三数之和除 6 取余为动爻（余 0 为上爻）
+- 动爻所在的经卦为用卦，另一经卦为体卦
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+# 先天八卦：名称、五行、爻（自下而上，1 为阳爻）、卦象
+TRIGRAMS = {
+    "乾": {"number": 1, "element": "金", "lines": (1, 1, 1), "image": "天"},
+    "兑": {"number": 2, "element": "金", "lines": (1, 1, 0), "image": "泽"},
+    "离": {"number": 3, "element": "火", "lines": (1, 0, 1), "image": "火"},
+    "震": {"number": 4, "element": "木", "lines": (1, 0, 0), "image": "雷"},
+    "巽": {"number": 5, "element": "木", "lines": (0, 1, 1), "image": "风"},
+    "坎": {"number": 6, "element": "水", "lines": (0, 1, 0), "image": "水"},
+    "艮": {"number": 7, "element": "土", "lines": (0, 0, 1), "image": "山"},
+    "坤": {"number": 8, "element": "土", "lines": (0, 0, 0), "image": "地"},
+}
+TRIGRAM_BY_NUMBER = {info["number"]: name for name, info in TRIGRAMS.items()}
+TRIGRAM_BY_LINES = {info["lines"]: name for name, info in TRIGRAMS.items()}
+
+# 六十四卦卦名：上卦 → 下卦（按先天数顺序：乾 兑 离 震 巽 坎 艮 坤）
+_HEXAGRAM_NAMES = {
+    "乾": ("乾为天", "天泽履", "天火同人", "天雷无妄", "天风姤", "天水讼", "天山遁", "天地否"),
+    "兑": ("泽天夬", "兑为泽", "泽火革", "泽雷随", "泽风大过", "泽水困", "泽山咸", "泽地萃"),
+    "离": ("火天大有", "火泽睽", "离为火", "火雷噬嗑", "火风鼎", "火水未济", "火山旅", "火地晋"),
+    "震": ("雷天大壮", "雷泽归妹", "雷火丰", "震为雷", "雷风恒", "雷水解", "雷山小过", "雷地豫"),
+    "巽": ("风天小畜", "风泽中孚", "风火家人", "风雷益", "巽为风", "风水涣", "风山渐", "风地观"),
+    "坎": ("水天需", "水泽节", "水火既济", "水雷屯", "水风井", "坎为水", "水山蹇", "水地比"),
+    "艮": ("山天大畜", "山泽损", "山火贲", "山雷颐", "山风蛊", "山水蒙", "艮为山", "山地剥"),
+    "坤": ("地天泰", "地泽临", "地火明夷", "地雷复", "地风升", "地水师", "地山谦", "坤为地"),
+}
+
+
+def _build_hexagrams() -> Dict[Tuple[int, ...], Dict]:
+    """预先算好六十四卦：六爻（自下而上）→ 卦信息"""
+    table = {}
+    for upper, names in _HEXAGRAM_NAMES.items():
+        for number, full_name in enumerate(names, start=1):
+            lower = TRIGRAM_BY_NUMBER[number]
+            short = full_name[0] if "为" in full_name else full_name[2:]
+            table[TRIGRAMS[lower]["lines"] + TRIGRAMS[upper]["lines"]] = {
+                "name": full_name, "short": short, "upper": upper, "lower": lower
+            }
+    return table
+
+
+HEXAGRAMS = _build_hexagrams()
+
+# 五行生克
+SHENG = {"木": "火", "火": "土", "土": "金", "金": "水", "水": "木"}
+KE = {"木": "土", "土": "水", "水": "火", "火": "金", "金": "木"}
+
+# 体用关系 → 吉凶
+RELATION_VERDICTS = {
+    "比和": "吉（体用同气，事易成）",
+    "用生体": "大吉（外力相助，有进益）",
+    "体克用": "吉（可以掌控局面，但需付出）",
+    "体生用": "小凶（付出多、耗损大）",
+    "用克体": "凶（外部压力大，主导权不在己）",
+}
+
+LINE_NAMES = ("初爻", "二爻", "三爻", "四爻", "五爻", "上爻")
+
+
+def element_relation(ti: str, yong: str) -> str:
+    """体用五行关系（比和 / 用生体 / 体生用 / 体克用 / 用克体）"""
+    if ti == yong:
+        return "比和"
+    if SHENG[yong] == ti:
+        return "用生体"
+    if SHENG[ti] == yong:
+        return "体生用"
+    if KE[ti] == yong:
+        return "体克用"
+    return "用克体"
+
+
+def _hexagram(lines: Tuple[int, ...]) -> Dict:
+    info = HEXAGRAMS[lines]
+    return {**info, "lines": list(lines)}
+
+
+def cast_by_numbers(first: int, second: int, third: int) -> Dict:
+    """
+    三数起卦
+
+    Args:
+        first: 第一个数（取上卦）
+        second: 第二个数（取下卦）
+        third: 第三个数（与前两数之和取动爻）
+
+    Returns:
+        numbers, primary（主卦）, mutual（互卦）, changed（变卦）, moving_line（1-6）,
+        ti / yong（体卦、用卦及五行）, relation（体用关系）, verdict（吉凶）,
+        changed_relation（体卦与变卦用卦的关系，看结果走向）
+    """
+    upper = TRIGRAM_BY_NUMBER[first % 8 or 8]
+    lower = TRIGRAM_BY_NUMBER[second % 8 or 8]
+    moving_line = (first + second + third) % 6 or 6
+
+    lines = TRIGRAMS[lower]["lines"] + TRIGRAMS[upper]["lines"]
+    mutual_lines = lines[1:4] + lines[2:5]
+    changed_lines = tuple(1 - line if index == moving_line - 1 else line for index, line in enumerate(lines))
+
+    # 动爻在下卦则下卦为用，上卦为体；反之亦然
+    if moving_line <= 3:
+        ti, yong = upper, lower
+        changed_yong = TRIGRAM_BY_LINES[changed_lines[:3]]
+    else:
+        ti, yong = lower, upper
+        changed_yong = TRIGRAM_BY_LINES[changed_lines[3:]]
+
+    ti_element = TRIGRAMS[ti]["element"]
+    relation = element_relation(ti_element, TRIGRAMS[yong]["element"])
+    changed_relation = element_relation(ti_element, TRIGRAMS[changed_yong]["element"])
+    return {
+        "numbers": [first, second, third],
+        "primary": _hexagram(lines),
+        "mutual": _hexagram(mutual_lines),
+        "changed": _hexagram(changed_lines),
+        "moving_line": moving_line,
+        "ti": {"trigram": ti, "element": ti_element},
+        "yong": {"trigram": yong, "element": TRIGRAMS[yong]["element"]},
+        "relation": relation,
+        "verdict": RELATION_VERDICTS[relation],
+        "changed_relation": changed_relation,
+        "changed_verdict": RELATION_VERDICTS[changed_relation]
+    }
+
+
+def format_cast(cast: Dict) -> str:
+    """起卦结果 → 注入提示词的事实文本"""
+    ti, yong = cast["ti"], cast["yong"]
+    return "\n".join([
+        f"起卦数字：{'、'.join(str(n) for n in cast['numbers'])}（三数起卦）",
+        f"主卦：{cast['primary']['name']}（上{cast['primary']['upper']}下{cast['primary']['lower']}），"
+        f"动爻：{LINE_NAMES[cast['moving_line'] - 1]}",
+        f"互卦：{cast['mutual']['name']}",
+        f"变卦：{cast['changed']['name']}",
+        f"体卦：{ti['trigram']}（{ti['element']}），用卦：{yong['trigram']}（{yong['element']}）",
+        f"体用关系：{cast['relation']}，{cast['verdict']}",
+        f"变卦用卦与体卦：{cast['changed_relation']}，{cast['changed_verdict']}"
+    ])
+
+
+_NUMBER_HINT = re.compile(r"(?:数字|号码)[^\d]{0,8}?(\d{1,4})[\s,，、/和.]+(\d{1,4})[\s,，、/和.]+(\d{1,4})")
+_NUMBER_RUN = re.compile(r"(?<![\d:：.\-/年月日])(\d{1,4})[\s,，、]+(\d{1,4})[\s,，、]+(\d{1,4})(?![\d:：.\-/年月日时点号岁])")
+# 紧跟“出生 / 生”的数字是生日，不是起卦数
+_BIRTH_SUFFIX = re.compile(r"\s*(?:出生|生于|生)")
+
+
+def _looks_like_date(numbers: List[int]) -> bool:
+    """年 月 日（如 1990 5 3）"""
+    year, month, day = numbers
+    return 1900 <= year <= 2100 and 1 <= month <= 12 and 1 <= day <= 31
+
+
+def extract_numbers(text: str, allow_bare: bool = False) -> Optional[List[int]]:
+    """
+    从用户消息中提取起卦用的三个数字
+
+    默认只取“数字”“号码”后的三个数；allow_bare=True（本条消息是在回答“请提供三个数字”）时，
+    也取最后一组以分隔符连写的三个数，但排除日期、时间和以空格分隔的生日（如 1990 5 3）。
+    """
+    if not text:
+        return None
+    match = _NUMBER_HINT.search(text)
+    if match:
+        return [int(group) for group in match.groups()]
+    if not allow_bare:
+        return None
+    for match in reversed(list(_NUMBER_RUN.finditer(text))):
+        numbers = [int(group) for group in match.groups()]
+        if _looks_like_date(numbers) or _BIRTH_SUFFIX.match(text, match.end()):
+            continue
+        return numbers
+    return None
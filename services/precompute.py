@@ -0,0 +1,129 @@
+"""
+投机预计算
+在用户大概率马上需要某个结果之前（如保存命书后打开 K 线页）提前在后台生成：
+- 同一个 key 同时只跑一次（后到的请求等待同一个任务）
+- 每日预算上限（总量，可选按用户），超出后不再预计算
+"""
+import asyncio
+import os
+from datetime import date
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+
+class SpeculativePrecompute:
+    """按 key 去重、带每日预算的后台预计算"""
+
+    def __init__(self, name: str, enabled: bool = True, daily_budget: int = 200,
+                 owner_daily_budget: Optional[int] = None):
+        self.name = name
+        self.enabled = enabled
+        self.daily_budget = daily_budget
+        self.owner_daily_budget = owner_daily_budget
+        self.in_flight: Dict[str, asyncio.Task] = {}
+        self.used_today = 0
+        self.used_by_owner: Dict[str, int] = {}
+        self.deduped = 0
+        self.skipped_over_budget = 0
+        self._day: Optional[date] = None
+        self._background: Set[asyncio.Task] = set()
+
+    def _roll_day(self):
+        today = date.today()
+        if self._day != today:
+            self._day = today
+            self.used_today = 0
+            self.used_by_owner.clear()
+
+    def schedule(self, key: str, job_factory: Callable[[], Awaitable[None]],
+                 owner: Optional[str] = None) -> Optional[asyncio.Task]:
+        """
+        提交一次预计算
+
+        Args:
+            key: 去重键（相同 key 的预计算结果可以共用）
+            job_factory: 返回预计算协程的函数
+            owner: 发起用户（设置了 owner_daily_budget 时按用户计入预算）
+
+        Returns:
+            正在执行的任务（已有同 key 任务时返回该任务）；未启用或超出当日预算时返回 None
+        """
+        if not self.enabled:
+            return None
+        if key in self.in_flight:
+            self.deduped += 1
+            return self.in_flight[key]
+
+        self._roll_day()
+        if self.used_today >= self.daily_budget:
+            self.skipped_over_budget += 1
+            print(f"⚠️  {self.name} 已达今日预算（{self.daily_budget}），跳过预计算", flush=True)
+            return None
+        if owner is not None and self.owner_daily_budget is not None:
+            if self.used_by_owner.get(owner, 0) >= self.owner_daily_budget:
+                self.skipped_over_budget += 1
+                print(f"⚠️  {self.name} 用户 {owner} 已达今日预算（{self.owner_daily_budget}），跳过预计算", flush=True)
+                return None
+            self.used_by_owner[owner] = self.used_by_owner.get(owner, 0) + 1
+
+        self.used_today += 1
+        task = asyncio.create_task(self._run(key, job_factory))
+        self.in_flight[key] = task
+        return task
+
+    def running(self, key: str) -> Optional[asyncio.Task]:
+        """同 key 正在执行的预计算（没有时返回 None）"""
+        return self.in_flight.get(key)
+
+    async def _run(self, key: str, job_factory: Callable[[], Awaitable[None]]):
+        try:
+            await job_factory()
+        except Exception as e:
+            print(f"⚠️  {self.name} 预计算失败（{key[:12]}）: {e}", flush=True)
+        finally:
+            self.in_flight.pop(key, None)
+
+    def spawn(self, coro: Awaitable[None]):
+        """在后台运行协程（保留引用，避免任务被提前回收）"""
+        if not self.enabled:
+            coro.close()
+            return
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def stats(self) -> dict:
+        """预计算状态"""
+        self._roll_day()
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self.in_flight),
+            "used_today": self.used_today,
+            "daily_budget": self.daily_budget,
+            "owner_daily_budget": self.owner_daily_budget,
+            "deduped": self.deduped,
+            "skipped_over_budget": self.skipped_over_budget
+        }
+
+
+# 保存命书后预生成 K 线
+kline_precompute = SpeculativePrecompute(
+    "K线预计算",
+    enabled=os.getenv("KLINE_PRECOMPUTE_ENABLED", "false").lower() == "true",
+    daily_budget=int(os.getenv("KLINE_PRECOMPUTE_DAILY_BUDGET", "200"))
+)
+
+# 查看某一年详情时预取相邻年份的流年解读
+kline_year_prefetch = SpeculativePrecompute(
+    "流年详情预取",
+    enabled=os.getenv("KLINE_YEAR_PREFETCH_ENABLED", "true").lower() == "true",
+    daily_budget=int(os.getenv("KLINE_YEAR_PREFETCH_DAILY_BUDGET", "2000")),
+    owner_daily_budget=int(os.getenv("KLINE_YEAR_PREFETCH_USER_DAILY_BUDGET", "60"))
+)
+
+# 首次起卦回答后预取各 tab（起大运、看事业……）的回答
+chat_tab_prefetch = SpeculativePrecompute(
+    "对话预取",
+    enabled=os.getenv("CHAT_PREFETCH_ENABLED", "true").lower() == "true",
+    daily_budget=int(os.getenv("CHAT_PREFETCH_DAILY_BUDGET", "3000")),
+    owner_daily_budget=int(os.getenv("CHAT_PREFETCH_USER_DAILY_BUDGET", "30"))
+)
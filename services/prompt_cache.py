@@ -0,0 +1,140 @@
+"""
+上游上下文缓存（静态系统提示词）
+起卦 / 命理分析的系统提示词有数 KB，且与用户无关。这里为每个提示词版本在上游创建一次
+缓存内容（Gemini cachedContents），之后的请求只引用缓存名，不再重复发送和预填充：
+- 缓存的创建和续期都在后台进行，请求路径上只读取已就绪的缓存名，未就绪时照常发送完整提示词
+- 提示词内容变化（版本指纹不同）时创建新缓存，旧缓存尽力删除
+- 上游不支持或调用失败时退避一段时间后再试，期间照常发送完整提示词
+"""
+import asyncio
+import hashlib
+import os
+import time
+from typing import Any, Dict, Optional, Set
+
+
+class PromptCache:
+    """按 key 管理静态提示词的上游缓存"""
+
+    def __init__(self, enabled: bool = True, ttl_seconds: int = 3600, refresh_margin_seconds: int = 300,
+                 retry_seconds: int = 600):
+        """
+        Args:
+            enabled: 关闭时 handle() 始终返回 None
+            ttl_seconds: 上游缓存的有效期
+            refresh_margin_seconds: 到期前多久开始续期
+            retry_seconds: 创建失败后多久再试
+        """
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.retry_seconds = retry_seconds
+        self.entries: Dict[str, Dict[str, Any]] = {}  # key → {version, name, expires_at}
+        self.retry_at: Dict[str, float] = {}
+        self.pending: Set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self._background: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def version(model: str, system_instruction: str) -> str:
+        """提示词版本指纹"""
+        return hashlib.sha1(f"{model}\n{system_instruction}".encode("utf-8")).hexdigest()[:16]
+
+    def handle(self, client: Any, key: str, model: str, system_instruction: str) -> Optional[str]:
+        """
+        读取可用的缓存名（不阻塞：未就绪时在后台创建，快到期时在后台续期）
+
+        Args:
+            client: GenAI 客户端（需支持 caches.create / update / delete）
+            key: 提示词标识（如 divination）
+            model: 模型名（缓存与模型绑定）
+            system_instruction: 完整的静态提示词
+
+        Returns:
+            上游缓存名；没有可用缓存时返回 None（调用方照常发送完整提示词）
+        """
+        if not self.enabled or client is None:
+            return None
+        version = self.version(model, system_instruction)
+        entry = self.entries.get(key)
+        now = time.time()
+        if entry and entry["version"] == version and now < entry["expires_at"]:
+            if now >= entry["expires_at"] - self.refresh_margin_seconds:
+                self._spawn(key, self._refresh(client, key, entry))
+            self.hits += 1
+            return entry["name"]
+
+        self.misses += 1
+        if now >= self.retry_at.get(key, 0):
+            self._spawn(key, self._create(client, key, model, system_instruction, version))
+        return None
+
+    def invalidate(self, key: str):
+        """使用缓存的请求失败时调用（上游缓存可能已被清理），下次请求重新创建"""
+        self.entries.pop(key, None)
+
+    def _spawn(self, key: str, coro):
+        if key in self.pending:
+            coro.close()
+            return
+        self.pending.add(key)
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        task.add_done_callback(lambda _: self.pending.discard(key))
+
+    async def _create(self, client: Any, key: str, model: str, system_instruction: str, version: str):
+        try:
+            cache = await asyncio.to_thread(
+                client.caches.create,
+                model=model,
+                config={
+                    "system_instruction": system_instruction,
+                    "display_name": f"{key}-{version}",
+                    "ttl": f"{self.ttl_seconds}s"
+                }
+            )
+        except Exception as e:
+            self.failures += 1
+            self.retry_at[key] = time.time() + self.retry_seconds
+            print(f"⚠️  提示词缓存 {key} 创建失败，{self.retry_seconds} 秒内使用完整提示词: {e}", flush=True)
+            return
+
+        previous = self.entries.get(key)
+        self.entries[key] = {"version": version, "name": cache.name, "expires_at": time.time() + self.ttl_seconds}
+        self.retry_at.pop(key, None)
+        print(f"✅ 提示词缓存 {key} 已创建: {cache.name}", flush=True)
+        if previous and previous["name"] != cache.name:
+            try:
+                await asyncio.to_thread(client.caches.delete, name=previous["name"])
+            except Exception as e:
+                print(f"⚠️  旧提示词缓存删除失败（到期后自动清理）: {e}", flush=True)
+
+    async def _refresh(self, client: Any, key: str, entry: Dict[str, Any]):
+        try:
+            await asyncio.to_thread(client.caches.update, name=entry["name"], config={"ttl": f"{self.ttl_seconds}s"})
+            entry["expires_at"] = time.time() + self.ttl_seconds
+        except Exception as e:
+            # 续期失败：保留到原到期时间，到期后重新创建
+            self.failures += 1
+            print(f"⚠️  提示词缓存 {key} 续期失败: {e}", flush=True)
+
+    def stats(self) -> dict:
+        """缓存状态"""
+        return {
+            "enabled": self.enabled,
+            "handles": {key: entry["name"] for key, entry in self.entries.items()},
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures
+        }
+
+
+prompt_cache = PromptCache(
+    enabled=os.getenv("PROMPT_CACHE_ENABLED", "true").lower() == "true",
+    ttl_seconds=int(os.getenv("PROMPT_CACHE_TTL_SECONDS", "3600")),
+    refresh_margin_seconds=int(os.getenv("PROMPT_CACHE_REFRESH_MARGIN_SECONDS", "300")),
+    retry_seconds=int(os.getenv("PROMPT_CACHE_RETRY_SECONDS", "600"))
+)
@@ -0,0 +1,199 @@
+"""
+奇门遁甲排盘（时家奇门，转盘，拆补法定局）
+单一事件起卦原先让模型按提问时间自行排奇门盘，耗费大量输出且经常排错。这里在后端确定性地排盘：
+- 定局：按当前节气与日干支的符头（甲 / 己日）定上中下元，查阴阳遁局数
+- 地盘：三奇六仪（戊己庚辛壬癸丁丙乙）从局数所在宫起，阳遁顺布、阴遁逆布
+- 天盘 / 九星：值符随时干转到时干所在宫，其余八星沿外圈同步旋转（天禽随天芮）
+- 八门：值使按时辰距旬首的步数在九宫中阳顺阴逆行进，其余七门沿外圈同步旋转
+- 八神：值符神落天盘值符宫，阳遁顺排、阴遁逆排
+
+18 个局 × 60 个时辰干支的盘面在模块加载时全部预先算好，每次排盘只需查表。
+"""
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+TIAN_GAN = "甲乙丙丁戊己庚辛壬癸"
+DI_ZHI = "子丑寅卯辰巳午未申酉戌亥"
+JIA_ZI = [TIAN_GAN[i % 10] + DI_ZHI[i % 12] for i in range(60)]
+
+PALACE_NAMES = {1: "坎一", 2: "坤二", 3: "震三", 4: "巽四", 5: "中五", 6: "乾六", 7: "兑七", 8: "艮八", 9: "离九"}
+
+# 外圈八宫（顺时针）：坎 → 艮 → 震 → 巽 → 离 → 坤 → 兑 → 乾
+RING = (1, 8, 3, 4, 9, 2, 7, 6)
+
+STAR_HOME = {1: "天蓬", 2: "天芮", 3: "天冲", 4: "天辅", 5: "天禽", 6: "天心", 7: "天柱", 8: "天任", 9: "天英"}
+GATE_HOME = {1: "休门", 2: "死门", 3: "伤门", 4: "杜门", 6: "开门", 7: "惊门", 8: "生门", 9: "景门"}
+DEITIES = ("值符", "螣蛇", "太阴", "六合", "白虎", "玄武", "九地", "九天")
+
+# 三奇六仪布局顺序
+STEM_ORDER = "戊己庚辛壬癸丁丙乙"
+# 六甲旬首所遁之仪：甲子戊、甲戌己、甲申庚、甲午辛、甲辰壬、甲寅癸
+XUN_YI = "戊己庚辛壬癸"
+
+# 节气 → (阴阳遁, 上元 / 中元 / 下元局数)
+JU_TABLE = {
+    "冬至": ("阳", (1, 7, 4)), "小寒": ("阳", (2, 8, 5)), "大寒": ("阳", (3, 9, 6)),
+    "立春": ("阳", (8, 5, 2)), "雨水": ("阳", (9, 6, 3)), "惊蛰": ("阳", (1, 7, 4)),
+    "春分": ("阳", (3, 9, 6)), "清明": ("阳", (4, 1, 7)), "谷雨": ("阳", (5, 2, 8)),
+    "立夏": ("阳", (4, 1, 7)), "小满": ("阳", (5, 2, 8)), "芒种": ("阳", (6, 3, 9)),
+    "夏至": ("阴", (9, 3, 6)), "小暑": ("阴", (8, 2, 5)), "大暑": ("阴", (7, 1, 4)),
+    "立秋": ("阴", (2, 5, 8)), "处暑": ("阴", (1, 4, 7)), "白露": ("阴", (9, 3, 6)),
+    "秋分": ("阴", (7, 1, 4)), "寒露": ("阴", (6, 9, 3)), "霜降": ("阴", (5, 8, 2)),
+    "立冬": ("阴", (6, 9, 3)), "小雪": ("阴", (5, 8, 2)), "大雪": ("阴", (4, 7, 1)),
+}
+
+YUAN_NAMES = ("上元", "中元", "下元")
+# 符头地支 → 元：子午卯酉上元，寅申巳亥中元，辰戌丑未下元
+YUAN_BY_ZHI = {zhi: index for index, group in enumerate(("子午卯酉", "寅申巳亥", "辰戌丑未")) for zhi in group}
+
+
+def _next_palace(palace: int, yang: bool) -> int:
+    """九宫按数序行进一步（阳顺阴逆）"""
+    return palace % 9 + 1 if yang else (palace - 2) % 9 + 1
+
+
+def _earth_plate(yang: bool, ju: int) -> Dict[int, str]:
+    """地盘：三奇六仪从局数所在宫起布"""
+    plate = {}
+    palace = ju
+    for stem in STEM_ORDER:
+        plate[palace] = stem
+        palace = _next_palace(palace, yang)
+    return plate
+
+
+def _rotate(mapping: Dict[int, str], start: int, target: int) -> Dict[int, str]:
+    """外圈八宫整体旋转，使 start 宫的内容落到 target 宫"""
+    shift = RING.index(target) - RING.index(start)
+    return {RING[(index + shift) % 8]: mapping[palace] for index, palace in enumerate(RING)}
+
+
+def _build_plate(yang: bool, ju: int, hour_index: int) -> Dict:
+    """某局某时辰干支的完整盘面"""
+    earth = _earth_plate(yang, ju)
+    stem_palace = {stem: palace for palace, stem in earth.items()}
+    gan = JIA_ZI[hour_index][0]
+    xun = hour_index // 10
+    xun_yi = XUN_YI[xun]
+
+    # 值符 / 值使：旬首之仪在地盘所在宫的星与门（中五宫寄坤二）
+    fu_home = stem_palace[xun_yi]
+    fu_ring = fu_home if fu_home != 5 else 2
+    zhi_fu = STAR_HOME[fu_home]
+    zhi_shi = GATE_HOME[fu_ring]
+
+    # 九星与天盘：值符转到时干（甲时用旬首之仪）所在宫
+    hour_stem = xun_yi if gan == "甲" else gan
+    fu_target = stem_palace[hour_stem]
+    fu_target = fu_target if fu_target != 5 else 2
+    stars = _rotate({palace: STAR_HOME[palace] for palace in RING}, fu_ring, fu_target)
+    heaven = _rotate({palace: earth[palace] for palace in RING}, fu_ring, fu_target)
+    qin_palace = next(palace for palace, star in stars.items() if star == "天芮")
+
+    # 八门：值使从旬首宫起，按时辰距旬首的步数在九宫中行进
+    gate_palace = fu_home
+    for _ in range(hour_index % 10):
+        gate_palace = _next_palace(gate_palace, yang)
+    gate_palace = gate_palace if gate_palace != 5 else 2
+    gates = _rotate({palace: GATE_HOME[palace] for palace in RING}, fu_ring, gate_palace)
+
+    # 八神：值符神随天盘值符，阳遁顺排、阴遁逆排
+    start = RING.index(fu_target)
+    deities = {RING[(start + (k if yang else -k)) % 8]: deity for k, deity in enumerate(DEITIES)}
+
+    palaces = []
+    for palace in range(1, 10):
+        if palace == 5:
+            palaces.append({"palace": 5, "name": PALACE_NAMES[5], "earth_stem": earth[5]})
+            continue
+        star, heaven_stem = stars[palace], heaven[palace]
+        if palace == qin_palace:
+            star, heaven_stem = f"{star}禽", f"{heaven_stem}{earth[5]}"
+        palaces.append({
+            "palace": palace,
+            "name": PALACE_NAMES[palace],
+            "deity": deities[palace],
+            "star": star,
+            "gate": gates[palace],
+            "heaven_stem": heaven_stem,
+            "earth_stem": earth[palace]
+        })
+
+    return {
+        "xun_shou": f"{JIA_ZI[xun * 10]}{xun_yi}",
+        "zhi_fu": {"star": zhi_fu, "palace": fu_target},
+        "zhi_shi": {"gate": zhi_shi, "palace": gate_palace},
+        "palaces": palaces
+    }
+
+
+def _build_plates() -> Dict[Tuple[str, int, int], Dict]:
+    """预先排好阴阳遁 18 局 × 60 时辰干支的盘面"""
+    return {
+        (dun, ju, hour_index): _build_plate(dun == "阳", ju, hour_index)
+        for dun in ("阳", "阴") for ju in range(1, 10) for hour_index in range(60)
+    }
+
+
+PLATES = _build_plates()
+
+
+def select_ju(jie_qi: str, day_gan_zhi: str) -> Tuple[str, int, str]:
+    """
+    拆补法定局
+
+    Returns:
+        (阴阳遁, 局数, 元)
+    """
+    dun, jus = JU_TABLE[jie_qi]
+    day_index = JIA_ZI.index(day_gan_zhi)
+    fu_tou = JIA_ZI[(day_index - TIAN_GAN.index(day_gan_zhi[0]) % 5) % 60]
+    yuan = YUAN_BY_ZHI[fu_tou[1]]
+    return dun, jus[yuan], YUAN_NAMES[yuan]
+
+
+def qimen_plate(moment: datetime, calculator) -> Dict:
+    """
+    按时刻排时家奇门盘
+
+    Args:
+        moment: 起局时间（北京时间）
+        calculator: FortuneCalculator（提供节气与干支）
+
+    Returns:
+        jie_qi, yuan, dun, ju, day_gan_zhi, hour_gan_zhi, xun_shou, zhi_fu, zhi_shi, palaces
+    """
+    lunar = calculator.get_lunar_date(moment)
+    dun, ju, yuan = select_ju(lunar["jie_qi"], lunar["day_gan_zhi"])
+    plate = PLATES[(dun, ju, JIA_ZI.index(lunar["hour_gan_zhi"]))]
+    return {
+        "jie_qi": lunar["jie_qi"],
+        "yuan": yuan,
+        "dun": f"{dun}遁",
+        "ju": ju,
+        "day_gan_zhi": lunar["day_gan_zhi"],
+        "hour_gan_zhi": lunar["hour_gan_zhi"],
+        **plate
+    }
+
+
+_JU_NUMERALS = "一二三四五六七八九"
+
+
+def format_qimen(plate: Dict) -> str:
+    """奇门盘 → 注入提示词的事实文本（每宫一行：八神 九星 八门 天盘/地盘）"""
+    lines: List[str] = [
+        f"定局：{plate['jie_qi']}{plate['yuan']}，{plate['dun']}{_JU_NUMERALS[plate['ju'] - 1]}局；"
+        f"日{plate['day_gan_zhi']} 时{plate['hour_gan_zhi']}，旬首{plate['xun_shou']}",
+        f"值符：{plate['zhi_fu']['star']}落{PALACE_NAMES[plate['zhi_fu']['palace']]}宫，"
+        f"值使：{plate['zhi_shi']['gate']}落{PALACE_NAMES[plate['zhi_shi']['palace']]}宫"
+    ]
+    for palace in plate["palaces"]:
+        if palace["palace"] == 5:
+            lines.append(f"{palace['name']}宫：地盘{palace['earth_stem']}（寄坤二）")
+            continue
+        lines.append(
+            f"{palace['name']}宫：{palace['deity']} {palace['star']} {palace['gate']} "
+            f"{palace['heaven_stem']}/{palace['earth_stem']}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,279 @@
+"""
+SSE 流复用中心
+每一次流式生成分配一个 stream_id，事件按序编号后写入有界环形缓冲区：
+- 断线重连时携带 Last-Event-ID，补发缺失事件后继续接收实时事件
+- 同一 stream_id 的多个订阅者共享同一次上游 LLM 调用
+- 所有订阅者断开且宽限期内无人重连时，中止上游生成（释放 LLM 并发槽位）
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple
+
+# 中文为主的输出，粗略按 1.5 字符 / token 估算
+CHARS_PER_TOKEN = 1.5
+
+
+class StreamSession:
+    """一次流式生成（上游只执行一次，可被多次订阅）"""
+
+    def __init__(self, stream_id: str, buffer_size: int, expected_tokens: int = 0,
+                 on_idle: Optional[Callable[["StreamSession"], None]] = None, owner: Optional[str] = None):
+        self.stream_id = stream_id
+        self.owner = owner  # 发起生成的用户（None 表示不限制续传者）
+        self.events = deque(maxlen=buffer_size)  # (seq, frame)
+        self.next_seq = 1
+        self.done = False
+        self.subscribers = 0
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.expected_tokens = expected_tokens
+        self.output_chars = 0
+        self.abandoned = False
+        self.failed = False  # 上游异常或被中止（结果不完整）
+        self.abandon_handle: Optional[asyncio.TimerHandle] = None
+        self._on_idle = on_idle
+        self._changed = asyncio.Event()
+
+    def publish(self, frame: str):
+        """追加一个 SSE 数据帧并唤醒所有订阅者"""
+        self.events.append((self.next_seq, frame))
+        self.next_seq += 1
+        self.output_chars += len(frame)
+        self._notify()
+
+    def finish(self):
+        """标记上游生成结束"""
+        self.done = True
+        self.finished_at = time.time()
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    @property
+    def last_seq(self) -> int:
+        return self.next_seq - 1
+
+    @property
+    def estimated_tokens(self) -> int:
+        """已产出内容的 token 估算值"""
+        return int(self.output_chars / CHARS_PER_TOKEN)
+
+    async def subscribe(self, last_event_id: int = 0) -> AsyncIterator[str]:
+        """
+        订阅事件流
+
+        Args:
+            last_event_id: 客户端已收到的最后一个事件编号（0 表示从头开始）
+
+        Yields:
+            带 id 字段的 SSE 帧
+        """
+        cursor = last_event_id
+        self.subscribers += 1
+        if self.abandon_handle:
+            # 宽限期内有人重连，取消中止计划
+            self.abandon_handle.cancel()
+            self.abandon_handle = None
+        try:
+            while True:
+                changed = self._changed
+                oldest = self.events[0][0] if self.events else self.next_seq
+                if cursor + 1 < oldest:
+                    # 缺失的事件已被环形缓冲区淘汰，告知客户端后从最早的可用事件继续
+                    yield "data: " + json.dumps({
+                        "type": "gap",
+                        "from": cursor + 1,
+                        "to": oldest - 1
+                    }, ensure_ascii=False) + "\n\n"
+                    cursor = oldest - 1
+                for seq, frame in list(self.events):
+                    if seq > cursor:
+                        yield f"id: {seq}\n{frame}"
+                        cursor = seq
+                if self.done and cursor >= self.last_seq:
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self._on_idle:
+                self._on_idle(self)
+
+
+class StreamHub:
+    """SSE 流注册表"""
+
+    def __init__(self, buffer_size: int = 512, ttl_seconds: float = 300.0, max_sessions: int = 1000,
+                 abandon_grace_seconds: float = 10.0):
+        self.buffer_size = buffer_size
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.abandon_grace_seconds = abandon_grace_seconds
+        self.sessions: Dict[str, StreamSession] = {}
+        self.abandoned_count = 0
+        self.tokens_saved = 0
+
+    def get(self, stream_id: Optional[str]) -> Optional[StreamSession]:
+        """按 stream_id 查找仍可订阅的流"""
+        if not stream_id:
+            return None
+        self._purge()
+        return self.sessions.get(stream_id)
+
+    def reserve(self, stream_id: Optional[str], owner: Optional[str] = None) -> Tuple[StreamSession, bool]:
+        """
+        占用一个流 ID（查找与登记之间没有 await，同一 ID 的并发请求只有一个能启动生成）
+
+        占用后由 start() 启动生成；不再需要时调用 release()，已订阅的请求会收到错误事件。
+
+        Args:
+            stream_id: 客户端指定的流 ID（可选，默认随机生成）
+            owner: 发起生成的用户
+
+        Returns:
+            (session, created)：created 为 False 时 session 是该 ID 已有的流
+        """
+        self._purge()
+        if stream_id and stream_id in self.sessions:
+            return self.sessions[stream_id], False
+        return self._create(stream_id, 0, owner), True
+
+    def release(self, session: StreamSession):
+        """释放 reserve() 占用但未启动生成的流（已启动的流不受影响）"""
+        if session.task or session.done:
+            return
+        if self.sessions.get(session.stream_id) is session:
+            self.sessions.pop(session.stream_id)
+        session.failed = True
+        session.publish("data: " + json.dumps({
+            "type": "error",
+            "content": "该流未启动生成"
+        }, ensure_ascii=False) + "\n\n")
+        session.finish()
+
+    def start(self, producer: AsyncIterator[str], stream_id: Optional[str] = None,
+              expected_tokens: int = 0, owner: Optional[str] = None) -> StreamSession:
+        """
+        启动一次流式生成
+
+        上游生成器在后台任务中运行，产出的每个 SSE 帧都写入缓冲区；
+        首帧为 {"type": "stream", "stream_id": ...}，客户端据此断线重连。
+        stream_id 已由 reserve() 占用时沿用该流（订阅者与所属用户不变）。
+
+        Args:
+            producer: 产出 "data: ...\\n\\n" 帧的异步生成器
+            stream_id: 客户端指定的流 ID（可选，默认随机生成）
+            expected_tokens: 预计输出 token 数（中止时用于估算节省量）
+            owner: 发起生成的用户（续传时校验）
+
+        Returns:
+            StreamSession
+        """
+        self._purge()
+        session = self.sessions.get(stream_id) if stream_id else None
+        if session is None or session.task or session.done:
+            session = self._create(stream_id, expected_tokens, owner)
+        else:
+            session.expected_tokens = expected_tokens
+        session.task = asyncio.create_task(self._run(session, producer))
+        return session
+
+    def _create(self, stream_id: Optional[str], expected_tokens: int, owner: Optional[str]) -> StreamSession:
+        stream_id = stream_id or uuid.uuid4().hex
+        session = StreamSession(stream_id, self.buffer_size, expected_tokens,
+                                on_idle=self._schedule_abandon, owner=owner)
+        session.publish("data: " + json.dumps({
+            "type": "stream",
+            "stream_id": stream_id
+        }, ensure_ascii=False) + "\n\n")
+        self.sessions[stream_id] = session
+        return session
+
+    async def _run(self, session: StreamSession, producer: AsyncIterator[str]):
+        try:
+            async for frame in producer:
+                session.publish(frame)
+        except asyncio.CancelledError:
+            session.failed = True
+            session.publish("data: " + json.dumps({
+                "type": "error",
+                "content": "客户端已断开，生成已中止"
+            }, ensure_ascii=False) + "\n\n")
+            raise
+        except Exception as e:
+            session.failed = True
+            print(f"❌ 流 {session.stream_id} 上游生成失败: {e}", flush=True)
+            session.publish("data: " + json.dumps({
+                "type": "error",
+                "content": f"生成错误: {str(e)}"
+            }, ensure_ascii=False) + "\n\n")
+        finally:
+            session.finish()
+
+    def _schedule_abandon(self, session: StreamSession):
+        """最后一个订阅者断开：宽限期后仍无人重连则中止上游生成"""
+        if session.abandon_handle:
+            session.abandon_handle.cancel()
+        session.abandon_handle = asyncio.get_running_loop().call_later(
+            self.abandon_grace_seconds, self._abandon_if_idle, session
+        )
+
+    def _abandon_if_idle(self, session: StreamSession):
+        session.abandon_handle = None
+        if session.done or session.subscribers > 0 or not session.task:
+            return
+        session.abandoned = True
+        session.task.cancel()
+        saved = max(session.expected_tokens - session.estimated_tokens, 0)
+        self.abandoned_count += 1
+        self.tokens_saved += saved
+        print(f"🛑 流 {session.stream_id} 无订阅者，已中止上游生成（预计节省 {saved} tokens）", flush=True)
+
+    def stats(self) -> dict:
+        """流状态与中止统计"""
+        return {
+            "active": sum(1 for s in self.sessions.values() if not s.done),
+            "buffered": len(self.sessions),
+            "abandoned": self.abandoned_count,
+            "tokens_saved_estimate": self.tokens_saved
+        }
+
+    def _purge(self):
+        """清理过期的已完成流；超出容量时淘汰最早完成的流"""
+        now = time.time()
+        expired = [
+            sid for sid, s in self.sessions.items()
+            if s.done and s.finished_at and now - s.finished_at > self.ttl_seconds
+        ]
+        for sid in expired:
+            self.sessions.pop(sid, None)
+
+        if len(self.sessions) >= self.max_sessions:
+            finished = sorted(
+                (s for s in self.sessions.values() if s.done),
+                key=lambda s: s.finished_at or 0
+            )
+            for s in finished[:len(self.sessions) - self.max_sessions + 1]:
+                self.sessions.pop(s.stream_id, None)
+
+
+def parse_last_event_id(value: Optional[str]) -> int:
+    """解析 Last-Event-ID（非法值视为从头开始）"""
+    try:
+        return max(int(value), 0) if value else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+# 创建全局实例
+stream_hub = StreamHub(
+    buffer_size=int(os.getenv("SSE_REPLAY_BUFFER_SIZE", "512")),
+    ttl_seconds=float(os.getenv("SSE_REPLAY_TTL_SECONDS", "300")),
+    abandon_grace_seconds=float(os.getenv("SSE_ABANDON_GRACE_SECONDS", "10"))
+)
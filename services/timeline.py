@@ -0,0 +1,77 @@
+"""
+时间轴窗口
+0-100 岁的时间轴按需逐年生成，接口可以只取 [from_age, to_age] 区间，
+并附带该区间自身的统计摘要（均值、最高 / 最低、区间趋势、区间内的高峰低谷）。
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MAX_AGE = 100
+
+
+def resolve_window(from_age: Optional[int] = None, to_age: Optional[int] = None) -> Tuple[int, int]:
+    """
+    规范化年龄窗口（缺省为 0-100）
+
+    Raises:
+        ValueError: 超出 0-100 或 from_age > to_age
+    """
+    start = 0 if from_age is None else from_age
+    end = MAX_AGE if to_age is None else to_age
+    if not 0 <= start <= MAX_AGE or not 0 <= end <= MAX_AGE:
+        raise ValueError(f"from_age / to_age 必须在 0-{MAX_AGE} 之间")
+    if start > end:
+        raise ValueError("from_age 不能大于 to_age")
+    return start, end
+
+
+def summarize_window(
+    scores: Iterable[Tuple[int, int]],
+    from_age: int,
+    to_age: int,
+    peaks: Iterable[Dict] = (),
+    valleys: Iterable[Dict] = ()
+) -> Dict:
+    """
+    窗口统计摘要
+
+    Args:
+        scores: 窗口内的 (age, score)
+        from_age / to_age: 窗口范围
+        peaks / valleys: 全部高峰 / 低谷（只保留落在窗口内的）
+
+    Returns:
+        from_age, to_age, count, avg_score, best, worst, trend, peaks, valleys
+    """
+    pairs: List[Tuple[int, int]] = list(scores)
+    summary = {
+        "from_age": from_age,
+        "to_age": to_age,
+        "count": len(pairs),
+        "avg_score": None,
+        "best": None,
+        "worst": None,
+        "trend": None,
+        "peaks": [p for p in peaks if from_age <= p.get("age", -1) <= to_age],
+        "valleys": [v for v in valleys if from_age <= v.get("age", -1) <= to_age]
+    }
+    if not pairs:
+        return summary
+
+    values = [score for _, score in pairs]
+    best_age, best_score = max(pairs, key=lambda pair: pair[1])
+    worst_age, worst_score = min(pairs, key=lambda pair: pair[1])
+
+    # 区间趋势：后半段均值 - 前半段均值（与 5 年趋势同样以 ±5 分为界）
+    half = len(values) // 2
+    trend_value = 0.0
+    if half:
+        trend_value = sum(values[-half:]) / half - sum(values[:half]) / half
+    direction = "上升" if trend_value > 5 else ("下降" if trend_value < -5 else "平稳")
+
+    summary.update({
+        "avg_score": round(sum(values) / len(values), 1),
+        "best": {"age": best_age, "score": best_score},
+        "worst": {"age": worst_age, "score": worst_score},
+        "trend": {"direction": direction, "value": round(trend_value, 1)}
+    })
+    return summary
@@ -0,0 +1,79 @@
+"""
+小六壬起课
+单一事件起卦原先由模型自己按月、日、时掐算落宫，算错或前后不一致时只能重试。
+这里在后端确定性地算出三次落宫，作为事实注入提示词：
+- 六宫顺序：大安 → 留连 → 速喜 → 赤口 → 小吉 → 空亡（循环）
+- 从大安起第一个数（农历月 / 第一个数字），从落宫起第二个数（农历日 / 第二个数字），
+  再从落宫起第三个数（时辰序数，子=1 / 第三个数字），最后的落宫为本课结果
+"""
+from datetime import datetime
+from typing import Dict, List
+
+PALACES = [
+    {"name": "大安", "deity": "青龙", "element": "木", "luck": "吉", "meaning": "事情平稳，宜守不宜动，所求可成"},
+    {"name": "留连", "deity": "玄武", "element": "水", "luck": "凶", "meaning": "事多拖延反复，进展缓慢"},
+    {"name": "速喜", "deity": "朱雀", "element": "火", "luck": "吉", "meaning": "喜讯将至，事情推进快"},
+    {"name": "赤口", "deity": "白虎", "element": "金", "luck": "凶", "meaning": "易有口舌争执，需防误会"},
+    {"name": "小吉", "deity": "六合", "element": "水", "luck": "吉", "meaning": "小有所得，人和事顺"},
+    {"name": "空亡", "deity": "勾陈", "element": "土", "luck": "凶", "meaning": "所求易落空，暂不宜强求"},
+]
+
+
+def _count(first: int, second: int, third: int) -> List[Dict]:
+    """按三个数依次掐算落宫（每次从上一落宫起数，落宫本身计为 1）"""
+    sequence = []
+    position = 0  # 从大安起数
+    for number in (first, second, third):
+        position = (position + number - 1) % len(PALACES)
+        sequence.append(PALACES[position])
+    return sequence
+
+
+def liuren_by_numbers(first: int, second: int, third: int) -> Dict:
+    """
+    数字起课
+
+    Returns:
+        method, inputs, sequence（三次落宫）, result（最终落宫）
+    """
+    sequence = _count(first, second, third)
+    return {
+        "method": "数字起课",
+        "inputs": [first, second, third],
+        "labels": [str(first), str(second), str(third)],
+        "sequence": sequence,
+        "result": sequence[-1]
+    }
+
+
+def liuren_by_time(moment: datetime, calculator) -> Dict:
+    """
+    时间起课（农历月 + 农历日 + 时辰）
+
+    Args:
+        moment: 起课时间（北京时间）
+        calculator: FortuneCalculator（提供农历换算）
+    """
+    lunar = calculator.get_lunar_date(moment)
+    hour_number = lunar["hour_index"] + 1
+    sequence = _count(lunar["month"], lunar["day"], hour_number)
+    return {
+        "method": "时间起课",
+        "inputs": [lunar["month"], lunar["day"], hour_number],
+        "labels": [lunar["month_name"], lunar["day_name"], f"{lunar['hour_zhi']}时"],
+        "sequence": sequence,
+        "result": sequence[-1]
+    }
+
+
+def format_liuren(lesson: Dict) -> str:
+    """起课结果 → 注入提示词的事实文本"""
+    result = lesson["result"]
+    steps = " → ".join(
+        f"{label}落{palace['name']}" for label, palace in zip(lesson["labels"], lesson["sequence"])
+    )
+    return "\n".join([
+        f"起课方式：{lesson['method']}（{' '.join(lesson['labels'])}）",
+        f"掐算：{steps}",
+        f"结果：{result['name']}（{result['deity']}，五行{result['element']}，{result['luck']}）—— {result['meaning']}"
+    ])
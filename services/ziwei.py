@@ -0,0 +1,179 @@
+"""
+紫微斗数排盘
+多处提示词要求模型“结合紫微斗数”，但后端并不排紫微盘，模型每次都凭空推演。这里按农历生辰查表排盘：
+- 命宫：寅宫起正月顺数至生月，再从该宫起子时逆数至生时；身宫：同样起月后顺数至生时
+- 十二宫：从命宫起逆布（命宫、兄弟、夫妻 ... 父母），宫干按年干五虎遁
+- 五行局：命宫干支纳音；紫微星由五行局与生日查表，天府与紫微以寅申为轴对称
+- 十四主星按紫微、天府两个星系定位，另排文昌、文曲、左辅、右弼（四化会用到）
+- 四化按生年天干；大限从命宫起，阳男阴女顺行、阴男阳女逆行
+
+闰月按本月排。同一时辰出生的命盘相同，排盘结果按农历生辰缓存。
+"""
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from calculator import FortuneCalculator
+
+TIAN_GAN = "甲乙丙丁戊己庚辛壬癸"
+DI_ZHI = "子丑寅卯辰巳午未申酉戌亥"
+
+PALACE_NAMES = ("命宫", "兄弟", "夫妻", "子女", "财帛", "疾厄", "迁移", "交友", "官禄", "田宅", "福德", "父母")
+
+# 纳音五行 → 五行局
+JU_BY_ELEMENT = {"水": 2, "木": 3, "金": 4, "土": 5, "火": 6}
+JU_NAMES = {2: "水二局", 3: "木三局", 4: "金四局", 5: "土五局", 6: "火六局"}
+
+# 五虎遁：年干 → 寅宫天干
+YIN_STEM_BY_YEAR_GAN = {"甲": "丙", "己": "丙", "乙": "戊", "庚": "戊", "丙": "庚", "辛": "庚",
+                        "丁": "壬", "壬": "壬", "戊": "甲", "癸": "甲"}
+
+# 紫微星系（相对紫微的偏移，逆行）与天府星系（相对天府的偏移，顺行）
+ZIWEI_GROUP = (("紫微", 0), ("天机", -1), ("太阳", -3), ("武曲", -4), ("天同", -5), ("廉贞", -8))
+TIANFU_GROUP = (("天府", 0), ("太阴", 1), ("贪狼", 2), ("巨门", 3), ("天相", 4), ("天梁", 5), ("七杀", 6), ("破军", 10))
+
+# 生年四化：禄、权、科、忌
+SI_HUA = {
+    "甲": ("廉贞", "破军", "武曲", "太阳"), "乙": ("天机", "天梁", "紫微", "太阴"),
+    "丙": ("天同", "天机", "文昌", "廉贞"), "丁": ("太阴", "天同", "天机", "巨门"),
+    "戊": ("贪狼", "太阴", "右弼", "天机"), "己": ("武曲", "贪狼", "天梁", "文曲"),
+    "庚": ("太阳", "武曲", "太阴", "天同"), "辛": ("巨门", "太阳", "文曲", "文昌"),
+    "壬": ("天梁", "紫微", "左辅", "武曲"), "癸": ("破军", "巨门", "太阴", "贪狼"),
+}
+SI_HUA_NAMES = ("化禄", "化权", "化科", "化忌")
+
+
+def _build_ziwei_table() -> Dict[int, List[int]]:
+    """预先算好紫微星位置：五行局 → 生日（1-30）对应的地支下标"""
+    table = {}
+    for ju in JU_NAMES:
+        positions = []
+        for day in range(1, 31):
+            quotient = -(-day // ju)  # 向上取整
+            extra = quotient * ju - day
+            base = (2 + quotient - 1) % 12  # 寅宫起 1
+            positions.append((base + extra) % 12 if extra % 2 == 0 else (base - extra) % 12)
+        table[ju] = positions
+    return table
+
+
+ZIWEI_TABLE = _build_ziwei_table()
+
+
+@lru_cache(maxsize=4096)
+def _build_chart(year_gan_zhi: str, month: int, day: int, hour_index: int, forward: Optional[bool]) -> Dict:
+    """按农历生辰排盘（forward 为大限方向，None 表示性别未知、不排大限）"""
+    year_gan = year_gan_zhi[0]
+    ming = (2 + month - 1 - hour_index) % 12
+    shen = (2 + month - 1 + hour_index) % 12
+
+    yin_stem = TIAN_GAN.index(YIN_STEM_BY_YEAR_GAN[year_gan])
+    stems = {branch: TIAN_GAN[(yin_stem + (branch - 2) % 12) % 10] for branch in range(12)}
+
+    ming_gan_zhi = stems[ming] + DI_ZHI[ming]
+    ju = JU_BY_ELEMENT[FortuneCalculator.NA_YIN_FULL[ming_gan_zhi][-1]]
+
+    ziwei = ZIWEI_TABLE[ju][day - 1]
+    tianfu = (4 - ziwei) % 12
+    stars: Dict[str, int] = {}
+    for name, offset in ZIWEI_GROUP:
+        stars[name] = (ziwei + offset) % 12
+    for name, offset in TIANFU_GROUP:
+        stars[name] = (tianfu + offset) % 12
+    minor = {
+        "文昌": (10 - hour_index) % 12,
+        "文曲": (4 + hour_index) % 12,
+        "左辅": (4 + month - 1) % 12,
+        "右弼": (10 - month + 1) % 12
+    }
+
+    transforms = {star: label for star, label in zip(SI_HUA[year_gan], SI_HUA_NAMES)}
+
+    palaces = []
+    for index, name in enumerate(PALACE_NAMES):
+        branch = (ming - index) % 12
+        palace = {
+            "name": name,
+            "branch": DI_ZHI[branch],
+            "gan_zhi": stems[branch] + DI_ZHI[branch],
+            "main_stars": [star for star, position in stars.items() if position == branch],
+            "minor_stars": [star for star, position in minor.items() if position == branch],
+            "is_shen": branch == shen
+        }
+        if forward is not None:
+            # 宫位逆布，顺行大限第 n 步落在第 12 - n 宫
+            step = (12 - index) % 12 if forward else index
+            palace["decade"] = [ju + step * 10, ju + step * 10 + 9]
+        palaces.append(palace)
+
+    return {
+        "ju": ju,
+        "ju_name": JU_NAMES[ju],
+        "ming": DI_ZHI[ming],
+        "shen": DI_ZHI[shen],
+        "shen_palace": PALACE_NAMES[(ming - shen) % 12],
+        "si_hua": [
+            {"star": star, "type": label,
+             "palace": PALACE_NAMES[(ming - {**stars, **minor}[star]) % 12]}
+            for star, label in transforms.items()
+        ],
+        "palaces": palaces
+    }
+
+
+def ziwei_chart(birth_moment: datetime, calculator: FortuneCalculator, gender: Optional[str] = None) -> Dict:
+    """
+    排紫微斗数命盘
+
+    Args:
+        birth_moment: 出生时间（建议用真太阳时）
+        calculator: FortuneCalculator（提供农历换算）
+        gender: 性别（男 / 女 / male / female），未知时不排大限
+
+    Returns:
+        lunar（农历生辰）, ju / ju_name（五行局）, ming / shen（命宫、身宫地支）, shen_palace（身宫所在宫）,
+        si_hua（生年四化及所在宫）, palaces（十二宫：宫名、干支、主星、辅星、是否身宫、大限）
+    """
+    lunar = calculator.get_lunar_date(birth_moment)
+    forward = None
+    if gender:
+        male = gender.lower() in ("男", "male", "m")
+        yang_year = TIAN_GAN.index(lunar["year_gan_zhi"][0]) % 2 == 0
+        forward = male == yang_year  # 阳男阴女顺行
+    chart = _build_chart(lunar["year_gan_zhi"], lunar["month"], lunar["day"], lunar["hour_index"], forward)
+    return {
+        "lunar": {
+            "year_gan_zhi": lunar["year_gan_zhi"],
+            "month_name": lunar["month_name"],
+            "day_name": lunar["day_name"],
+            "hour_zhi": lunar["hour_zhi"]
+        },
+        **chart
+    }
+
+
+def ziwei_cache_stats() -> Dict:
+    """排盘缓存命中情况（供 /health 使用）"""
+    info = _build_chart.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize}
+
+
+def format_ziwei(chart: Dict) -> str:
+    """紫微命盘 → 注入提示词的事实文本（每宫一行）"""
+    lunar = chart["lunar"]
+    transforms = {item["star"]: item["type"] for item in chart["si_hua"]}
+    lines = [
+        f"农历{lunar['year_gan_zhi']}年{lunar['month_name']}{lunar['day_name']} {lunar['hour_zhi']}时，"
+        f"{chart['ju_name']}；命宫在{chart['ming']}，身宫在{chart['shen']}（{chart['shen_palace']}）"
+    ]
+    for palace in chart["palaces"]:
+        stars = [star + transforms.get(star, "") for star in palace["main_stars"]] or ["无主星"]
+        minor = [star + transforms.get(star, "") for star in palace["minor_stars"]]
+        line = f"{palace['name']}（{palace['gan_zhi']}）：{' '.join(stars)}"
+        if minor:
+            line += f"；{' '.join(minor)}"
+        if palace.get("decade"):
+            line += f"；大限{palace['decade'][0]}-{palace['decade'][1]}岁"
+        lines.append(line)
+    lines.append("四化：" + " ".join(f"{item['star']}{item['type']}（{item['palace']}）" for item in chart["si_hua"]))
+    return "\n".join(lines)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+测试梅花易数起卦数字的提取（运行：python -m pytest test_meihua.py）
+"""
+from services.meihua import cast_by_numbers, extract_numbers
+
+
+def test_hinted_numbers():
+    """“数字/号码”之后的三个数用来起卦"""
+    assert extract_numbers("我的论文能中稿吗？数字 3 7 9") == [3, 7, 9]
+    assert extract_numbers("号码是12、5、33") == [12, 5, 33]
+    assert extract_numbers("我出生于1990年5月15日14:30，数字是 3 7 9") == [3, 7, 9]
+
+
+def test_bare_numbers_need_a_request():
+    """没有提示、也不是在回答“请提供三个数字”时，不起卦"""
+    assert extract_numbers("15 23 8") is None
+    assert extract_numbers("15 23 8", allow_bare=True) == [15, 23, 8]
+    assert extract_numbers("1990-05-15 14:30 男，12 5 33", allow_bare=True) == [12, 5, 33]
+
+
+def test_dates_are_not_numbers():
+    """生日、日期不当成起卦数"""
+    assert extract_numbers("我1990 5 3 出生") is None
+    assert extract_numbers("我1990 5 3 出生", allow_bare=True) is None
+    assert extract_numbers("1990 5 3", allow_bare=True) is None
+    assert extract_numbers("我 5 3 12 出生的", allow_bare=True) is None
+    assert extract_numbers("1990-05-15", allow_bare=True) is None
+    assert extract_numbers("1990/5/15", allow_bare=True) is None
+    assert extract_numbers("1990年5月15日", allow_bare=True) is None
+
+
+def test_times_are_not_numbers():
+    """时刻不当成起卦数"""
+    assert extract_numbers("明天 14:30 10:00 9:15 面试", allow_bare=True) is None
+    assert extract_numbers("1990-05-15 14:30", allow_bare=True) is None
+    assert extract_numbers("下午 3 点 15 分", allow_bare=True) is None
+
+
+def test_same_numbers_same_cast():
+    """同样的数字总是得到同样的卦"""
+    first = cast_by_numbers(6, 3, 1)
+    second = cast_by_numbers(6, 3, 1)
+    assert first["primary"]["name"] == second["primary"]["name"]
+    assert first["changed"]["name"] == second["changed"]["name"]
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+测试小六壬时间起课（运行：python -m pytest test_xiaoliuren.py）
+"""
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from calculator import FortuneCalculator
+from services.xiaoliuren import liuren_by_time
+
+calculator = FortuneCalculator()
+
+# 起课时刻（北京时间）→ (农历月, 农历日, 时辰序数, 落宫)
+KNOWN_LESSONS = [
+    (datetime(1990, 5, 3, 8), 4, 9, 5, "赤口"),      # 四月初九辰时
+    (datetime(2024, 2, 10, 0, 30), 1, 1, 1, "大安"),  # 正月初一子时
+    (datetime(2026, 10, 19, 13, 30), 9, 10, 8, "大安"),  # 九月初十未时
+    (datetime(2026, 10, 19, 5, 30), 9, 10, 4, "速喜"),   # 九月初十卯时
+]
+
+
+@pytest.mark.parametrize("moment, month, day, hour_number, palace", KNOWN_LESSONS)
+def test_known_lessons(moment, month, day, hour_number, palace):
+    lesson = liuren_by_time(moment, calculator)
+    assert lesson["inputs"] == [month, day, hour_number]
+    assert lesson["result"]["name"] == palace
+
+
+def test_utc_moment_uses_beijing_hour():
+    """UTC 05:30 是北京时间 13:30（未时），不能按卯时起课"""
+    utc = datetime(2026, 10, 19, 5, 30, tzinfo=ZoneInfo("UTC"))
+    beijing = utc.astimezone(ZoneInfo("Asia/Shanghai")).replace(tzinfo=None)
+    lesson = liuren_by_time(beijing, calculator)
+    assert lesson["labels"][2] == "未时"
+    assert lesson["result"]["name"] == "大安"
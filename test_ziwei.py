@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+测试紫微斗数排盘（运行：python -m pytest test_ziwei.py）
+"""
+from datetime import datetime
+
+import pytest
+
+from calculator import FortuneCalculator
+from services.ziwei import TIAN_GAN, ziwei_chart
+
+calculator = FortuneCalculator()
+
+# 出生时间 → (命宫干支, 兄弟宫干支, 五行局, 命宫主星)
+KNOWN_CHARTS = [
+    # 庚午年四月初九辰时：命宫在丑，子丑两宫接在亥宫之后（戊寅 ... 丁亥、戊子、己丑）
+    (datetime(1990, 5, 3, 8), "己丑", "戊子", "火六局", []),
+    # 同日巳时：命宫在子，戊子霹雳火为火六局，初九紫微在子
+    (datetime(1990, 5, 3, 10), "戊子", "丁亥", "火六局", ["紫微"]),
+    # 甲子年正月初九卯时：命宫乙亥（山头火）
+    (datetime(1984, 2, 10, 5), "乙亥", "甲戌", "火六局", ["天机"]),
+    # 己卯年冬月廿五午时：命宫庚午（路旁土）
+    (datetime(2000, 1, 1, 12), "庚午", "己巳", "土五局", ["紫微"]),
+]
+
+
+@pytest.mark.parametrize("moment, ming, xiong_di, ju_name, main_stars", KNOWN_CHARTS)
+def test_known_charts(moment, ming, xiong_di, ju_name, main_stars):
+    chart = ziwei_chart(moment, calculator, "男")
+    palaces = {palace["name"]: palace for palace in chart["palaces"]}
+    assert palaces["命宫"]["gan_zhi"] == ming
+    assert palaces["兄弟"]["gan_zhi"] == xiong_di
+    assert chart["ju_name"] == ju_name
+    assert palaces["命宫"]["main_stars"] == main_stars
+
+
+def test_palace_stems_continue_after_hai():
+    """五虎遁从寅宫起干，子、丑两宫的天干紧接亥宫"""
+    chart = ziwei_chart(datetime(1990, 5, 3, 8), calculator)
+    stems = {palace["branch"]: palace["gan_zhi"][0] for palace in chart["palaces"]}
+    assert TIAN_GAN.index(stems["子"]) == (TIAN_GAN.index(stems["亥"]) + 1) % 10
+    assert TIAN_GAN.index(stems["丑"]) == (TIAN_GAN.index(stems["子"]) + 1) % 10